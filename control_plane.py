@@ -0,0 +1,648 @@
+# -*- coding: utf-8 -*-
+
+"""
+control_plane.py -- TCP connections between test driver and worker hosts
+used instead of files in the shared network directory
+to pass test parameters, readiness, start, stonewall, abort and results,
+so that test coordination does not load the storage being measured.
+every message carries an HMAC made with a secret key for this test run,
+which the test driver passes to remote hosts on the command line,
+and messages are only unpickled once their HMAC is checked.
+Copyright 2012 -- Ben England
+Licensed under the Apache License at http://www.apache.org/licenses/LICENSE-2.0
+See Appendix on this page for instructions pertaining to license.
+"""
+
+import hashlib
+import hmac
+import ipaddress
+import os
+import pickle
+import secrets
+import select
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+import smallfile
+from smallfile import SMFRunException, unittest_module
+
+# each message is a pickled (kind, payload) tuple preceded by its length
+# and by an HMAC of the pickle
+
+msg_hello = "hello"  # host -> driver, payload is host name (--as-host)
+msg_params = "params"  # driver -> host, payload is smf_test_params
+msg_ready = "ready"  # host -> driver, all threads on host at starting gate
+msg_start = "start"  # driver -> host, start the test now
+msg_stonewall = "stonewall"  # either way, some thread has finished
+msg_abort = "abort"  # either way, payload is the reason
+msg_result = "result"  # host -> driver, payload is a thread's thread_result
+msg_results_done = "results-done"  # host -> driver, payload is result count
+
+msg_len_format = "!I"
+msg_len_size = struct.calcsize(msg_len_format)
+msg_digest = hashlib.sha256
+msg_digest_size = msg_digest().digest_size
+msg_header_size = msg_len_size + msg_digest_size
+
+# length is checked before any more of a message is read,
+# a hello is just a host name, so a connection that has not said hello
+# cannot make the test driver hold more than max_hello_len bytes for it
+
+max_msg_len = 1 << 26
+max_hello_len = 1 << 12
+
+# secret key for a test run, as hex digits for the command line
+
+
+def new_key():
+    return secrets.token_hex(32)
+
+
+def sign(key, data):
+    return hmac.new(bytes.fromhex(key), data, msg_digest).digest()
+
+
+def send_msg(sock, key, kind, payload=None):
+    data = pickle.dumps((kind, payload))
+    header = struct.pack(msg_len_format, len(data)) + sign(key, data)
+    sock.sendall(header + data)
+
+
+def recv_exactly(sock, count):
+    chunks = []
+    while count > 0:
+        chunk = sock.recv(min(count, 1 << 20))
+        if not chunk:
+            raise SMFRunException("control connection closed by other end")
+        chunks.append(chunk)
+        count -= len(chunk)
+    return b"".join(chunks)
+
+
+def check_msg_len(msg_len, limit):
+    if msg_len > limit:
+        raise SMFRunException(
+            "control message of %d bytes rejected, limit is %d" % (msg_len, limit)
+        )
+
+
+def verify_msg(key, digest, data):
+    if not hmac.compare_digest(digest, sign(key, data)):
+        raise SMFRunException("control message with wrong HMAC rejected")
+    return pickle.loads(data)
+
+
+def recv_msg(sock, key):
+    (msg_len,) = struct.unpack(msg_len_format, recv_exactly(sock, msg_len_size))
+    check_msg_len(msg_len, max_msg_len)
+    digest = recv_exactly(sock, msg_digest_size)
+    return verify_msg(key, digest, recv_exactly(sock, msg_len))
+
+
+# remove complete messages from the front of buf, bytes received so far
+# on a connection, and return them, any partial message is left in buf
+
+
+def take_msgs(buf, key, limit):
+    msgs = []
+    while len(buf) >= msg_len_size:
+        (msg_len,) = struct.unpack_from(msg_len_format, buf)
+        check_msg_len(msg_len, limit)
+        if len(buf) < msg_header_size + msg_len:
+            break
+        digest = bytes(buf[msg_len_size:msg_header_size])
+        data = bytes(buf[msg_header_size : msg_header_size + msg_len])
+        del buf[0 : msg_header_size + msg_len]
+        msgs.append(verify_msg(key, digest, data))
+    return msgs
+
+
+# parse "host:port" given to smallfile_remote.py --control-addr
+
+
+def parse_addr(addr):
+    (host, sep, port) = addr.rpartition(":")
+    if not sep or not host:
+        raise SMFRunException("control address %s is not host:port" % addr)
+    return (host, int(port))
+
+
+# true if host name resolves to a loopback address, as it does
+# for the host's own name with the usual Debian or Ubuntu /etc/hosts
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(smallfile.hostaddr(host)).is_loopback
+    except OSError:
+        return False
+
+
+# address of this host on the network it reaches remote_host through,
+# or None if that cannot be found, no packets are sent
+
+
+def address_toward(remote_host):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((remote_host, 9))
+        return s.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        s.close()
+
+
+# the test driver only listens on --control-host, so remote hosts in
+# host_set must be able to reach it.  if control_host is loopback and
+# was not chosen by the user, use this host's address toward them instead,
+# returns the control host to use
+
+
+def reachable_control_host(control_host, host_set, user_chose):
+    remote_hosts = [h for h in host_set if not is_loopback(h)]
+    if not remote_hosts or not is_loopback(control_host):
+        return control_host
+    if not user_chose:
+        for h in remote_hosts:
+            addr = address_toward(h)
+            if addr is not None and not ipaddress.ip_address(addr).is_loopback:
+                return addr
+    raise SMFRunException(
+        "--control-host %s resolves to loopback address %s, so hosts %s "
+        "could not reach the test driver, use --control-host to give "
+        "an address of this host that they can reach"
+        % (control_host, smallfile.hostaddr(control_host), ",".join(remote_hosts))
+    )
+
+
+# test driver side, runs in smallfile_cli.py.
+# it listens only on the --control-host address,
+# accepts one connection from each worker host in the host set,
+# and handles messages from all of them in one thread using a selector.
+# it never waits for the rest of a message: bytes received on a connection
+# are kept until a whole message is there, and a connection that has not
+# said hello within hello_timeout seconds is dropped
+
+
+class coordinator:
+    hello_timeout = 10.0
+    send_timeout = 10.0
+
+    def __init__(self, prm):
+        self.prm = prm
+        self.verbose = prm.master_invoke.verbose
+        self.key = new_key()
+        self.listener = socket.create_server((prm.control_host, prm.control_port))
+        self.port = self.listener.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.hosts = {}  # host name -> connection
+        self.hello_deadlines = {}  # connection -> time it must say hello by
+        self.ready = set()
+        self.results = {}  # host name -> list of smallfile.thread_result
+        self.done = set()  # hosts that will send no more results
+        self.started = False
+        self.stonewall_sent = False
+        self.abort_reason = None
+
+    # address that remote hosts connect to
+
+    def addr(self):
+        return "%s:%d" % (self.prm.control_host, self.port)
+
+    # what smallfile_remote.py needs to connect to this test driver
+
+    def remote_args(self):
+        return "--control-addr %s --control-key %s" % (self.addr(), self.key)
+
+    def host_of(self, conn):
+        for (h, c) in self.hosts.items():
+            if c is conn:
+                return h
+        return None
+
+    def send(self, conn, kind, payload=None):
+        try:
+            send_msg(conn, self.key, kind, payload)
+        except OSError as e:
+            print(
+                "control: could not send %s to %s: %s" % (kind, self.host_of(conn), e)
+            )
+
+    def broadcast(self, kind, payload=None):
+        for conn in list(self.hosts.values()):
+            self.send(conn, kind, payload)
+
+    # handle whatever arrives within timeout seconds
+
+    def poll(self, timeout):
+        for (key, _) in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                (conn, _) = self.listener.accept()
+                # recv() returns what has arrived once select() says readable,
+                # and sendall() gives up on a host that stops reading
+                conn.settimeout(self.send_timeout)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.selector.register(conn, selectors.EVENT_READ, bytearray())
+                self.hello_deadlines[conn] = time.monotonic() + self.hello_timeout
+                continue
+            conn = key.fileobj
+            h = self.host_of(conn)
+            limit = max_hello_len if h is None else max_msg_len
+            try:
+                chunk = conn.recv(1 << 20)
+                if not chunk:
+                    raise SMFRunException("control connection closed by other end")
+                key.data.extend(chunk)
+                msgs = take_msgs(key.data, self.key, limit)
+            except (OSError, EOFError, SMFRunException) as e:
+                self.drop(conn)
+                if h is not None:
+                    del self.hosts[h]
+                    self.lost_host(h, e)
+                else:
+                    print("control: connection dropped before hello: %s" % e)
+                continue
+            for (kind, payload) in msgs:
+                if conn.fileno() < 0:
+                    break  # dropped while handling an earlier message
+                self.handle(conn, kind, payload)
+        now = time.monotonic()
+        for (conn, deadline) in list(self.hello_deadlines.items()):
+            if now > deadline:
+                print("control: no hello within %d seconds" % self.hello_timeout)
+                self.drop(conn)
+
+    def drop(self, conn):
+        self.hello_deadlines.pop(conn, None)
+        self.selector.unregister(conn)
+        conn.close()
+
+    # before the test starts, losing a host aborts the test,
+    # after that, results it sent before it was lost are kept
+
+    def lost_host(self, h, e):
+        if h in self.done:
+            return
+        if not self.started:
+            if self.abort_reason is None:
+                self.abort_reason = "lost connection to host %s: %s" % (h, e)
+            return
+        self.done.add(h)
+        print(
+            "ERROR: lost connection to host %s after %d thread results: %s"
+            % (h, len(self.results.get(h, [])), e)
+        )
+
+    # only hosts in the host set may say hello, once each,
+    # and nothing else is accepted on a connection before its hello
+
+    def handle(self, conn, kind, payload):
+        h = self.host_of(conn)
+        if kind == msg_hello:
+            if h is not None or payload not in self.prm.host_set:
+                print("control: rejected hello from host %s" % payload)
+                self.drop(conn)
+            elif payload in self.hosts:
+                print("control: rejected second hello from host %s" % payload)
+                self.drop(conn)
+            else:
+                self.hosts[payload] = conn
+                del self.hello_deadlines[conn]
+                self.send(conn, msg_params, self.prm)
+            return
+        if h is None:
+            print("control: %s before hello, connection dropped" % kind)
+            self.drop(conn)
+            return
+        if self.verbose:
+            print("control: %s from host %s" % (kind, h))
+        if kind == msg_ready:
+            self.ready.add(h)
+        elif kind == msg_stonewall:
+            if not self.stonewall_sent:
+                self.stonewall_sent = True
+                self.broadcast(msg_stonewall)
+        elif kind == msg_result:
+            self.results.setdefault(h, []).append(payload)
+        elif kind == msg_results_done:
+            self.done.add(h)
+        elif kind == msg_abort:
+            self.abort_reason = "host %s aborted: %s" % (h, payload)
+        else:
+            print("control: unexpected message %s from host %s" % (kind, h))
+
+    # handle messages until done() returns True,
+    # returns False if timeout seconds pass first, or if give_up() returns True
+
+    def wait_for(self, done, timeout, give_up):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done():
+            if self.abort_reason is not None:
+                raise SMFRunException(self.abort_reason)
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            if give_up():
+                self.poll(0.0)  # in case last messages arrived
+                return done()
+            self.poll(0.5)
+        return True
+
+    # run the test once remote hosts have been launched,
+    # launchers are the threads that launched them,
+    # returns list of smallfile.thread_result from all hosts
+
+    def run(self, launchers, host_timeout):
+        host_set = self.prm.host_set
+
+        def all_ready():
+            return len(self.ready) == len(host_set)
+
+        def any_launcher_died():
+            return [t for t in launchers if not smallfile.thrd_is_alive(t)] != []
+
+        def all_results():
+            return len(self.done) == len(host_set)
+
+        def all_launchers_died():
+            return [t for t in launchers if smallfile.thrd_is_alive(t)] == []
+
+        try:
+            if not self.wait_for(all_ready, host_timeout, any_launcher_died):
+                missing = [h for h in host_set if h not in self.ready]
+                raise SMFRunException(
+                    "hosts %s did not reach starting gate within %d seconds"
+                    % (",".join(missing), host_timeout)
+                )
+
+            # this is like firing the gun at the track meet
+
+            self.broadcast(msg_start)
+            self.started = True
+            self.prm.test_start_time = time.time()
+            print("starting all threads on %d hosts" % len(host_set))
+            if not self.wait_for(all_results, None, all_launchers_died):
+                missing = [h for h in host_set if h not in self.done]
+                print("ERROR: not all results from hosts %s" % ",".join(missing))
+        except (SMFRunException, KeyboardInterrupt) as e:
+            self.broadcast(msg_abort, str(e))
+            raise
+        finally:
+            self.close()
+        invoke_list = []
+        for h in host_set:
+            invoke_list.extend(self.results.get(h, []))
+        return invoke_list
+
+    def close(self):
+        for conn in list(self.hosts.values()) + list(self.hello_deadlines.keys()):
+            conn.close()
+        self.hosts = {}
+        self.hello_deadlines = {}
+        self.selector.close()
+        self.listener.close()
+
+
+# worker host side, runs in smallfile_remote.py
+
+
+class control_client:
+    def __init__(self, addr, key, as_host, timeout=60):
+        self.key = key
+        self.sock = socket.create_connection(parse_addr(addr), timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # main thread and watcher thread both send
+        self.send_lock = threading.Lock()
+        try:
+            self.send(msg_hello, as_host)
+            (kind, self.params) = recv_msg(self.sock, self.key)
+            if kind != msg_params:
+                raise SMFRunException("expected test parameters, got %s" % kind)
+        except (OSError, EOFError, SMFRunException):
+            self.sock.close()
+            raise
+
+    def send(self, kind, payload=None):
+        with self.send_lock:
+            send_msg(self.sock, self.key, kind, payload)
+
+    # return next message, or None if none arrives within timeout seconds
+
+    def poll(self, timeout):
+        (readable, _, _) = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return None
+        return recv_msg(self.sock, self.key)
+
+    # wait for test driver to start the test,
+    # stonewall from a host that finished early is not possible yet
+
+    def wait_for_start(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                raise SMFRunException(
+                    "starting signal not seen within %d seconds" % timeout
+                )
+            msg = self.poll(remaining)
+            if msg is None:
+                continue
+            (kind, payload) = msg
+            if kind == msg_start:
+                return
+            if kind == msg_abort:
+                raise SMFRunException("test driver aborted test: %s" % payload)
+
+    def close(self):
+        self.sock.close()
+
+
+# run two worker hosts on this one, as separate smallfile_remote.py processes
+# connected over loopback, and check that all their results come back
+
+
+class Test(unittest_module.TestCase):
+    def test_loopback_hosts(self):
+        import smf_test_params
+
+        hosts = ["ctlhost0", "ctlhost1"]
+        prm = smf_test_params.smf_test_params(
+            host_set=hosts, thread_count=2, top_dirs=[os.path.join("/var/tmp", "smf")]
+        )
+        prm.control_host = "127.0.0.1"
+        prm.master_invoke.iterations = 50
+        prm.master_invoke.total_sz_kb = 4
+        prm.master_invoke.prefix = "ctl"
+        prm.recalculate_timeouts()
+        for opname in ["create", "cleanup"]:
+            prm.master_invoke.opname = opname
+            prm.master_invoke.create_top_dirs(False)
+            coord = coordinator(prm)
+            remote_pgm = os.path.join(os.path.dirname(__file__), "smallfile_remote.py")
+            launchers = [
+                threading.Thread(
+                    target=os.system,
+                    args=(
+                        "%s %s %s --as-host %s"
+                        % (sys.executable, remote_pgm, coord.remote_args(), h),
+                    ),
+                )
+                for h in hosts
+            ]
+            for t in launchers:
+                t.start()
+            invoke_list = coord.run(launchers, prm.host_startup_timeout)
+            for t in launchers:
+                t.join()
+            self.assertTrue(len(invoke_list) == len(hosts) * prm.thread_count)
+            self.assertTrue(
+                sorted(set([invk.onhost for invk in invoke_list])) == sorted(hosts)
+            )
+            for invk in invoke_list:
+                self.assertTrue(invk.status == smallfile.OK)
+                self.assertTrue(invk.filenum_final is not None)
+            # no file coordination in the shared directory
+            self.assertTrue(os.listdir(prm.master_invoke.network_dir) == [])
+
+    # a host lost after the test started does not abort the test,
+    # results of its threads that finished before that are kept
+
+    def test_lost_host_keeps_results(self):
+        import smf_test_params
+
+        hosts = ["ctlhost0", "ctlhost1"]
+        prm = smf_test_params.smf_test_params(host_set=hosts, thread_count=2)
+        prm.control_host = "127.0.0.1"
+        coord = coordinator(prm)
+        try:
+            # each client waits for test parameters from coordinator
+            clients = {}
+
+            def connect(h):
+                clients[h] = control_client(coord.addr(), coord.key, h)
+
+            connectors = [threading.Thread(target=connect, args=(h,)) for h in hosts]
+            for t in connectors:
+                t.start()
+            self.assertTrue(coord.wait_for(lambda: len(coord.hosts) == 2, 10, bool))
+            for t in connectors:
+                t.join()
+            clients = [clients[h] for h in hosts]
+            inv = prm.master_invoke
+            inv.tid = "00"
+            rslt = smallfile.thread_result(inv)
+            coord.started = True
+            for c in clients:
+                c.send(msg_result, rslt)
+            clients[0].send(msg_result, rslt)
+            clients[0].send(msg_results_done, 2)
+            clients[0].close()
+            clients[1].close()
+            self.assertTrue(coord.wait_for(lambda: len(coord.done) == 2, 10, bool))
+            self.assertTrue(coord.abort_reason is None)
+            self.assertTrue(len(coord.results["ctlhost0"]) == 2)
+            self.assertTrue(len(coord.results["ctlhost1"]) == 1)
+        finally:
+            coord.close()
+
+    # a client without the test run's key, or not in the host set,
+    # gets no parameters and cannot send anything that is unpickled
+
+    def test_reject_strangers(self):
+        import smf_test_params
+
+        prm = smf_test_params.smf_test_params(host_set=["ctlhost0"], thread_count=1)
+        prm.control_host = "127.0.0.1"
+        coord = coordinator(prm)
+        try:
+            for (key, h) in [(new_key(), "ctlhost0"), (coord.key, "stranger")]:
+                outcome = []
+
+                def connect():
+                    try:
+                        control_client(coord.addr(), key, h, timeout=5)
+                        outcome.append("connected")
+                    except (OSError, SMFRunException) as e:
+                        outcome.append(e)
+
+                t = threading.Thread(target=connect)
+                t.start()
+                while t.is_alive():
+                    coord.poll(0.1)
+                t.join()
+                self.assertTrue(isinstance(outcome[0], SMFRunException))
+                self.assertTrue(coord.hosts == {})
+                self.assertTrue(coord.abort_reason is None)
+        finally:
+            coord.close()
+
+    # a client that sends part of a message and stops does not hold up
+    # other hosts, and is dropped if it does not say hello in time,
+    # one that sends too long a message is dropped right away
+
+    def test_stalled_client(self):
+        import smf_test_params
+
+        prm = smf_test_params.smf_test_params(host_set=["ctlhost0"], thread_count=1)
+        prm.control_host = "127.0.0.1"
+        coord = coordinator(prm)
+        coord.hello_timeout = 1.0
+        try:
+            stalled = socket.create_connection(("127.0.0.1", coord.port))
+            stalled.sendall(b"\0")
+            too_long = socket.create_connection(("127.0.0.1", coord.port))
+            too_long.sendall(struct.pack(msg_len_format, max_hello_len + 1))
+            clients = []
+
+            def connect():
+                clients.append(control_client(coord.addr(), coord.key, "ctlhost0"))
+
+            t = threading.Thread(target=connect)
+            t.start()
+
+            def only_stalled_left():
+                return len(coord.hosts) == 1 and len(coord.hello_deadlines) == 1
+
+            self.assertTrue(coord.wait_for(only_stalled_left, 5, bool))
+            t.join()
+            self.assertTrue(clients[0].params.host_set == ["ctlhost0"])
+            self.assertTrue(too_long.recv(1) == b"")
+            coord.wait_for(lambda: not coord.hello_deadlines, 5, bool)
+            self.assertTrue(coord.hello_deadlines == {})
+            self.assertTrue(stalled.recv(1) == b"")
+            self.assertTrue(list(coord.hosts.keys()) == ["ctlhost0"])
+            for c in [stalled, too_long, clients[0]]:
+                c.close()
+        finally:
+            coord.close()
+
+    # hosts in the host set can reach the address the test driver listens on
+
+    def test_reachable_control_host(self):
+        self.assertTrue(is_loopback("127.0.0.1") and is_loopback("localhost"))
+        self.assertTrue(not is_loopback("192.0.2.1"))
+        loopback_hosts = ["localhost", "127.0.0.1"]
+        self.assertTrue(
+            reachable_control_host("localhost", loopback_hosts, True) == "localhost"
+        )
+        self.assertTrue(
+            reachable_control_host("192.0.2.1", ["192.0.2.2"], True) == "192.0.2.1"
+        )
+        with self.assertRaises(SMFRunException):
+            reachable_control_host("localhost", ["192.0.2.2"], True)
+        addr = address_toward("192.0.2.2")
+        if addr is not None and not is_loopback(addr):
+            self.assertTrue(
+                reachable_control_host("localhost", ["192.0.2.2"], False) == addr
+            )
+
+
+if __name__ == "__main__":
+    unittest_module.main()
@@ -8,14 +8,58 @@ Licensed under the Apache License at http://www.apache.org/licenses/LICENSE-2.0
 See Appendix on this page for instructions pertaining to license.
 """
 
+import asyncio
+import concurrent.futures
 import multiprocessing
+import multiprocessing.connection
 import os
 import shutil
+import threading
 import time
 
 import smallfile
 from smallfile import SMFRunException, unittest_module
-from sync_files import touch
+from sync_files import ensure_deleted, touch
+
+# host-local starting gate shared by all worker processes on a host.
+# each worker thread reports that it reached the gate by releasing
+# the ready semaphore, the host process counts them, waits for the
+# test-wide starting gate, and then lets every thread go at once,
+# so threads neither create thread-ready files nor look for the gate
+
+
+class start_barrier:
+    def __init__(self):
+        self.ready = multiprocessing.Semaphore(0)
+        self.go = multiprocessing.Event()
+
+    # called by worker threads
+
+    def thread_ready(self):
+        self.ready.release()
+
+    def wait(self):
+        self.go.wait()
+
+    # called by host process, returns how many threads were ready
+    # before timeout seconds passed or abort_fn appeared
+
+    def await_threads(self, count, timeout, abort_fn):
+        deadline = time.monotonic() + timeout
+        ready = 0
+        while ready < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                break
+            if self.ready.acquire(timeout=min(remaining, 0.5)):
+                ready += 1
+            elif os.path.exists(abort_fn):
+                break
+        return ready
+
+    def release(self):
+        self.go.set()
+
 
 # this class launches multiple threads with SmallfileWorkload instances
 # we do this because we can use > 1 core this way, with python threading,
@@ -24,7 +68,7 @@ from sync_files import touch
 
 
 class subprocess(multiprocessing.Process):
-    def __init__(self, invocation):
+    def __init__(self, invocation, shared_buf_name=None, barrier=None):
         multiprocessing.Process.__init__(self)
         (conn1, conn2) = multiprocessing.Pipe(False)
         self.receiver = conn1  # master process receives test result data here
@@ -33,9 +77,30 @@ class subprocess(multiprocessing.Process):
         invocation.biggest_buf = None
         invocation.log = None
         self.invoke = invocation  # all workload generated by this object
+        self.invokes = [invocation]
+        self.results = []  # smallfile.thread_result for each of invokes
+        # name of shared memory containing biggest_buf, if any
+        self.shared_buf_name = shared_buf_name
+        self.barrier = barrier
+
+    # once the process has its own copy of the sending end,
+    # closing ours lets receiver see end-of-file if the process dies
+
+    def start(self):
+        multiprocessing.Process.start(self)
+        self.sender.close()
+
+    # wait for test result from process and for process to exit
+
+    def receive_results(self):
+        for _ in results_as_completed([self]):
+            pass
 
     def run(self):
         try:
+            if self.shared_buf_name:
+                self.invoke.attach_shared_buf(self.shared_buf_name)
+            self.invoke.start_barrier = self.barrier
             self.invoke.do_workload()
             self.invoke.log.debug(
                 "exiting subprocess and returning invoke " + str(self.invoke)
@@ -46,18 +111,237 @@ class subprocess(multiprocessing.Process):
                 % (self.invoke.tid, self.invoke.onhost, self.invoke.log_fn())
             )
             self.invoke.log.error(str(e))
-            self.status = self.invoke.NOTOK
+            self.invoke.status = self.invoke.NOTOK
+        finally:
+            self.invoke.rsptimes.close()  # already saved to file
+            self.invoke.read_buf = None
+            self.invoke.write_buf = None
+            self.invoke.detach_shared_buf()
+            self.sender.send(smallfile.thread_result(self.invoke))
+
+
+# this class runs several SmallfileWorkload instances in one process,
+# so that more clients can be emulated per host than there can be processes,
+# and so that they share one mapping of biggest_buf and one set of loggers.
+# each instance keeps its own tid, directories, counters and response times,
+# and each one's result goes back through the pipe as soon as it is done.
+# subclasses define run_workers() to decide how the instances are run
+
+
+class multi_worker_subprocess(multiprocessing.Process):
+    def __init__(self, invocations, shared_buf_name=None, barrier=None):
+        multiprocessing.Process.__init__(self)
+        (conn1, conn2) = multiprocessing.Pipe(False)
+        self.receiver = conn1  # master process receives test result data here
+        self.sender = conn2  # slave process sends test result data here
+        for invk in invocations:
+            invk.buf = None
+            invk.biggest_buf = None
+            invk.log = None
+        self.invokes = invocations
+        self.results = []  # smallfile.thread_result for each of invokes
+        self.shared_buf_name = shared_buf_name
+        self.barrier = barrier
+
+    def start(self):
+        multiprocessing.Process.start(self)
+        self.sender.close()
+
+    def receive_results(self):
+        for _ in results_as_completed([self]):
+            pass
+
+    # each instance's result is sent as soon as it is done,
+    # instead of all of them when the slowest one is done
+
+    def send_result(self, invk):
+        with self.send_lock:
+            if invk.tid not in self.sent:
+                self.sent.add(invk.tid)
+                self.sender.send(smallfile.thread_result(invk))
+
+    def run(self):
+        self.send_lock = threading.Lock()
+        self.sent = set()
+        try:
+            # all instances share one mapping of the shared biggest_buf
+            if self.shared_buf_name:
+                first = self.invokes[0]
+                first.attach_shared_buf(self.shared_buf_name)
+                for invk in self.invokes[1:]:
+                    invk.shared_buf = first.shared_buf
+                    invk.biggest_buf = first.biggest_buf
+                    invk.stonewall_flag = first.stonewall_flag
+            for invk in self.invokes:
+                invk.start_barrier = self.barrier
+            self.run_workers()
         finally:
-            self.rsptimes = None  # response time array already saved to file
-            # reduce amount of data returned from this thread
-            # by eliminating references objects that are no longer needed
-            self.invoke.log = None  # log objects cannot be serialized
-            self.invoke.buf = None
-            self.invoke.biggest_buf = None
-            self.invoke.rsptimes = None
-            self.invoke.loggers = None
-            self.invoke.file_dirs = None
-            self.sender.send(self.invoke)
+            # views of shared memory must be gone before it is closed
+            for invk in self.invokes:
+                invk.rsptimes.close()  # already saved to file
+                invk.buf = None
+                invk.biggest_buf = None
+                invk.stonewall_flag = None
+                invk.read_buf = None
+                invk.write_buf = None
+            for invk in self.invokes:
+                invk.detach_shared_buf()
+            # instances that never got to run still report their status
+            for invk in self.invokes:
+                self.send_result(invk)
+
+    def report_exception(self, invk, e):
+        print(
+            "Exception seen in thread %s host %s (tail %s) "
+            % (invk.tid, invk.onhost, invk.log_fn())
+        )
+        if invk.log:
+            invk.log.error(str(e))
+        invk.status = invk.NOTOK
+
+
+# this class runs each SmallfileWorkload instance as a python thread,
+# which is enough when the workload is I/O-bound,
+# and lets threads use more than one core on free-threaded python builds
+
+
+class thread_subprocess(multi_worker_subprocess):
+    def run_workers(self):
+        thread_list = [
+            threading.Thread(target=self.run_worker, args=(invk,), name=invk.tid)
+            for invk in self.invokes
+        ]
+        for t in thread_list:
+            t.start()
+        for t in thread_list:
+            t.join()
+
+    def run_worker(self, invk):
+        try:
+            invk.do_workload()
+        except Exception as e:
+            self.report_exception(invk, e)
+        self.send_result(invk)
+
+
+# this class runs each SmallfileWorkload instance as a coroutine.
+# blocking filesystem calls are done by a pool of executor_threads threads
+# shared by all of them.
+# operations not in SmallfileWorkload.file_op_names are run
+# whole in an executor thread
+
+
+class asyncio_subprocess(multi_worker_subprocess):
+    def __init__(
+        self, invocations, shared_buf_name=None, executor_threads=32, barrier=None
+    ):
+        multi_worker_subprocess.__init__(self, invocations, shared_buf_name, barrier)
+        self.executor_threads = executor_threads
+
+    def run_workers(self):
+        asyncio.run(self.run_workers_async())
+
+    async def run_workers_async(self):
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.executor_threads
+        ) as executor:
+            # get every instance to the starting gate
+            ready = []
+            prepared = await asyncio.gather(
+                *[
+                    loop.run_in_executor(executor, invk.prepare_workload)
+                    for invk in self.invokes
+                ],
+                return_exceptions=True,
+            )
+            for (invk, result) in zip(self.invokes, prepared):
+                if isinstance(result, Exception):
+                    self.report_exception(invk, result)
+                else:
+                    ready.append(invk)
+            if not ready:
+                return
+
+            # one coroutine waits at the starting gate for all of them
+
+            try:
+                if self.barrier is not None:
+                    for _ in ready:
+                        self.barrier.thread_ready()
+                    await loop.run_in_executor(executor, self.barrier.wait)
+                elif ready[0].starting_gate:
+                    for invk in ready:
+                        touch(invk.gen_thread_ready_fname(invk.tid))
+                    await self.wait_for_gate(ready[0])
+            except Exception as e:
+                for invk in ready:
+                    self.report_exception(invk, e)
+                return
+
+            await asyncio.gather(
+                *[self.run_and_finish_worker(invk, executor) for invk in ready]
+            )
+
+    async def run_and_finish_worker(self, invk, executor):
+        loop = asyncio.get_running_loop()
+        await self.run_worker(invk, executor)
+        await loop.run_in_executor(executor, invk.finish_workload)
+        self.send_result(invk)
+
+    async def wait_for_gate(self, invk):
+        delay_time = invk.gate_poll_delay(0.1)
+        while delay_time is not None:
+            await asyncio.sleep(delay_time)
+            delay_time = invk.gate_poll_delay(delay_time)
+        synch_time = invk.gate_synch_time()
+        if synch_time > 0.0:
+            await asyncio.sleep(synch_time)
+
+    async def run_worker(self, invk, executor):
+        loop = asyncio.get_running_loop()
+        invk.start_time = time.time()
+        try:
+            func = smallfile.SmallfileWorkload.workloads[invk.opname]
+            if invk.opname in invk.file_op_names:
+                invk.async_executor = executor
+                await func(invk)
+            else:
+                await loop.run_in_executor(executor, func, invk)
+        except invk.workload_exceptions as e:
+            invk.workload_exception(e)
+        except Exception as e:
+            self.report_exception(invk, e)
+        finally:
+            invk.async_executor = None
+
+
+# yield each thread's smallfile.thread_result as soon as it arrives
+# from any of the worker processes in thread_list,
+# and wait for each process to exit once all its threads have reported.
+# if a process dies, results already received from it are kept
+
+
+def results_as_completed(thread_list):
+    waiting = {t.receiver: t for t in thread_list if len(t.results) < len(t.invokes)}
+    while waiting:
+        for conn in multiprocessing.connection.wait(list(waiting.keys())):
+            t = waiting[conn]
+            try:
+                rslt = conn.recv()
+            except EOFError:
+                print(
+                    "worker process %d exited without results for %d threads"
+                    % (t.pid, len(t.invokes) - len(t.results))
+                )
+                del waiting[conn]
+                t.join()
+                continue
+            t.results.append(rslt)
+            if len(t.results) == len(t.invokes):
+                del waiting[conn]
+                t.join()
+            yield rslt
 
 
 # below are unit tests for SmallfileWorkload
@@ -131,12 +415,208 @@ class Test(unittest_module.TestCase):
             assert rtnd_invok.elapsed_time is not None
             assert rtnd_invok.rq_final is not None
             assert rtnd_invok.filenum_final is not None
-            if rtnd_invok.status != rtnd_invok.OK:
+            if rtnd_invok.status != smallfile.OK:
                 raise SMFRunException(
                     "subprocess failure for %s invocation %s: "
                     % (str(t), str(rtnd_invok))
                 )
 
+    # threads attached to a shared biggest_buf must be able to verify
+    # data written by threads attached to an earlier shared biggest_buf
+
+    def test_multiproc_shared_buf(self):
+        if not smallfile.shared_memory_installed:
+            return
+        for opname in ["create", "read"]:
+            self.invok.opname = opname
+            self.invok.incompressible = True
+            shared_buf = self.invok.create_shared_buf()
+            try:
+                threadList = []
+                for j in range(0, 2):
+                    s = smallfile.SmallfileWorkload()
+                    s.tid = str(j)
+                    s.opname = opname
+                    s.incompressible = True
+                    s.verify_read = True
+                    s.finish_all_rq = True
+                    s.stonewall = False
+                    s.iterations = 20
+                    threadList.append(subprocess(s, shared_buf.name))
+                for t in threadList:
+                    t.start()
+                for t in threadList:
+                    rtnd_invok = t.receiver.recv()
+                    t.join()
+                    assert rtnd_invok.status == smallfile.OK
+                    assert rtnd_invok.filenum_final == 20
+            finally:
+                shared_buf.close()
+                shared_buf.unlink()
+
+    # the stonewall file is seen by the per-host watcher,
+    # and worker threads see it through the flag in shared memory
+
+    def test_stonewall_flag(self):
+        if not smallfile.shared_memory_installed:
+            return
+        import multi_thread_workload
+
+        stonewall_path = self.invok.stonewall_fn()
+        ensure_deleted(stonewall_path)
+        shared_buf = self.invok.create_shared_buf()
+        s = smallfile.SmallfileWorkload()
+        watcher = multi_thread_workload.stonewall_watcher(self.invok, shared_buf)
+        watcher.start()
+        try:
+            s.attach_shared_buf(shared_buf.name)
+            time.sleep(3 * s.stonewall_check_interval)
+            assert not s.stonewall_seen()
+            touch(stonewall_path)
+            watcher.join(timeout=10)
+            assert not watcher.is_alive()
+            assert s.stonewall_seen()
+        finally:
+            watcher.stop()
+            s.detach_shared_buf()
+            shared_buf.close()
+            shared_buf.unlink()
+            ensure_deleted(stonewall_path)
+
+    # threads in different processes wait at the host's start barrier
+    # until the host process releases them
+
+    def test_start_barrier(self):
+        barrier = start_barrier()
+        invokes = []
+        for j in range(0, 3):
+            s = smallfile.SmallfileWorkload()
+            s.tid = "barrier%d" % j
+            s.iterations = 5
+            s.stonewall = False
+            s.finish_all_rq = True
+            invokes.append(s)
+        threadList = [subprocess(invokes[0], barrier=barrier)]
+        threadList.append(thread_subprocess(invokes[1:], barrier=barrier))
+        for t in threadList:
+            t.start()
+        abort_fn = self.invok.abort_fn()
+        assert barrier.await_threads(3, 10, abort_fn) == 3
+        time.sleep(0.2)
+        assert not barrier.go.is_set()
+        released = time.time()
+        barrier.release()
+        for t in threadList:
+            t.receive_results()
+            for rtnd_invok in t.results:
+                assert rtnd_invok.status == smallfile.OK
+                assert rtnd_invok.filenum_final == 5
+                assert rtnd_invok.start_time >= released
+
+    # many workers in one process must produce same files and results
+    # as one process per worker
+
+    def test_asyncio_workers(self):
+        worker_count = 20
+        for opname in ["create", "read", "stat", "cleanup"]:
+            invokeList = []
+            for j in range(0, worker_count):
+                s = smallfile.SmallfileWorkload()
+                s.tid = "%02d" % j
+                s.opname = opname
+                s.prefix = "async_"
+                s.verify_read = True
+                s.finish_all_rq = True
+                s.stonewall = False
+                s.iterations = 30
+                s.iodepth = 2 if opname == "read" else 1
+                invokeList.append(s)
+            t = asyncio_subprocess(invokeList, executor_threads=4)
+            t.start()
+            t.receive_results()
+            assert len(t.results) == worker_count
+            for rtnd_invok in t.results:
+                assert rtnd_invok.status == smallfile.OK
+                assert rtnd_invok.filenum_final == 30
+                assert rtnd_invok.elapsed_time is not None
+                if opname in ["create", "read"]:
+                    assert rtnd_invok.rq_final == 30
+
+    # threads sharing a process must each keep their own random file sizes,
+    # or reads with verification fail
+
+    def test_threads_per_proc(self):
+        import multi_thread_workload
+        import smf_test_params
+
+        prm = smf_test_params.smf_test_params(thread_count=6)
+        prm.procs = 2
+        inv = prm.master_invoke
+        inv.tid = "regtest"
+        inv.prefix = "thrproc_"
+        inv.iterations = 30
+        inv.total_sz_kb = 8
+        inv.filesize_distr = inv.fsdistr_random_exponential
+        inv.verify_read = True
+        inv.finish_all_rq = True
+        inv.stonewall = False
+        for opname in ["create", "read"]:
+            inv.opname = opname
+            thread_list = multi_thread_workload.create_worker_list(prm)
+            assert len(thread_list) == 2
+            for t in thread_list:
+                assert isinstance(t, thread_subprocess)
+                t.start()
+            for t in thread_list:
+                t.receive_results()
+                assert len(t.results) == 3
+                for rtnd_invok in t.results:
+                    assert rtnd_invok.status == smallfile.OK
+                    assert rtnd_invok.filenum_final == 30
+
+    # --procs P starts exactly P worker processes,
+    # even if --threads is not a multiple of P
+
+    def test_procs_count(self):
+        import multi_thread_workload
+        import smf_test_params
+
+        for (threads, procs, counts) in [
+            (6, 4, [2, 2, 1, 1]),
+            (5, 4, [2, 1, 1, 1]),
+            (8, 4, [2, 2, 2, 2]),
+        ]:
+            prm = smf_test_params.smf_test_params(thread_count=threads)
+            prm.procs = procs
+            assert prm.get_proc_thread_counts() == counts
+            inv = prm.master_invoke
+            inv.tid = "regtest"
+            inv.prefix = "procs_"
+            inv.iterations = 10
+            inv.opname = "create"
+            inv.finish_all_rq = True
+            inv.stonewall = False
+            thread_list = multi_thread_workload.create_worker_list(prm)
+            for t in thread_list:
+                t.start()
+            pids = set([t.pid for t in thread_list])
+            results = []
+            for t in thread_list:
+                t.receive_results()
+                results.extend(t.results)
+                t.join()
+            assert len(pids) == procs
+            assert len(results) == threads
+            tids = sorted([r.tid for r in results])
+            assert tids == ["%02d" % k for k in range(0, threads)]
+            for r in results:
+                assert r.status == smallfile.OK
+            inv.opname = "cleanup"
+            for t in multi_thread_workload.create_worker_list(prm):
+                t.start()
+                t.receive_results()
+                t.join()
+
 
 # so you can just do "python invoke_process.py" to test it
 
@@ -3,8 +3,10 @@ import copy
 import os
 import random
 import sys
+import threading
 import time
 
+import control_plane
 import invoke_process
 import output_results
 import smallfile
@@ -18,14 +20,22 @@ from sync_files import (
 )
 
 
-def create_worker_list(prm):
-    # for each thread set up SmallfileWorkload instance,
-    # create a thread instance, and delete the thread-ready file
+def create_worker_list(prm, shared_buf=None, barrier=None):
+    # for each thread set up SmallfileWorkload instance
+    # and create a thread instance
+    # if biggest_buf is in shared memory, threads attach to it by name
+    # threads are grouped into worker processes by prm.get_proc_thread_counts()
+    # if there is a start_barrier, threads wait there instead of
+    # creating thread-ready files and looking for the starting gate file
 
-    thread_list = []
+    shared_buf_name = shared_buf.name if shared_buf else None
+
+    invoke_list = []
     for k in range(0, prm.thread_count):
         nextinv = copy.copy(prm.master_invoke)
         nextinv.tid = "%02d" % k
+        # threads in the same process must not share a random number generator
+        nextinv.randstate = random.Random()
         if not prm.master_invoke.is_shared_dir:
             nextinv.src_dirs = [
                 d + os.sep + prm.master_invoke.onhost + os.sep + "thrd_" + nextinv.tid
@@ -35,16 +45,120 @@ def create_worker_list(prm):
                 d + os.sep + prm.master_invoke.onhost + os.sep + "thrd_" + nextinv.tid
                 for d in nextinv.dest_dirs
             ]
-        t = invoke_process.subprocess(nextinv)
-        thread_list.append(t)
-        ensure_deleted(nextinv.gen_thread_ready_fname(nextinv.tid))
-    return thread_list
+        invoke_list.append(nextinv)
+        if barrier is None:
+            ensure_deleted(nextinv.gen_thread_ready_fname(nextinv.tid))
+    groups = []
+    for count in prm.get_proc_thread_counts():
+        start = sum([len(g) for g in groups])
+        groups.append(invoke_list[start : start + count])
+    if prm.worker_engine == prm.worker_engine_asyncio:
+        return [
+            invoke_process.asyncio_subprocess(
+                g, shared_buf_name, prm.executor_threads, barrier
+            )
+            for g in groups
+        ]
+    if len(groups) == len(invoke_list):
+        return [
+            invoke_process.subprocess(ivk, shared_buf_name, barrier)
+            for ivk in invoke_list
+        ]
+    return [
+        invoke_process.thread_subprocess(g, shared_buf_name, barrier) for g in groups
+    ]
+
+
+# one thread per host looks for the stonewall file on behalf of
+# all worker threads on the host, and tells them through the flag byte
+# in shared memory, so the shared network directory sees one lookup
+# per host every stonewall_check_interval, instead of one per thread.
+# when a thread on this host finishes first and sets the flag,
+# the watcher creates the stonewall file for the other hosts
+
+
+class stonewall_watcher(threading.Thread):
+    def __init__(self, invk, shared_buf):
+        threading.Thread.__init__(self, name="stonewall-watcher", daemon=True)
+        self.stonewall_path = invk.stonewall_fn()
+        self.interval = invk.stonewall_check_interval
+        self.flag = None
+        if shared_buf:
+            self.flag = invk.stonewall_flag_view(shared_buf)
+        # other hosts know about the stonewall
+        self.published = False
+        self.stopped = threading.Event()
+
+    def publish(self):
+        self.published = True
+        try:
+            touch(self.stonewall_path)
+        except OSError as e:
+            print("unable to write stonewall file: %s" % str(e))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.flag[0]:
+                self.publish()
+                break
+            if os.path.exists(self.stonewall_path):
+                self.published = True
+                self.flag[0] = 1
+                break
+
+    # if threads on this host finished before the watcher looked,
+    # other hosts have not been told yet.
+    # the view must be released before the shared memory can be closed
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.flag is not None:
+            if self.flag[0] and not self.published:
+                self.publish()
+            self.flag.release()
+
+
+# with a control connection to the test driver, stonewall goes both ways
+# over it instead of through the stonewall file,
+# and the test driver can abort the test on this host
+
+
+class control_watcher(stonewall_watcher):
+    def __init__(self, invk, shared_buf, control, thread_list):
+        stonewall_watcher.__init__(self, invk, shared_buf)
+        self.control = control
+        self.thread_list = thread_list
+        self.abort_fname = invk.abort_fn()
+
+    def publish(self):
+        self.published = True
+        self.control.send(control_plane.msg_stonewall)
+
+    def run(self):
+        while not self.stopped.is_set():
+            msg = self.control.poll(self.interval)
+            if self.flag is not None and self.flag[0] and not self.published:
+                self.publish()
+            if msg is None:
+                continue
+            (kind, payload) = msg
+            if kind == control_plane.msg_stonewall and self.flag is not None:
+                self.published = True
+                self.flag[0] = 1
+            elif kind == control_plane.msg_abort:
+                print("test driver aborted test: %s" % payload)
+                abort_test(self.abort_fname, self.thread_list)
+                break
 
 
 # what follows is code that gets done on each host
 
 
-def run_multi_thread_workload(prm):
+def run_multi_thread_workload(prm, control=None):
+    # with a control connection, the test driver is reached through it
+    # instead of through files in the shared network directory
+
     master_invoke = prm.master_invoke
     prm_slave = prm.is_slave
     verbose = master_invoke.verbose
@@ -54,7 +168,8 @@ def run_multi_thread_workload(prm):
         master_invoke.create_top_dirs(False)
 
     if prm_slave:
-        time.sleep(1.1)
+        if control is None:
+            time.sleep(1.1)
         for d in master_invoke.top_dirs:
             ensure_dir_exists(d)
         for dlist in [master_invoke.src_dirs, master_invoke.dest_dirs]:
@@ -63,136 +178,170 @@ def run_multi_thread_workload(prm):
                 if verbose:
                     print(host + " saw " + str(d))
 
-    # for each thread set up SmallfileWorkload instance,
-    # create a thread instance, and delete the thread-ready file
-
-    thread_list = create_worker_list(prm)
-    my_host_invoke = thread_list[0].invoke
-
-    # start threads, wait for them to reach starting gate
-    # to do this, look for thread-ready files
-
-    for t in thread_list:
-        ensure_deleted(t.invoke.gen_thread_ready_fname(t.invoke.tid))
-    for t in thread_list:
-        t.start()
-    if verbose:
-        print("started %d worker threads on host %s" % (len(thread_list), host))
-
-    # wait for all threads to reach the starting gate
-    # this makes it more likely that they will start simultaneously
-
-    startup_timeout = prm.startup_timeout
-    if smallfile.is_windows_os:
-        print("adding time for Windows synchronization")
-        startup_timeout += 30
-    abort_fname = my_host_invoke.abort_fn()
-    thread_count = len(thread_list)
-    thread_to_wait_for = 0
-    for sec in range(0, startup_timeout * 2):
-        for k in range(thread_to_wait_for, thread_count):
-            t = thread_list[k]
-            fn = t.invoke.gen_thread_ready_fname(t.invoke.tid)
-            if not os.path.exists(fn):
-                if verbose:
-                    print("thread %d thread-ready file %s not found..." % (k, fn))
-                break
-            thread_to_wait_for = k + 1
-        if thread_to_wait_for == thread_count:
-            break
-        if os.path.exists(abort_fname):
-            break
-        time.sleep(0.5)
-
-    # if all threads didn't make it to the starting gate
-
-    if thread_to_wait_for < thread_count:
-        abort_test(abort_fname, thread_list)
-        raise SMFRunException(
-            "only %d threads reached starting gate within %d sec"
-            % (thread_to_wait_for, startup_timeout)
+    # build data buffer once for all threads on this host
+
+    shared_buf = master_invoke.create_shared_buf()
+    watcher = None
+    try:
+        # for each thread set up SmallfileWorkload instance
+        # and create a thread instance
+
+        barrier = invoke_process.start_barrier()
+        thread_list = create_worker_list(prm, shared_buf, barrier)
+        invoke_list = [ivk for t in thread_list for ivk in t.invokes]
+        my_host_invoke = invoke_list[0]
+
+        # start threads, wait for them to reach starting gate
+
+        for t in thread_list:
+            t.start()
+        if verbose:
+            print("started %d worker threads on host %s" % (len(invoke_list), host))
+        if control is None and shared_buf and master_invoke.stonewall:
+            watcher = stonewall_watcher(master_invoke, shared_buf)
+            watcher.start()
+
+        # wait for all threads to reach the starting gate
+        # this makes it more likely that they will start simultaneously
+
+        startup_timeout = prm.startup_timeout
+        if smallfile.is_windows_os:
+            print("adding time for Windows synchronization")
+            startup_timeout += 30
+        abort_fname = my_host_invoke.abort_fn()
+        thread_count = len(invoke_list)
+        threads_ready = barrier.await_threads(
+            thread_count, startup_timeout, abort_fname
         )
 
-    # declare that this host is at the starting gate
+        # if all threads didn't make it to the starting gate
 
-    if prm_slave:
-        host_ready_fn = my_host_invoke.gen_host_ready_fname()
-        if my_host_invoke.verbose:
-            print(
-                "host %s creating ready file %s"
-                % (my_host_invoke.onhost, host_ready_fn)
+        if threads_ready < thread_count:
+            abort_test(abort_fname, thread_list)
+            msg = "only %d threads reached starting gate within %d sec" % (
+                threads_ready,
+                startup_timeout,
             )
-        touch(host_ready_fn)
+            if control:
+                control.send(control_plane.msg_abort, msg)
+            raise SMFRunException(msg)
+
+        if control:
+            # tell test driver we are ready, and let all threads go
+            # as soon as it says so, which it does for all hosts at once
+
+            control.send(control_plane.msg_ready)
+            try:
+                control.wait_for_start(prm.host_startup_timeout + 10)
+            except SMFRunException:
+                abort_test(abort_fname, thread_list)
+                raise
+            watcher = control_watcher(master_invoke, shared_buf, control, thread_list)
+            watcher.start()
+            barrier.release()
+        else:
+            # declare that this host is at the starting gate
+
+            if prm_slave:
+                host_ready_fn = my_host_invoke.gen_host_ready_fname()
+                if my_host_invoke.verbose:
+                    print(
+                        "host %s creating ready file %s"
+                        % (my_host_invoke.onhost, host_ready_fn)
+                    )
+                touch(host_ready_fn)
+
+            sg = my_host_invoke.starting_gate
+            if not prm_slave:  # special case of no --host-set parameter
+                try:
+                    write_sync_file(sg, "hi there")
+                    if verbose:
+                        print("wrote starting gate file")
+                except IOError as e:
+                    print("error writing starting gate for threads: %s" % str(e))
+                prm.test_start_time = time.time()
+
+            # wait for starting_gate file to be created by test driver
+            # every second we resume scan from last host file not found
 
-    sg = my_host_invoke.starting_gate
-    if not prm_slave:  # special case of no --host-set parameter
-        try:
-            write_sync_file(sg, "hi there")
             if verbose:
-                print("wrote starting gate file")
-        except IOError as e:
-            print("error writing starting gate for threads: %s" % str(e))
-        prm.test_start_time = time.time()
+                print("awaiting " + sg)
+            if prm_slave:
+                for sec in range(0, prm.host_startup_timeout + 10):
+                    # hack to ensure that directory is up to date
+                    #   ndlist = os.listdir(my_host_invoke.network_dir)
+                    # if verbose: print(str(ndlist))
+                    if os.path.exists(sg):
+                        break
+                    time.sleep(0.5)
+                if not os.path.exists(sg):
+                    abort_test(my_host_invoke.abort_fn(), thread_list)
+                    raise SMFRunException(
+                        "starting signal not seen within %d seconds"
+                        % prm.host_startup_timeout
+                    )
 
-    # wait for starting_gate file to be created by test driver
-    # every second we resume scan from last host file not found
+            # let all threads on this host go at the same time,
+            # 3 seconds after the starting gate was created,
+            # so that other hosts have time to see it and start with us
 
-    if verbose:
-        print("awaiting " + sg)
-    if prm_slave:
-        for sec in range(0, prm.host_startup_timeout + 10):
-            # hack to ensure that directory is up to date
-            #   ndlist = os.listdir(my_host_invoke.network_dir)
-            # if verbose: print(str(ndlist))
-            if os.path.exists(sg):
-                break
-            time.sleep(0.5)
-        if not os.path.exists(sg):
-            abort_test(my_host_invoke.abort_fn(), thread_list)
-            raise SMFRunException(
-                "starting signal not seen within %d seconds" % prm.host_startup_timeout
-            )
-    if verbose:
-        print("starting test on host " + host + " in 2 seconds")
-    time.sleep(2 + random.random())  # let other hosts see starting gate file
+            synch_time = os.stat(sg).st_mtime + 3.0 - time.time()
+            if verbose:
+                print("starting test on host %s in %f seconds" % (host, synch_time))
+            if synch_time > 0.0:
+                time.sleep(synch_time)
+            else:
+                print("WARNING: other hosts may have already started")
+            barrier.release()
 
-    # FIXME: don't timeout the test,
-    # instead check thread progress and abort if you see any of them stalled
-    # but if servers are heavily loaded you can't rely on filesystem
+        # FIXME: don't timeout the test,
+        # instead check thread progress and abort if you see any of them stalled
+        # but if servers are heavily loaded you can't rely on filesystem
 
-    # wait for all threads on this host to finish
+        # wait for all threads on this host to finish,
+        # with a test driver connection, pass each thread's result on to it
+        # as soon as the thread is done, so that if this host fails later
+        # the test driver still has results of threads that finished
 
-    for t in thread_list:
         if verbose:
-            print("waiting for thread %s" % t.invoke.tid)
-        t.invoke = t.receiver.recv()  # to get results from sub-process
-        t.join()
+            print("waiting for %d threads" % len(invoke_list))
+        result_list = []
+        for rslt in invoke_process.results_as_completed(thread_list):
+            result_list.append(rslt)
+            if control:
+                control.send(control_plane.msg_result, rslt)
+    finally:
+        if watcher:
+            watcher.stop()
+        if shared_buf:
+            shared_buf.close()
+            shared_buf.unlink()
 
     # if not a slave of some other host, print results (for this host)
 
     exit_status = OK
     if not prm_slave:
         try:
-            invoke_list = [t.invoke for t in thread_list]
-            output_results.output_results(invoke_list, prm)
+            output_results.output_results(result_list, prm)
         except SMFResultException as e:
             print("ERROR: " + str(e))
             exit_status = NOTOK
+    elif control:
+        # tell test driver that this host has no more results
+
+        if verbose:
+            print("sent %d results to test driver" % len(result_list))
+        control.send(control_plane.msg_results_done, len(result_list))
+        control.close()
     else:
         # if we are participating in a multi-host test
-        # then write out this host's result in pickle format
+        # then write out this host's results in pickle format
         # so test driver can pick up result
 
         result_filename = master_invoke.host_result_filename(prm.as_host)
-        if verbose:
-            print("writing invokes to: " + result_filename)
-        invok_list = [t.invoke for t in thread_list]
         if verbose:
             print("saving result to filename %s" % result_filename)
-        for ivk in invok_list:
-            ivk.buf = None
-            ivk.biggest_buf = None
-        write_pickle(result_filename, invok_list)
+        write_pickle(result_filename, result_list)
         time.sleep(1.2)  # for benefit of NFS with actimeo=1
 
     sys.exit(exit_status)
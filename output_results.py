@@ -11,6 +11,30 @@ from smallfile import KB_PER_GB, OK, SMFResultException
 BYTES_PER_KiB = 1024.0
 KiB_PER_MiB = 1024.0
 
+# percentiles of each operation's latency histogram in JSON output,
+# keys have no dots in them so that elasticsearch can index them
+
+latency_percentiles = [
+    ("p50Usec", 50.0),
+    ("p90Usec", 90.0),
+    ("p99Usec", 99.0),
+    ("p999Usec", 99.9),
+]
+
+
+# list of (key, microseconds) summarizing a latency histogram
+
+
+def latency_summary(h):
+    summary = [
+        ("minUsec", h.min * 1000000.0),
+        ("meanUsec", h.total * 1000000.0 / h.count),
+    ]
+    for (key, pct) in latency_percentiles:
+        summary.append((key, h.percentile(pct) * 1000000.0))
+    summary.append(("maxUsec", h.max * 1000000.0))
+    return summary
+
 
 class result_stats:
     # start with zeroing because we'll add
@@ -24,6 +48,19 @@ class result_stats:
         self.files_per_sec = 0.0
         self.IOPS = 0.0
         self.MiBps = 0.0
+        self.dir_fd_hits = 0
+        self.dir_fd_misses = 0
+        self.dir_fd_evictions = 0
+        self.histograms = {}  # operation name -> smallfile.latency_histogram
+
+    # merge latency histogram of an operation into this object's
+
+    def add_histogram(self, opname, histogram):
+        try:
+            self.histograms[opname].merge(histogram)
+        except KeyError:
+            self.histograms[opname] = h = smallfile.latency_histogram()
+            h.merge(histogram)
 
     def get_from_invoke(self, invk, record_sz_kb):
         if invk.elapsed_time is None:
@@ -37,6 +74,11 @@ class result_stats:
         )
         self.files = invk.filenum_final if invk.filenum_final is not None else 0
         self.records = invk.rq_final if invk.rq_final is not None else 0
+        self.dir_fd_hits = invk.dir_fd_hits
+        self.dir_fd_misses = invk.dir_fd_misses
+        self.dir_fd_evictions = invk.dir_fd_evictions
+        for (opname, h) in (invk.histograms or {}).items():
+            self.add_histogram(opname, h)
         if invk.elapsed_time is not None and invk.elapsed_time > 0.0:
             self.files_per_sec = invk.filenum_final / invk.elapsed_time
             if invk.rq_final > 0:
@@ -55,6 +97,11 @@ class result_stats:
         self.elapsed = max(self.elapsed, component.elapsed)
         self.files += component.files
         self.records += component.records
+        self.dir_fd_hits += component.dir_fd_hits
+        self.dir_fd_misses += component.dir_fd_misses
+        self.dir_fd_evictions += component.dir_fd_evictions
+        for (opname, h) in component.histograms.items():
+            self.add_histogram(opname, h)
         if component.elapsed > 0.0:
             self.files_per_sec += component.files_per_sec
             try:
@@ -75,29 +122,61 @@ class result_stats:
         if self.records > 0:
             target["IOPS"] = self.IOPS
             target["MiBps"] = self.MiBps
+        if self.dir_fd_misses > 0:
+            target["dirFdHits"] = self.dir_fd_hits
+            target["dirFdMisses"] = self.dir_fd_misses
+            target["dirFdEvictions"] = self.dir_fd_evictions
+        if self.histograms:
+            target["latency"] = latency = {}
+            for (opname, h) in sorted(self.histograms.items()):
+                latency[opname] = op_latency = {"samples": h.count}
+                op_latency.update(latency_summary(h))
+
+
+# directories created before the starting gate, or removed by cleanup,
+# are timed separately from the files,
+# threads do this at the same time so elapsed time is the longest one
+
+
+def output_dir_phase(invoke_list, rslt, verb, count_field, time_field):
+    elapsed_times = [getattr(invk, time_field) for invk in invoke_list]
+    elapsed_times = [t for t in elapsed_times if t]
+    if not elapsed_times:
+        return
+    dir_count = sum([getattr(invk, count_field) for invk in invoke_list])
+    elapsed = max(elapsed_times)
+    print(
+        "directories %s = %d in %9.3f sec = %f dirs/sec"
+        % (verb, dir_count, elapsed, dir_count / elapsed)
+    )
+    key = verb.capitalize()
+    rslt["dirs" + key] = dir_count
+    rslt["dirs" + key + "Elapsed"] = elapsed
+    rslt["dirs" + key + "PerSec"] = dir_count / elapsed
 
 
 def output_results(invoke_list, test_params):
     if len(invoke_list) < 1:
-        raise SMFResultException("no pickled invokes read, so no results")
+        raise SMFResultException("no thread results received, so no results")
     my_host_invoke = invoke_list[0]  # pick a representative one
     rszkb = my_host_invoke.record_sz_kb
-    if rszkb == 0:
-        rszkb = my_host_invoke.total_sz_kb
-    if rszkb * my_host_invoke.BYTES_PER_KB > my_host_invoke.biggest_buf_size:
-        rszkb = my_host_invoke.biggest_buf_size / my_host_invoke.BYTES_PER_KB
 
     rslt = {}
     rslt["host"] = {}
     stats_by_host = {}
     cluster = stats_by_host["stats"] = result_stats()
 
-    for invk in invoke_list:  # for each parallel SmallfileWorkload
+    for invk in invoke_list:  # for each thread's smallfile.thread_result
         # add up work that it did
         # and determine time interval over which test ran
 
-        if not isinstance(invk, smallfile.SmallfileWorkload):
-            raise SMFResultException("invoke is of wrong type: %s" % str(invk))
+        if not isinstance(invk, smallfile.thread_result):
+            raise SMFResultException("result is of wrong type: %s" % str(invk))
+        if invk.result_version != smallfile.thread_result.version:
+            raise SMFResultException(
+                "result from host %s is version %s, expected %d"
+                % (invk.onhost, invk.result_version, smallfile.thread_result.version)
+            )
         if invk.status:
             status = "ERR: " + os.strerror(invk.status)
         else:
@@ -134,7 +213,7 @@ def output_results(invoke_list, test_params):
 
     # now counters are all added up, generate JSON
 
-    for invk in invoke_list:  # for each parallel SmallfileWorkload
+    for invk in invoke_list:  # for each thread's smallfile.thread_result
         per_host = stats_by_host[invk.onhost]
         try:
             per_host_json = rslt["host"][invk.onhost]
@@ -163,6 +242,19 @@ def output_results(invoke_list, test_params):
     rslt["totalhreads"] = len(invoke_list)
 
     print("total files = %d" % cluster.files)
+    if cluster.dir_fd_misses > 0:
+        print(
+            "directory fd cache: hits = %d, misses = %d, evictions = %d"
+            % (cluster.dir_fd_hits, cluster.dir_fd_misses, cluster.dir_fd_evictions)
+        )
+    for (opname, h) in sorted(cluster.histograms.items()):
+        usecs = " ".join(
+            ["%s %d" % (key[:-4], usec) for (key, usec) in latency_summary(h)]
+        )
+        print("%s latency usec: %s" % (opname, usecs))
+
+    output_dir_phase(invoke_list, rslt, "created", "dirs_created", "dir_create_time")
+    output_dir_phase(invoke_list, rslt, "removed", "dirs_removed", "dir_remove_time")
 
     if cluster.records > 0:
         print("total IOPS = %d" % cluster.IOPS)
@@ -186,6 +278,15 @@ def output_results(invoke_list, test_params):
     rslt["pctFilesDone"] = pct_files
 
     print("elapsed time = %9.3f" % cluster.elapsed)
+
+    # how far apart threads started, across all hosts,
+    # which depends on how well their clocks are synchronized
+
+    start_times = [invk.start_time for invk in invoke_list if invk.start_time]
+    if len(start_times) > 1:
+        start_skew = max(start_times) - min(start_times)
+        print("start skew = %9.6f sec" % start_skew)
+        rslt["startSkew"] = start_skew
     rslt["startTime"] = test_params.test_start_time
     rslt["status"] = os.strerror(cluster.status)
 
@@ -11,6 +11,7 @@ See Appendix on this page for instructions pertaining to license.
 import argparse
 import os
 
+import control_plane
 import smallfile
 import smf_test_params
 from parser_data_types import (
@@ -22,7 +23,7 @@ from parser_data_types import (
     non_negative_integer,
     positive_integer,
 )
-from smallfile import SmallfileWorkload
+from smallfile import SmallfileWorkload, SMFRunException
 
 yaml_parser_installed = False
 try:
@@ -59,6 +60,12 @@ def parse():
         default=inv.measure_rsptimes,
         help="if true then record response time of each file op",
     )
+    add(
+        "--response-times-format",
+        default=inv.rsptime_format,
+        choices=SmallfileWorkload.all_rsptime_formats,
+        help="save response times as binary .rsp file or as .csv file",
+    )
     add(
         "--network-sync-dir",
         help="if --top not shared filesystem, provide shared filesystem directory",
@@ -87,6 +94,17 @@ def parse():
         default=test_params.launch_by_daemon,
         help="use non-ssh launcher to get test running",
     )
+    add(
+        "--control-port",
+        type=non_negative_integer,
+        default=test_params.control_port,
+        help="TCP port for test driver to coordinate hosts on (0 = use shared files)",
+    )
+    add(
+        "--control-host",
+        default=test_params.control_host,
+        help="host name or address that remote hosts reach test driver at",
+    )
     add(
         "--files",
         type=positive_integer,
@@ -99,6 +117,30 @@ def parse():
         default=test_params.thread_count,
         help="threads per client",
     )
+    add(
+        "--worker-engine",
+        default=test_params.worker_engine,
+        choices=test_params.all_worker_engines,
+        help="run threads in each worker process as threads or as coroutines",
+    )
+    add(
+        "--procs",
+        type=non_negative_integer,
+        default=test_params.procs,
+        help="worker processes per client (0 = derive from threads per process)",
+    )
+    add(
+        "--threads-per-proc",
+        type=non_negative_integer,
+        default=test_params.threads_per_proc,
+        help="threads per worker process (0 = worker engine default)",
+    )
+    add(
+        "--executor-threads",
+        type=positive_integer,
+        default=test_params.executor_threads,
+        help="blocking filesystem calls in flight per process with asyncio worker engine",
+    )
     add(
         "--files-per-dir",
         type=positive_integer,
@@ -221,6 +263,48 @@ def parse():
         default=inv.incompressible,
         help="if true then non-compressible data written",
     )
+    add(
+        "--io-engine",
+        default=inv.io_engine,
+        choices=SmallfileWorkload.all_io_engines,
+        help="transfer one record per system call (sync) or several (vectored)",
+    )
+    add(
+        "--iov-count",
+        type=positive_integer,
+        default=inv.iov_count,
+        help="records per system call with vectored I/O engine",
+    )
+    add(
+        "--iodepth",
+        type=positive_integer,
+        default=inv.iodepth,
+        help="files in flight per thread for data operations",
+    )
+    add(
+        "--dir-threads",
+        type=positive_integer,
+        default=inv.dir_threads,
+        help="threads per worker used to create and remove directory trees",
+    )
+    add(
+        "--cleanup-scan",
+        type=boolean,
+        default=inv.cleanup_scan,
+        help="if true then cleanup lists each directory and removes only entries found",
+    )
+    add(
+        "--dir-fd-cache",
+        type=non_negative_integer,
+        default=inv.dir_fd_cache_size,
+        help="directory fds kept open per thread for per-file operations (0 = none)",
+    )
+    add(
+        "--direct-io",
+        type=boolean,
+        default=inv.direct_io,
+        help="if true then bypass page cache using O_DIRECT for file data",
+    )
 
     # these parameters shouldn't be used by mere mortals
     add(
@@ -250,8 +334,14 @@ def parse():
     inv.opname = args.operation
     test_params.top_dirs = [os.path.abspath(p) for p in args.top]
     test_params.launch_by_daemon = args.launch_by_daemon
+    test_params.control_port = args.control_port
+    test_params.control_host = args.control_host
     inv.iterations = args.files
     test_params.thread_count = inv.threads = args.threads
+    test_params.worker_engine = args.worker_engine
+    test_params.executor_threads = args.executor_threads
+    test_params.procs = args.procs
+    test_params.threads_per_proc = args.threads_per_proc
     inv.files_per_dir = args.files_per_dir
     inv.dirs_per_dir = args.dirs_per_dir
     inv.record_sz_kb = args.record_size
@@ -270,12 +360,20 @@ def parse():
     inv.stonewall = args.stonewall
     inv.finish_all_rq = args.finish
     inv.measure_rsptimes = args.response_times
+    inv.rsptime_format = args.response_times_format
     inv.fsync = args.fsync
     inv.record_ctime_size = args.record_ctime_size
     test_params.permute_host_dirs = args.permute_host_dirs
     test_params.output_json = args.output_json
     inv.incompressible = args.incompressible
     inv.verify_read = args.verify_read
+    inv.io_engine = args.io_engine
+    inv.iov_count = args.iov_count
+    inv.direct_io = args.direct_io
+    inv.iodepth = args.iodepth
+    inv.dir_fd_cache_size = args.dir_fd_cache
+    inv.dir_threads = args.dir_threads
+    inv.cleanup_scan = args.cleanup_scan
     test_params.min_directories_per_sec = args.min_dirs_per_sec
     inv.is_shared_dir = args.same_dir
     inv.verbose = args.verbose
@@ -321,12 +419,82 @@ def parse():
     if inv.record_sz_kb > inv.total_sz_kb and inv.total_sz_kb != 0:
         raise SmfParseException("record size cannot exceed file size")
 
+    # with both --procs and --threads-per-proc, their product is threads per client
+
+    if test_params.procs and test_params.threads_per_proc:
+        test_params.thread_count = test_params.procs * test_params.threads_per_proc
+        inv.threads = test_params.thread_count
+    elif test_params.procs > test_params.thread_count:
+        raise SmfParseException("cannot have more worker processes than threads")
+
+    if inv.io_engine == inv.io_engine_vectored:
+        if not smallfile.vectored_io_supported:
+            raise SmfParseException(
+                "vectored I/O engine needs os.pwritev and os.preadv, not available here"
+            )
+        if inv.iov_count > inv.max_iov_count:
+            raise SmfParseException(
+                "iov count cannot exceed %d records" % inv.max_iov_count
+            )
+
+    if inv.iodepth > 1 and inv.opname not in inv.file_op_names:
+        raise SmfParseException(
+            "iodepth > 1 is only supported for operations: %s"
+            % ",".join(inv.file_op_names)
+        )
+
+    if inv.dir_fd_cache_size > 0:
+        if not smallfile.dir_fd_supported:
+            raise SmfParseException(
+                "directory fd cache needs dir_fd support in os module, not available here"
+            )
+        # rename looks up source and destination directories at the same time
+        if inv.dir_fd_cache_size < 2:
+            raise SmfParseException("directory fd cache must hold at least 2 fds")
+
+    if inv.direct_io:
+        if not smallfile.direct_io_supported:
+            raise SmfParseException("O_DIRECT is not available on this platform")
+        align_kb = inv.direct_io_align // inv.BYTES_PER_KB
+        if inv.record_sz_kb % align_kb != 0:
+            raise SmfParseException(
+                "with --direct-io, record size must be a multiple of %d KB" % align_kb
+            )
+
     if inv.record_sz_kb == 0 and inv.verbose:
         print(
             "record size not specified,large files will default to record size %d KB"
             % (SmallfileWorkload.biggest_buf_size / inv.BYTES_PER_KB)
         )
 
+    if test_params.control_port and (
+        test_params.launch_by_daemon or smallfile.is_windows_os
+    ):
+        raise SmfParseException(
+            "--control-port cannot be used with --launch-by-daemon or on Windows, "
+            + "where hosts return results in the shared directory"
+        )
+
+    # the test driver's own host name is often a loopback address,
+    # which remote hosts cannot connect to
+
+    if test_params.control_port and test_params.host_set:
+        default_control_host = smallfile.get_hostname(None)
+        try:
+            control_host = control_plane.reachable_control_host(
+                test_params.control_host,
+                test_params.host_set,
+                test_params.control_host != default_control_host,
+            )
+        except SMFRunException as e:
+            raise SmfParseException(str(e))
+        if control_host != test_params.control_host:
+            print(
+                "--control-host %s is a loopback address, using %s instead"
+                % (test_params.control_host, control_host)
+            )
+            test_params.control_host = control_host
+
     if test_params.top_dirs:
         for d in test_params.top_dirs:
             if len(d) < 6:
@@ -365,11 +533,12 @@ def parse():
         inv.pause_between_files = 0
         print("pause parameter not needed with auto-pause Y, setting pause to 0")
 
-    # create must finish all files so that subsequent ops have the files they need
+    # create and create-mmap must finish all files
+    # so that subsequent ops have the files they need
     # cleanup must finish all files so that all remnants of last test are removed
 
     if (
-        ["cleanup", "create", "mkdir"].__contains__(inv.opname)
+        ["cleanup", "create", "create-mmap", "mkdir"].__contains__(inv.opname)
     ) and not inv.finish_all_rq:
         print("changing --finish to true for op type %s" % inv.opname)
         inv.finish_all_rq = True
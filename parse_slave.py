@@ -13,14 +13,17 @@ import os
 import pickle
 import time
 
+import control_plane
 import smallfile
 
 
 def parse():
     """
     parse command line and return unpickled test params
+    and connection to test driver, if any
 
-    pass via --network-sync-dir option
+    pass via --network-sync-dir option, or get them from test driver
+    at --control-addr
     optionally pass host identity of this remote invocation
     """
     parser = argparse.ArgumentParser(description="parse remote smallfile parameters")
@@ -32,15 +35,32 @@ def parse():
         default=smallfile.get_hostname(None),
         help="directory used to synchronize with test driver",
     )
+    parser.add_argument(
+        "--control-addr",
+        help="host:port of test driver, to get parameters from instead of files",
+    )
+    parser.add_argument(
+        "--control-key",
+        help="secret key of this test run, to authenticate --control-addr messages",
+    )
     args = parser.parse_args()
 
-    param_pickle_fname = os.path.join(args.network_sync_dir, "param.pickle")
-    if not os.path.exists(param_pickle_fname):
-        time.sleep(1.1)
-    params = None
-    with open(param_pickle_fname, "rb") as pickled_params:
-        params = pickle.load(pickled_params)
+    control = None
+    if args.control_addr:
+        if not args.control_key:
+            parser.error("--control-addr requires --control-key")
+        control = control_plane.control_client(
+            args.control_addr, args.control_key, args.as_host
+        )
+        params = control.params
+    else:
+        param_pickle_fname = os.path.join(args.network_sync_dir, "param.pickle")
+        if not os.path.exists(param_pickle_fname):
+            time.sleep(1.1)
+        params = None
+        with open(param_pickle_fname, "rb") as pickled_params:
+            params = pickle.load(pickled_params)
     params.is_slave = True
     params.as_host = args.as_host
     params.master_invoke.onhost = args.as_host
-    return params
+    return (params, control)
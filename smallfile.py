@@ -28,13 +28,20 @@ Created on Apr 22, 2009
 # on Fedora 33 with python 3.9.2, unittest is built in and no package is needed
 
 
+import array
+import asyncio
 import codecs
+import collections
+import concurrent.futures
 import copy
 import errno
+import json
 import logging
 import math
+import mmap
 import os
 import os.path
+import queue
 import random
 import socket
 import sys
@@ -82,6 +89,25 @@ try:
 except ImportError:
     pass
 
+shared_memory_installed = False
+try:
+    from multiprocessing import shared_memory
+
+    shared_memory_installed = True
+except ImportError:
+    pass
+
+# O_DIRECT is only defined on Linux and some BSDs,
+# and we need fcntl to turn it off again for unaligned tail of a file
+
+direct_io_supported = False
+try:
+    import fcntl
+
+    direct_io_supported = hasattr(os, "O_DIRECT")
+except ImportError:
+    pass
+
 unittest_module = None
 try:
     import unittest2
@@ -128,6 +154,28 @@ O_BINARY = 0
 if is_windows_os:
     O_BINARY = os.O_BINARY
 
+# os.readv() lets us read into a preallocated buffer
+
+readv_supported = hasattr(os, "readv")
+
+# os.pwritev() and os.preadv() let us transfer many records per system call
+
+vectored_io_supported = hasattr(os, "pwritev") and hasattr(os, "preadv")
+
+# *at() variants of the system calls used by per-file operations
+# let us look up a file name relative to a cached directory file descriptor
+
+dir_fd_supported = {
+    os.open,
+    os.stat,
+    os.chmod,
+    os.unlink,
+    os.rename,
+    os.mkdir,
+    os.rmdir,
+    os.symlink,
+} <= os.supports_dir_fd
+
 # for timeout debugging
 
 debug_timeout = os.getenv("DEBUG_TIMEOUT")
@@ -236,16 +284,570 @@ def hexdump(b):
     return s
 
 
+# return offset of first byte where two buffers of equal length differ,
+# or their length if they are the same,
+# by bisecting with slice compares instead of comparing byte by byte
+
+
+def first_mismatch(b1, b2):
+    (lo, hi) = (0, min(len(b1), len(b2)))
+    if b1[lo:hi] == b2[lo:hi]:
+        return hi
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if b1[lo:mid] == b2[lo:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+# read from fd into a writable buffer without allocating a bytes object,
+# on platforms without os.readv() (i.e. Windows) fall back to a copy
+
+
+def read_into(fd, view):
+    if readv_supported:
+        return os.readv(fd, [view])
+    bytesread = os.read(fd, len(view))
+    view[0 : len(bytesread)] = bytesread
+    return len(bytesread)
+
+
+# true if buffer (bytearray or mmap) contains expected at offset,
+# find() limited to this range can only match at offset
+# and compares in C without copying either buffer
+
+
+def buf_matches(buf, offset, expected):
+    return buf.find(expected, offset, offset + len(expected)) == offset
+
+
+# turn off O_DIRECT on an open file descriptor so that
+# an I/O which is not a multiple of the block size can be done
+
+
+def clear_direct_io(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+
+
+# run file_op on behalf of a worker in a thread pool,
+# returning its record count along with when it started and ended
+
+
+def timed_file_op(file_op, invk, fn, file_size_kb):
+    start_time = time.time()
+    records = file_op(invk, fn, file_size_kb)
+    return (records, start_time, time.time())
+
+
 def binary_buf_str(b):  # display a binary buffer as a text string
     if sys.version < "3":
         return codecs.unicode_escape_decode(b)[0]
     else:
         if isinstance(b, str):
             return bytes(b).decode("UTF-8", "backslashreplace")
+        elif isinstance(b, memoryview):
+            return b.tobytes().decode("UTF-8", "backslashreplace")
         else:
             return b.decode("UTF-8", "backslashreplace")
 
 
+# least-recently-used set of open directory file descriptors,
+# keyed by directory pathname, so that per-file operations
+# can pass dir_fd= and just the file name instead of the whole pathname,
+# and the kernel does not have to walk the whole path for every operation.
+# it counts hits, misses and evictions so their effect can be reported.
+# it is not thread-safe, each thread using one needs its own
+
+
+class dir_fd_cache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.fds = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, dpath):
+        fd = self.fds.get(dpath)
+        if fd is not None:
+            self.fds.move_to_end(dpath)
+            self.hits += 1
+            return fd
+        fd = os.open(dpath, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        self.misses += 1
+        self.fds[dpath] = fd
+        if len(self.fds) > self.capacity:
+            (_, old_fd) = self.fds.popitem(last=False)
+            os.close(old_fd)
+            self.evictions += 1
+        return fd
+
+    # close all descriptors and add counters into another cache, if any
+
+    def close(self, counts_to=None):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+        if counts_to is not None:
+            counts_to.hits += self.hits
+            counts_to.misses += self.misses
+            counts_to.evictions += self.evictions
+
+
+# subdirectory name for each file number, indexed like a list,
+# but each distinct directory name is built only once, when first needed,
+# since the name depends only on a directory index computed from file number.
+# this keeps memory proportional to number of directories, not files,
+# and there is nothing to build before the starting gate
+
+
+class lazy_file_dirs:
+    def __init__(self, invk):
+        self.invk = invk
+        self.names = {}
+
+    def __getitem__(self, file_num):
+        dir_index = self.invk.mk_dir_index(file_num)
+        try:
+            return self.names[dir_index]
+        except KeyError:
+            dir_name = self.invk.mk_dir_name(file_num)
+            self.names[dir_index] = dir_name
+            return dir_name
+
+
+# makes file names for one worker the same way as a single join of
+# top dir, subdirectory, prefix, host, thread ID, file number and suffix,
+# but for each top dir it keeps the "topdir/subdir/prefix_host_tid_" part
+# for the current directory, and which file numbers are in that directory,
+# so for most files making a name is one concatenation with the file number.
+# prefix, host, thread ID and suffix are looked at again whenever
+# a file is in a different directory than the one before it
+
+
+class file_name_generator:
+    def __init__(self, invk):
+        self.invk = invk
+        self.name_key = None
+        self.file_prefix = None
+        self.file_suffix = None
+        # top dir -> (first file number, last file number + 1, name prefix)
+        self.dir_prefixes = {}
+
+    def cache_dir_prefix(self, tree, file_num):
+        invk = self.invk
+        name_key = (invk.prefix, invk.onhost, invk.tid, invk.suffix)
+        if name_key != self.name_key:
+            self.name_key = name_key
+            self.file_prefix = "_".join(name_key[0:3]) + "_"
+            self.file_suffix = "_" + invk.suffix
+            self.dir_prefixes = {}
+        dir_prefix = (
+            tree + os.sep + invk.file_dirs[file_num] + os.sep + self.file_prefix
+        )
+        if invk.hash_to_dir:
+            # neighboring file numbers are not in the same directory
+            (first, last) = (file_num, file_num + 1)
+        else:
+            first = file_num - file_num % invk.files_per_dir
+            last = first + invk.files_per_dir
+        cached = (first, last, dir_prefix)
+        self.dir_prefixes[tree] = cached
+        return cached
+
+    def mk_file_nm(self, base_dirs, file_num):
+        tree = base_dirs[file_num % len(base_dirs)]
+        cached = self.dir_prefixes.get(tree)
+        if cached is None or not cached[0] <= file_num < cached[1]:
+            cached = self.cache_dir_prefix(tree, file_num)
+        return cached[2] + str(file_num) + self.file_suffix
+
+    # source and destination names of one file
+
+    def mk_src_dest_nms(self, file_num):
+        return (
+            self.mk_file_nm(self.invk.src_dirs, file_num),
+            self.mk_file_nm(self.invk.dest_dirs, file_num),
+        )
+
+
+# log-linear histogram of response times of one operation type,
+# like HdrHistogram: times below sub_count microseconds each have a bucket,
+# above that each power of 2 is split into sub_count / 2 buckets,
+# so a percentile is within 1/32 of the real value or half a microsecond,
+# up to 2^max_bits microseconds (19 hours).
+# count, sum, minimum and maximum are exact.
+# it takes the same few KB however many samples it has,
+# histograms of the same operation from any threads or hosts can be merged,
+# and only the buckets in use are pickled
+
+
+class latency_histogram:
+    sub_bits = 5
+    sub_count = 1 << sub_bits
+    half_count = sub_count >> 1
+    max_bits = 36
+    bucket_count = sub_count + (max_bits - sub_bits) * half_count
+
+    def __init__(self):
+        self.buckets = array.array("Q", bytes(8 * self.bucket_count))
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, usec):
+        if usec < cls.sub_count:
+            return usec if usec > 0 else 0
+        shift = usec.bit_length() - cls.sub_bits
+        if shift > cls.max_bits - cls.sub_bits:
+            return cls.bucket_count - 1
+        return (
+            cls.sub_count
+            + (shift - 1) * cls.half_count
+            + (usec >> shift)
+            - cls.half_count
+        )
+
+    # middle of the range of microseconds counted in a bucket
+
+    @classmethod
+    def bucket_value(cls, index):
+        if index < cls.sub_count:
+            return index + 0.5
+        shift = (index - cls.sub_count) // cls.half_count + 1
+        low = ((index - cls.sub_count) % cls.half_count + cls.half_count) << shift
+        return low + (1 << shift) / 2.0
+
+    def add(self, rsp_time):
+        self.buckets[self.bucket_index(int(rsp_time * 1000000.0))] += 1
+        self.count += 1
+        self.total += rsp_time
+        if self.min is None or rsp_time < self.min:
+            self.min = rsp_time
+        if self.max is None or rsp_time > self.max:
+            self.max = rsp_time
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        buckets = self.buckets
+        for (k, c) in enumerate(other.buckets):
+            if c:
+                buckets[k] += c
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    # response time in seconds that pct percent of samples are at or below
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(self.count * pct / 100.0))
+        seen = 0
+        for (k, c) in enumerate(self.buckets):
+            seen += c
+            if seen >= rank:
+                value = self.bucket_value(k) / 1000000.0
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def __getstate__(self):
+        used = [(k, c) for (k, c) in enumerate(self.buckets) if c]
+        return (self.count, self.total, self.min, self.max, used)
+
+    def __setstate__(self, state):
+        self.__init__()
+        (self.count, self.total, self.min, self.max, used) = state
+        for (k, c) in used:
+            self.buckets[k] = c
+
+
+# binary response time file written by rsptime_recorder:
+# a header of rsptime_header_size bytes, which is JSON padded with spaces,
+# followed by one record per sample of rsptime_fields float64 values
+# in the byte order named in the header: operation code
+# (index into the header's "op_names"), start time (seconds since 1970)
+# and response time (seconds).
+# the header is rewritten when the thread finishes, with all operation names
+# and the sample count, but records are fixed size, so a reader can
+# get the sample count from the file size, even if the thread never finished
+
+rsptime_header_size = 4096
+rsptime_fields = 3
+rsptime_magic = "smallfile-rsptimes"
+rsptime_version = 1
+
+
+def read_rsptime_header(pathname):
+    with open(pathname, "rb") as f:
+        header = json.loads(f.read(rsptime_header_size).decode("utf-8"))
+    if header.get("format") != rsptime_magic:
+        raise SMFResultException("%s is not a response time file" % pathname)
+    if header["version"] != rsptime_version:
+        raise SMFResultException(
+            "%s: response time file version %s, expected %d"
+            % (pathname, header["version"], rsptime_version)
+        )
+    record_bytes = rsptime_fields * 8
+    header["samples"] = (
+        os.path.getsize(pathname) - rsptime_header_size
+    ) // record_bytes
+    return header
+
+
+# one thread per process writes full chunks of response time samples
+# for all the worker threads in it, so that they do not wait for the disk.
+# if it falls more than max_chunks behind, workers wait for it,
+# so memory used for samples stays bounded
+
+
+class rsptime_writer(threading.Thread):
+    max_chunks = 16
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="rsptime-writer", daemon=True)
+        self.chunks = queue.Queue(self.max_chunks)
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            (recorder, chunk, done) = self.chunks.get()
+            try:
+                if chunk is not None:
+                    recorder.write_chunk(chunk)
+                if done is not None:
+                    recorder.write_header()
+            except Exception as e:
+                recorder.error = e
+            finally:
+                if done is not None:
+                    done.set()
+
+
+rsptime_writer_lock = threading.Lock()
+rsptime_writer_thread = None
+
+
+# a forked worker process does not have the writer thread of its parent
+
+
+def get_rsptime_writer():
+    global rsptime_writer_thread
+    with rsptime_writer_lock:
+        w = rsptime_writer_thread
+        if w is None or w.pid != os.getpid():
+            w = rsptime_writer_thread = rsptime_writer()
+            w.start()
+        return w
+
+
+# response time samples of one thread, kept in an array of float64,
+# with operation code, start time and response time of each operation,
+# instead of a tuple per operation, so each sample takes 24 bytes.
+# when chunk_size samples have accumulated, the rsptime_writer thread
+# appends them to the thread's response time file, so memory used stays
+# the same however long the test runs and samples are on disk as they come.
+# finish() waits for the rest to be written.
+# like dir_fd_cache, it is not thread-safe, each thread needs its own
+
+
+class rsptime_recorder:
+    chunk_size = 1 << 16
+
+    def __init__(self, invk):
+        self.invk = invk
+        self.path = None
+        self.file = None
+        self.written = 0  # number of samples in file
+        self.queued = 0  # number of samples given to writer
+        self.error = None
+        self.op_names = []
+        self.op_codes = {}
+        self.chunk = array.array("d")
+
+    def __len__(self):
+        return self.queued + len(self.chunk) // rsptime_fields
+
+    def append(self, opname, start_time, rsp_time):
+        try:
+            op_code = self.op_codes[opname]
+        except KeyError:
+            op_code = self.op_codes[opname] = len(self.op_names)
+            self.op_names.append(opname)
+        chunk = self.chunk
+        chunk.append(op_code)
+        chunk.append(start_time)
+        chunk.append(rsp_time)
+        if len(chunk) >= self.chunk_size * rsptime_fields:
+            self.flush()
+
+    def flush(self, done=None):
+        if self.path is None:
+            self.path = self.invk.rsptime_fn("rsp")
+        chunk = self.chunk
+        self.chunk = array.array("d")
+        self.queued += len(chunk) // rsptime_fields
+        get_rsptime_writer().chunks.put((self, chunk, done))
+
+    # called by writer thread
+
+    def write_chunk(self, chunk):
+        if self.file is None:
+            self.file = open(self.path, "wb")
+            self.write_header()
+        chunk.tofile(self.file)
+        self.written += len(chunk) // rsptime_fields
+
+    def write_header(self):
+        invk = self.invk
+        header = json.dumps(
+            {
+                "format": rsptime_magic,
+                "version": rsptime_version,
+                "byteorder": sys.byteorder,
+                "fields": ["op", "start", "rsp"],
+                "host": get_hostname(None),
+                "tid": invk.tid,
+                "op": invk.opname,
+                "start_time": invk.start_time,
+                "op_names": self.op_names,
+                "samples": self.written,
+            }
+        ).encode("utf-8")
+        if len(header) > rsptime_header_size:
+            raise OSError(errno.E2BIG, "response time file header too big")
+        self.file.seek(0)
+        self.file.write(header.ljust(rsptime_header_size, b" "))
+        self.file.seek(0, os.SEEK_END)
+
+    # write the rest of the samples and the final header, return pathname
+
+    def finish(self):
+        done = threading.Event()
+        self.flush(done)
+        done.wait()
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())  # particularly for NFS this is needed
+            self.file.close()
+            self.file = None
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+    # (operation name, start time, response time) for every sample,
+    # read back from the file written by finish()
+
+    def samples(self):
+        with open(self.path, "rb") as f:
+            f.seek(rsptime_header_size)
+            while True:
+                chunk = array.array("d")
+                try:
+                    chunk.fromfile(f, self.chunk_size * rsptime_fields)
+                except EOFError:
+                    pass  # partial last chunk was still read
+                for k in range(0, len(chunk), rsptime_fields):
+                    yield (self.op_names[int(chunk[k])], chunk[k + 1], chunk[k + 2])
+                if len(chunk) < self.chunk_size * rsptime_fields:
+                    break
+
+    # forget samples not yet written, file is left alone
+
+    def close(self):
+        self.chunk = array.array("d")
+
+
+# what one thread reports when it is done: counters, times and status,
+# without the parameters, buffers, names and response times
+# that the SmallfileWorkload instance holds while running.
+# worker processes send one of these per thread as it finishes,
+# so collecting results from many threads and hosts stays cheap.
+# version changes whenever fields are added or removed,
+# so a result from a host running different code is recognized
+
+
+class thread_result:
+    version = 2
+
+    __slots__ = (
+        "result_version",
+        "onhost",
+        "tid",
+        "opname",
+        "iterations",
+        "record_sz_kb",
+        "status",
+        "start_time",
+        "elapsed_time",
+        "filenum_final",
+        "rq_final",
+        "dirs_created",
+        "dir_create_time",
+        "dirs_removed",
+        "dir_remove_time",
+        "dir_fd_hits",
+        "dir_fd_misses",
+        "dir_fd_evictions",
+        "histograms",
+    )
+
+    def __init__(self, invk):
+        self.result_version = self.version
+        self.onhost = invk.onhost
+        self.tid = invk.tid
+        self.opname = invk.opname
+        self.iterations = invk.iterations
+        self.record_sz_kb = invk.get_record_size_to_use()
+        self.status = invk.status
+        self.start_time = invk.start_time
+        self.elapsed_time = invk.elapsed_time
+        self.filenum_final = invk.filenum_final
+        self.rq_final = invk.rq_final
+        self.dirs_created = invk.dirs_created
+        self.dir_create_time = invk.dir_create_time
+        self.dirs_removed = invk.dirs_removed
+        self.dir_remove_time = invk.dir_remove_time
+        self.dir_fd_hits = invk.dir_fd_hits
+        self.dir_fd_misses = invk.dir_fd_misses
+        self.dir_fd_evictions = invk.dir_fd_evictions
+        # operation name -> latency_histogram
+        self.histograms = invk.histograms
+
+    # pickle just the values, field names are the same for every result
+
+    def __getstate__(self):
+        return tuple(getattr(self, f) for f in self.__slots__)
+
+    def __setstate__(self, state):
+        for (f, v) in zip(self.__slots__, state):
+            setattr(self, f, v)
+
+    def __str__(self):
+        return (
+            "thread_result: host=%s tid=%s op=%s status=%s start=%s "
+            "elapsed=%s files=%s records=%s"
+            % (
+                self.onhost,
+                self.tid,
+                self.opname,
+                str(self.status),
+                str(self.start_time),
+                str(self.elapsed_time),
+                str(self.filenum_final),
+                str(self.rq_final),
+            )
+        )
+
+
 class SmallfileWorkload:
     rename_suffix = ".rnm"
     all_op_names = [
@@ -268,16 +870,20 @@ class SmallfileWorkload:
         "swift-get",
         "swift-put",
         "ls-l",
+        "ls-l-scandir",
         "await-create",
         "truncate-overwrite",
+        "create-mmap",
+        "read-mmap",
     ]
     OK = 0
     NOTOK = 1
     BYTES_PER_KB = 1024
     MICROSEC_PER_SEC = 1000000.0
 
-    # number of files between stonewalling check at smallest file size
-    max_files_between_checks = 100
+    # seconds between stonewall checks, measured on the monotonic clock,
+    # so how far a thread overshoots does not depend on file size
+    stonewall_check_interval = 0.05
 
     # default for UNIX
     tmp_dir = os.getenv("TMPDIR")
@@ -310,6 +916,56 @@ class SmallfileWorkload:
     # initialize files with up to this many different random patterns
     buf_offset_range = 1 << 10
 
+    # how file data is transferred, one record per system call
+    # or up to iov_count records per system call
+
+    io_engine_sync = "sync"
+    io_engine_vectored = "vectored"
+    all_io_engines = [io_engine_sync, io_engine_vectored]
+
+    # how response times are saved, see rsptime_recorder
+    rsptime_format_binary = "binary"
+    rsptime_format_csv = "csv"
+    all_rsptime_formats = [rsptime_format_binary, rsptime_format_csv]
+
+    # operations done one file at a time by do_file_ops(),
+    # these can keep more than one file in flight per thread,
+    # and run as coroutines with the asyncio worker engine
+
+    file_op_names = [
+        "create",
+        "append",
+        "overwrite",
+        "truncate-overwrite",
+        "read",
+        "create-mmap",
+        "read-mmap",
+        "mkdir",
+        "rmdir",
+        "symlink",
+        "stat",
+        "chmod",
+        "getxattr",
+        "setxattr",
+        "rename",
+        "delete",
+        "delete-renamed",
+    ]
+
+    # limit on records per vectored system call (IOV_MAX on Linux)
+
+    max_iov_count = 1024
+
+    # O_DIRECT buffers, offsets and transfer sizes must be multiples of
+    # the device logical block size, the page size covers 512-byte
+    # and 4-KB sector devices
+
+    direct_io_align = max(mmap.PAGESIZE, 4096)
+
+    # maps a random byte to a 7-bit value for compressible random contents
+
+    seven_bit_table = bytes([k % 127 for k in range(0, 256)])
+
     loggers = {}  # so we only instantiate logger for a given thread name once
 
     # constructor sets up initial, default values for test parameters
@@ -354,9 +1010,6 @@ class SmallfileWorkload:
         # number of xattrs to read/write
         self.xattr_count = 0
 
-        # test-over polling rate
-        self.files_between_checks = 20
-
         # prepend this to file name
         self.prefix = ""
 
@@ -380,6 +1033,7 @@ class SmallfileWorkload:
 
         # append response times to .rsptimes
         self.measure_rsptimes = False
+        self.rsptime_format = self.rsptime_format_binary
 
         # write/expect binary random (incompressible) data
         self.incompressible = False
@@ -387,6 +1041,34 @@ class SmallfileWorkload:
         # , compare read data to what was written
         self.verify_read = True
 
+        # how file data is transferred (see all_io_engines)
+        self.io_engine = self.io_engine_sync
+
+        # records per system call with vectored I/O engine
+        self.iov_count = 16
+
+        # bypass page cache using O_DIRECT for file data
+        self.direct_io = False
+
+        # files in flight per thread for data operations
+        self.iodepth = 1
+
+        # threads used to create and remove directory trees
+        self.dir_threads = 1
+
+        # cleanup lists each directory once and removes this thread's entries
+        # instead of trying every name this thread's files could have
+        self.cleanup_scan = False
+
+        # directory fds kept open per thread for *at() system calls, 0 = none
+        self.dir_fd_cache_size = 0
+
+        # the dir_fd_cache itself, only while the workload is running
+        self.dir_fds = None
+
+        # executor for file ops when run as a coroutine by asyncio worker engine
+        self.async_executor = None
+
         # should we attempt to adjust pause between files
         self.auto_pause = False
 
@@ -430,6 +1112,21 @@ class SmallfileWorkload:
         # copy from here on writes, compare to here on reads
         self.biggest_buf = None
 
+        # shared memory containing biggest_buf, if shared by all threads on host
+        self.shared_buf = None
+
+        # byte in shared_buf that is set once the stonewall is seen on this host
+        self.stonewall_flag = None
+
+        # host-local starting gate, used instead of files if the host has one
+        self.start_barrier = None
+
+        # preallocated buffer that reads are done into
+        self.read_buf = None
+
+        # page-aligned copy of record to write with O_DIRECT
+        self.write_buf = None
+
         # random seed used to control sequence of random numbers,
         # default to different sequence every time
         self.randstate = random.Random()
@@ -440,6 +1137,9 @@ class SmallfileWorkload:
         # number of threads in each host/pod
         self.threads = 1
 
+        # response time samples, see rsptime_recorder
+        self.rsptimes = None
+
         # reset object state variables
 
         self.reset()
@@ -470,14 +1170,21 @@ class SmallfileWorkload:
         s += " fsync=" + str(self.fsync)
         s += " stonewall=" + str(self.stonewall)
         s += " cleanup_delay_usec_per_file=" + str(self.cleanup_delay_usec_per_file)
-        s += " files_between_checks=" + str(self.files_between_checks)
         s += " pause=" + str(self.pause_between_files)
         s += " pause_sec=" + str(self.pause_sec)
         s += " auto_pause=" + str(self.auto_pause)
         s += " verify_read=" + str(self.verify_read)
         s += " incompressible=" + str(self.incompressible)
+        s += " io_engine=" + self.io_engine
+        s += " iov_count=%d" % self.iov_count
+        s += " direct_io=" + str(self.direct_io)
+        s += " iodepth=%d" % self.iodepth
+        s += " dir_fd_cache_size=%d" % self.dir_fd_cache_size
+        s += " dir_threads=%d" % self.dir_threads
+        s += " cleanup_scan=" + str(self.cleanup_scan)
         s += " finish_all_rq=" + str(self.finish_all_rq)
         s += " rsp_times=" + str(self.measure_rsptimes)
+        s += " rsp_format=" + self.rsptime_format
         s += " tid=" + self.tid
         s += " loglevel=" + str(self.log_level)
         s += " filenum=" + str(self.filenum)
@@ -506,9 +1213,27 @@ class SmallfileWorkload:
         self.rq = 0  # how many reads/writes have been attempted so far
         self.rq_final = None  # how many reads/writes completed when test ended
         self.abort = False
-        self.file_dirs = []  # subdirectores within per-thread dir
+        # subdirectories within per-thread dir, by file number
+        self.file_dirs = lazy_file_dirs(self)
+        self.file_names = file_name_generator(self)
         self.status = ok
 
+        # directories created before the starting gate, and how long it took
+        self.dirs_created = 0
+        self.dir_create_time = None
+
+        # directories removed by cleanup, and how long it took
+        self.dirs_removed = 0
+        self.dir_remove_time = None
+
+        # monotonic clock time of next stonewall check
+        self.next_stonewall_check = 0.0
+
+        # directory fd cache counters, summed over all files in flight
+        self.dir_fd_hits = 0
+        self.dir_fd_misses = 0
+        self.dir_fd_evictions = 0
+
         # response time samples for auto-pause feature
         self.pause_rsptime_count = 100
         # special value that means no response times have been measured yet
@@ -520,6 +1245,8 @@ class SmallfileWorkload:
         # start time for this history interval
         self.pause_history_start_time = 0.0
         self.pause_sec = self.pause_between_files / self.MICROSEC_PER_SEC
+        # pause to be taken by coroutine instead of sleeping in do_another_file()
+        self.async_pause_sec = 0.0
         # recalculate this to capture any changes in self.total_hosts and self.threads
         self.total_threads = self.total_hosts * self.threads
         self.throttling_factor = 0.1 * math.log(self.total_threads + 1, 2)
@@ -531,7 +1258,11 @@ class SmallfileWorkload:
 
         # to measure file operation response times
         self.op_start_time = None
-        self.rsptimes = []
+        # response time histogram for each operation name
+        self.histograms = {}
+        if self.rsptimes is not None:
+            self.rsptimes.close()
+        self.rsptimes = rsptime_recorder(self)
         self.rsptime_filename = None
 
     # given a set of top-level directories (e.g. for NFS benchmarking)
@@ -598,35 +1329,41 @@ class SmallfileWorkload:
             self.op_start_time = starttime
 
     # indicate end of an operation,
-    # this appends the elapsed time of the operation to .rsptimes array
+    # this appends the elapsed time of the operation to .rsptimes recorder
+    # end_time is passed in if the operation was done by another thread
 
-    def op_endtime(self, opname):
-        end_time = time.time()
+    def op_endtime(self, opname, end_time=None):
+        if not end_time:
+            end_time = time.time()
         rsp_time = end_time - self.op_start_time
+        try:
+            self.histograms[opname].add(rsp_time)
+        except KeyError:
+            h = self.histograms[opname] = latency_histogram()
+            h.add(rsp_time)
         if self.measure_rsptimes:
-            self.rsptimes.append((opname, self.op_start_time, rsp_time))
+            self.rsptimes.append(opname, self.op_start_time, rsp_time)
         self.op_start_time = None
         if self.auto_pause:
             self.adjust_pause_time(end_time, rsp_time)
 
-    # save response times seen by this thread
+    # save response times seen by this thread,
+    # most of them were already written to the binary file during the test.
+    # for CSV format, the binary file is converted to CSV and removed
 
     def save_rsptimes(self):
-        fname = "rsptimes_{tid}_{host}_{op}_{ts}.csv".format(
-            tid=str(self.tid),
-            host=get_hostname(None),
-            op=self.opname,
-            ts=str(self.start_time),
-        )
-        rsptime_fname = join(self.network_dir, fname)
-        with open(rsptime_fname, "w") as f:
-            for opname, start_time, rsp_time in self.rsptimes:
+        rsptime_fname = self.rsptimes.finish()
+        if self.rsptime_format != self.rsptime_format_csv:
+            return
+        with open(self.rsptime_fn("csv"), "w") as f:
+            for opname, start_time, rsp_time in self.rsptimes.samples():
                 # time granularity is microseconds, accuracy is less
                 f.write(
                     "%8s, %9.6f, %9.6f\n"
                     % (opname, start_time - self.start_time, rsp_time)
                 )
             os.fsync(f.fileno())  # particularly for NFS this is needed
+        os.unlink(rsptime_fname)
 
     # compute pause time based on available response time samples,
     # assuming all threads converge to roughly the same average response time
@@ -735,6 +1472,18 @@ class SmallfileWorkload:
     def log_fn(self):
         return join(self.tmp_dir, "invoke_logs-%s.log" % self.tid)
 
+    # response time file for this thread, ext is "rsp" (binary) or "csv"
+
+    def rsptime_fn(self, ext):
+        fname = "rsptimes_{tid}_{host}_{op}_{ts}.{ext}".format(
+            tid=str(self.tid),
+            host=get_hostname(None),
+            op=self.opname,
+            ts=str(self.start_time),
+            ext=ext,
+        )
+        return join(self.network_dir, fname)
+
     # file for result stored as pickled python object
 
     def host_result_filename(self, result_host=None):
@@ -749,32 +1498,36 @@ class SmallfileWorkload:
 
     def init_random_seed(self):
         fn = self.gen_thread_ready_fname(self.tid, hostname=self.onhost) + ".seed"
-        thread_seed = str(time.time())
         self.log.debug("seed opname: " + self.opname)
-        if self.opname == "create" or self.opname == "swift-put":
-            thread_seed = str(time.time()) + " " + self.tid
-            ensure_deleted(fn)
-            with open(fn, "w") as seedfile:
-                seedfile.write(str(thread_seed))
-                self.log.debug("write seed %s " % thread_seed)
-        # elif ['append', 'read', 'swift-get'].__contains__(self.opname):
+        thread_seed = self.get_saved_seed(fn, str(time.time()) + " " + self.tid)
+        if thread_seed is None:
+            thread_seed = str(time.time())
+            if self.opname in ["cleanup", "rmdir", "delete"]:
+                self.log.info(
+                    "no saved random seed found in %s but it does not matter for deletes"
+                    % fn
+                )
         else:
-            try:
-                with open(fn, "r") as seedfile:
-                    thread_seed = seedfile.readlines()[0].strip()
-                    self.log.debug("read seed %s " % thread_seed)
-            except OSError as e:
-                if e.errno == errno.ENOENT and self.opname in [
-                    "cleanup",
-                    "rmdir",
-                    "delete",
-                ]:
-                    self.log.info(
-                        "no saved random seed found in %s but it does not matter for deletes"
-                        % fn
-                    )
+            self.log.debug("using seed %s " % thread_seed)
         self.randstate.seed(thread_seed)
 
+    # ops that write file contents save new_seed in seed_fn,
+    # other ops read back the seed saved by the op that wrote the files,
+    # returns None if no saved seed could be read
+
+    def get_saved_seed(self, seed_fn, new_seed):
+        if self.opname in ["create", "create-mmap", "swift-put"]:
+            ensure_deleted(seed_fn)
+            with open(seed_fn, "w") as seedfile:
+                seedfile.write(new_seed)
+            return new_seed
+        # elif ['append', 'read', 'swift-get'].__contains__(self.opname):
+        try:
+            with open(seed_fn, "r") as seedfile:
+                return seedfile.readlines()[0].strip()
+        except OSError:
+            return None
+
     def get_next_file_size(self):
         next_size = self.total_sz_kb
         if self.filesize_distr == self.fsdistr_random_exponential:
@@ -800,31 +1553,48 @@ class SmallfileWorkload:
     # that other hosts will also see it at the same time
 
     def wait_for_gate(self):
-        if self.starting_gate:
+        if self.start_barrier is not None:
+            # the host process releases us when the test starts
+            self.start_barrier.thread_ready()
+            self.start_barrier.wait()
+        elif self.starting_gate:
             gateReady = self.gen_thread_ready_fname(self.tid)
             touch(gateReady)
-            delay_time = 0.1
-            while not os.path.exists(self.starting_gate):
-                if os.path.exists(self.abort_fn()):
-                    raise SMFRunException("thread " + str(self.tid) + " saw abort flag")
-                # wait a little longer so that
-                # other clients have time to see that gate exists
-                delay_time = delay_time * 1.5
-                if delay_time > 2.0:
-                    delay_time = 2.0
+            delay_time = self.gate_poll_delay(0.1)
+            while delay_time is not None:
                 time.sleep(delay_time)
-            gateinfo = os.stat(self.starting_gate)
-            synch_time = gateinfo.st_mtime + 3.0 - time.time()
+                delay_time = self.gate_poll_delay(delay_time)
+            synch_time = self.gate_synch_time()
             if synch_time > 0.0:
                 time.sleep(synch_time)
-            if synch_time < 0.0:
-                self.log.warn("other threads may have already started")
             if self.verbose:
                 self.log.debug(
                     "started test at %f sec after waiting %f sec"
                     % (time.time(), synch_time)
                 )
 
+    # return None if starting gate exists,
+    # otherwise how long to wait before looking for it again
+
+    def gate_poll_delay(self, delay_time):
+        if os.path.exists(self.starting_gate):
+            return None
+        if os.path.exists(self.abort_fn()):
+            raise SMFRunException("thread " + str(self.tid) + " saw abort flag")
+        # wait a little longer so that
+        # other clients have time to see that gate exists
+        return min(delay_time * 1.5, 2.0)
+
+    # how long to wait after starting gate is seen
+    # so that all threads on all hosts start at the same time
+
+    def gate_synch_time(self):
+        gateinfo = os.stat(self.starting_gate)
+        synch_time = gateinfo.st_mtime + 3.0 - time.time()
+        if synch_time < 0.0:
+            self.log.warn("other threads may have already started")
+        return synch_time
+
     # record info needed to compute test statistics
 
     def end_test(self):
@@ -842,7 +1612,10 @@ class SmallfileWorkload:
         self.end_time = time.time()
         self.elapsed_time = self.end_time - self.start_time
         stonewall_path = self.stonewall_fn()
-        if self.filenum >= self.iterations and not os.path.exists(stonewall_path):
+        if self.filenum >= self.iterations and self.stonewall_flag is not None:
+            # the host's watcher tells other threads and other hosts
+            self.stonewall_flag[0] = 1
+        elif self.filenum >= self.iterations and not os.path.exists(stonewall_path):
             try:
                 touch(stonewall_path)
                 self.log.info("stonewall file %s written" % stonewall_path)
@@ -862,23 +1635,28 @@ class SmallfileWorkload:
     def test_ended(self):
         return (self.end_time is not None) and (self.end_time > self.start_time)
 
+    # has some thread finished?
+    # if threads on this host share a stonewall flag, a watcher in the
+    # parent process sets it when the stonewall file appears,
+    # so threads never look up the file in the shared network directory
+
+    def stonewall_seen(self):
+        if self.stonewall_flag is not None:
+            return self.stonewall_flag[0] != 0
+        return os.path.exists(self.stonewall_fn())
+
     # see if we should do one more file
-    # to minimize overhead, do not check stonewall file before every iteration
+    # to minimize overhead, check for stonewall at most every
+    # stonewall_check_interval seconds, not before every iteration
 
     def do_another_file(self):
-        if self.stonewall and (((self.filenum + 1) % self.files_between_checks) == 0):
-            stonewall_path = self.stonewall_fn()
-            if self.verbose:
-                self.log.debug(
-                    "checking for stonewall file %s after %s iterations"
-                    % (stonewall_path, self.filenum)
-                )
-            if os.path.exists(stonewall_path):
-                self.log.info(
-                    "stonewall file %s seen after %d iterations"
-                    % (stonewall_path, self.filenum)
-                )
-                self.end_test()
+        if self.stonewall:
+            now = time.monotonic()
+            if now >= self.next_stonewall_check:
+                self.next_stonewall_check = now + self.stonewall_check_interval
+                if self.stonewall_seen():
+                    self.log.info("stonewall seen after %d iterations" % self.filenum)
+                    self.end_test()
 
         # if user doesn't want to finish all requests and test has ended, stop
 
@@ -894,7 +1672,10 @@ class SmallfileWorkload:
             raise SMFRunException("thread " + str(self.tid) + " saw abort flag")
         self.filenum += 1
         if self.pause_sec > 0.0 and self.iterations % self.files_between_pause == 0:
-            time.sleep(self.pause_sec * self.files_between_pause)
+            if self.async_executor is None:
+                time.sleep(self.pause_sec * self.files_between_pause)
+            else:
+                self.async_pause_sec = self.pause_sec * self.files_between_pause
         return True
 
     # in this method of directory selection, as filenum increments upwards,
@@ -940,6 +1721,14 @@ class SmallfileWorkload:
             dir_num //= self.dirs_per_dir
         return os.sep.join(pathlist)
 
+    # all files with the same directory index are in the same directory
+
+    def mk_dir_index(self, file_num):
+        if self.hash_to_dir:
+            random_hash = file_num * self.some_prime % self.iterations
+            return random_hash // self.files_per_dir
+        return file_num // self.files_per_dir
+
     def mk_dir_name(self, file_num):
         if self.hash_to_dir:
             return self.mk_hashed_dir_name(file_num)
@@ -956,34 +1745,32 @@ class SmallfileWorkload:
     # to spread load across mountpoints,
     # so we use round-robin mountpoint selection
     # NOTE: this routine is called A LOT,
-    # so need to optimize by avoiding lots of os.path.join calls
+    # so file_name_generator caches everything but the file number
 
     def mk_file_nm(self, base_dirs, filenum=-1):
         if filenum == -1:
             filenum = self.filenum
-        listlen = len(base_dirs)
-        tree = base_dirs[filenum % listlen]
-        components = [
-            tree,
-            os.sep,
-            self.file_dirs[filenum],
-            os.sep,
-            self.prefix,
-            "_",
-            self.onhost,
-            "_",
-            self.tid,
-            "_",
-            str(filenum),
-            "_",
-            self.suffix,
-        ]
-        return "".join(components)
+        return self.file_names.mk_file_nm(base_dirs, filenum)
+
+    # split a pathname from mk_file_nm() into a directory fd and a name in it,
+    # to pass as dir_fd= and path to *at() system calls,
+    # without a directory fd cache this is (None, pathname)
+
+    def at_dir(self, fn):
+        if self.dir_fds is None:
+            return (None, fn)
+        (dpath, name) = os.path.split(fn)
+        return (self.dir_fds.get(dpath), name)
 
     # generate buffer contents, use these on writes and
     # compare against them for reads where random data is used,
+    # random bytes are generated in bulk from self.randstate
+    # so contents are still determined by the per-thread random seed
+
+    def create_biggest_buf(self, contents_random, randstate=None):
+        if randstate is None:
+            randstate = self.randstate
 
-    def create_biggest_buf(self, contents_random):
         # generate random byte sequence if desired.
 
         random_segment_size = 1 << self.random_seg_size_bits
@@ -994,47 +1781,30 @@ class SmallfileWorkload:
 
             if contents_random:
                 biggest_buf = bytearray(
-                    [
-                        self.randstate.randrange(0, 127)
-                        for k in range(0, random_segment_size)
-                    ]
+                    randstate.randbytes(random_segment_size).translate(
+                        self.seven_bit_table
+                    )
                 )
             else:
                 biggest_buf = bytearray(
-                    [k % 128 for k in range(0, random_segment_size)]
+                    bytes(range(0, 128)) * (random_segment_size // 128)
                 )
 
             # to prevent confusion in python when printing out buffer contents
             # WARNING: this line breaks PythonTidy utility
             biggest_buf = biggest_buf.replace(b"\\", b"!")
 
-            # keep doubling buffer size until it is big enough
+            # repeat random segment until buffer is big enough
 
             next_power_2 = self.biggest_buf_size_bits - self.random_seg_size_bits
-            for j in range(0, next_power_2):
-                biggest_buf.extend(biggest_buf[:])
+            biggest_buf *= 1 << next_power_2
 
         else:  # if incompressible
             # for buffer to be incompressible,
             # we can't repeat the same (small) random sequence
             # FIXME: why shouldn't we always do it this way?
 
-            # initialize to a single random byte
-            biggest_buf = bytearray([self.randstate.randrange(0, 255)])
-            myassert(len(biggest_buf) == 1)
-            powerof2 = 1
-            powersum = 1
-            for j in range(0, self.biggest_buf_size_bits - 1):
-                myassert(len(biggest_buf) == powersum)
-                powerof2 *= 2
-                powersum += powerof2
-                # biggest_buf length is now 2^j - 1
-                biggest_buf.extend(
-                    bytearray(
-                        [self.randstate.randrange(0, 255) for k in range(0, powerof2)]
-                    )
-                )
-            biggest_buf.extend(bytearray([self.randstate.randrange(0, 255)]))
+            biggest_buf = bytearray(randstate.randbytes(self.biggest_buf_size))
 
         # add extra space at end
         # so that we can get different buffer contents
@@ -1044,6 +1814,51 @@ class SmallfileWorkload:
         myassert(len(biggest_buf) == self.biggest_buf_size + self.buf_offset_range)
         return biggest_buf
 
+    # build biggest_buf once for all threads on this host
+    # in a shared memory segment, so each worker process
+    # does not have to build and hold its own copy.
+    # contents come from a per-host seed saved the same way as thread seeds
+    # returns None if shared memory is not available in this python
+
+    def create_shared_buf(self):
+        if not shared_memory_installed:
+            return None
+        seed_fn = join(self.tmp_dir, "biggest_buf.%s.seed" % self.onhost)
+        buf_seed = self.get_saved_seed(seed_fn, str(time.time()) + " " + self.onhost)
+        if buf_seed is None:
+            buf_seed = str(time.time())
+        biggest_buf = self.create_biggest_buf(False, random.Random(buf_seed))
+        # one more byte for the stonewall flag, new shared memory is zeroed
+        shared_buf = shared_memory.SharedMemory(create=True, size=len(biggest_buf) + 1)
+        shared_buf.buf[0 : len(biggest_buf)] = biggest_buf
+        return shared_buf
+
+    # writable view of the stonewall flag byte that follows biggest_buf
+    # in the segment built by create_shared_buf()
+
+    def stonewall_flag_view(self, shared_buf):
+        offset = self.biggest_buf_size + self.buf_offset_range
+        return shared_buf.buf[offset : offset + 1]
+
+    # use read-only view of biggest_buf built by create_shared_buf()
+    # instead of building one in do_workload()
+
+    def attach_shared_buf(self, shared_buf_name):
+        self.shared_buf = shared_memory.SharedMemory(name=shared_buf_name)
+        buf_len = self.biggest_buf_size + self.buf_offset_range
+        self.biggest_buf = self.shared_buf.buf[0:buf_len].toreadonly()
+        self.stonewall_flag = self.stonewall_flag_view(self.shared_buf)
+
+    # views into shared memory must be released before it can be closed
+
+    def detach_shared_buf(self):
+        self.buf = None
+        self.biggest_buf = None
+        self.stonewall_flag = None
+        if self.shared_buf:
+            self.shared_buf.close()
+            self.shared_buf = None
+
     # allocate buffer of correct size with offset based on filenum, tid, etc.
 
     def prepare_buf(self):
@@ -1085,14 +1900,282 @@ class SmallfileWorkload:
         # if self.verbose:
         #    self.log.debug('unique_offset: %d' % unique_offset)
 
+        # biggest_buf is a memoryview, so this slice does not copy any data
+
         self.buf = self.biggest_buf[unique_offset : total_space + unique_offset]
         # if self.verbose:
         #    self.log.debug('start of prepared buf: %s' % self.buf.hex()[0:40])
 
+    # return buffer that records are written from,
+    # with O_DIRECT the record is copied from self.buf once per file
+    # into a page-aligned buffer, since self.buf is at a per-file offset
+
+    def get_write_source(self, rszbytes):
+        if not self.direct_io:
+            return self.buf
+        if self.write_buf is None or len(self.write_buf) < rszbytes:
+            self.write_buf = mmap.mmap(-1, rszbytes)
+        source = memoryview(self.write_buf)[0:rszbytes]
+        source[:] = self.buf[0:rszbytes]
+        return source
+
+    # return a writable view of a preallocated buffer that reads are done into,
+    # with O_DIRECT this is an anonymous mmap, which is always page-aligned
+
+    def get_read_buf(self, size):
+        if self.direct_io:
+            if not isinstance(self.read_buf, mmap.mmap) or len(self.read_buf) < size:
+                self.read_buf = mmap.mmap(-1, size)
+        elif self.read_buf is None or len(self.read_buf) < size:
+            self.read_buf = bytearray(size)
+        return memoryview(self.read_buf)
+
+    # with O_DIRECT, a read of the unaligned tail of a file has to ask
+    # for a multiple of the block size, the read just returns fewer bytes
+
+    def get_read_transfer_size(self, nbytes):
+        if not self.direct_io:
+            return nbytes
+        align = self.direct_io_align
+        return ((nbytes + align - 1) // align) * align
+
+    # open a file for data transfer, using O_DIRECT if requested
+
+    def open_data_file(self, fn, open_mode):
+        (dfd, name) = self.at_dir(fn)
+        if not self.direct_io:
+            return os.open(name, open_mode, dir_fd=dfd)
+        try:
+            return os.open(name, open_mode | os.O_DIRECT, dir_fd=dfd)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                raise SMFRunException(
+                    "filesystem containing %s does not support O_DIRECT, "
+                    "cannot use --direct-io" % fn
+                )
+            raise e
+
+    # write remaining_kb of data from self.buf to fd
+    # in records of get_record_size_to_use() KB,
+    # passing memoryview slices of the pattern buffer straight to os.write()
+    # so no data is copied, and only the last (partial) record needs a new slice
+    # with O_DIRECT, a last record that is not a multiple of the block size
+    # is written with O_DIRECT turned off
+    # returns the number of records written
+
+    def write_records(self, fd, remaining_kb):
+        if self.io_engine == self.io_engine_vectored:
+            return self.write_records_vectored(fd, remaining_kb)
+        rszkb = self.get_record_size_to_use()
+        record = self.get_write_source(rszkb * self.BYTES_PER_KB)
+        records = 0
+        while remaining_kb > 0:
+            next_kb = min(rszkb, remaining_kb)
+            if next_kb < rszkb:
+                record = record[0 : next_kb * self.BYTES_PER_KB]
+            if self.direct_io and len(record) % self.direct_io_align:
+                clear_direct_io(fd)
+            written = os.write(fd, record)
+            if written != len(record):
+                raise MFRdWrExc(self.opname, self.filenum, self.rq + records, written)
+            records += 1
+            remaining_kb -= next_kb
+        return records
+
+    # read remaining_kb of data from fd in records of get_record_size_to_use() KB
+    # into a buffer that is allocated once per thread,
+    # comparing each record against a memoryview of the expected pattern
+    # buf_matches() compares without copying either buffer,
+    # and only the last (partial) record needs a new slice
+    # with O_DIRECT, every read asks for a multiple of the block size,
+    # even for a file smaller than one block
+    # returns the number of records read
+
+    def read_records(self, fd, remaining_kb):
+        if self.io_engine == self.io_engine_vectored:
+            return self.read_records_vectored(fd, remaining_kb)
+        rszkb = self.get_record_size_to_use()
+        rszbytes = rszkb * self.BYTES_PER_KB
+        transfer_bytes = self.get_read_transfer_size(rszbytes)
+        read_view = self.get_read_buf(transfer_bytes)
+        record = read_view[0:transfer_bytes]
+        expected = self.buf[0:rszbytes]
+        records = 0
+        while remaining_kb > 0:
+            next_kb = min(rszkb, remaining_kb)
+            if next_kb < rszkb:
+                expected = expected[0 : next_kb * self.BYTES_PER_KB]
+                record = read_view[0 : self.get_read_transfer_size(len(expected))]
+            bytesread = read_into(fd, record)
+            if bytesread < len(expected):
+                raise MFRdWrExc(self.opname, self.filenum, self.rq + records, bytesread)
+            if self.verify_read:
+                # this is in fast path so avoid evaluating self.log.debug
+                # unless people really want to see it
+                if self.verbose:
+                    self.log.debug(
+                        "read fd %d remain %u bytesread %u"
+                        % (fd, remaining_kb, bytesread)
+                    )
+                if not buf_matches(self.read_buf, 0, expected):
+                    raise MFRdWrExc(
+                        "read: buffer contents matched up through byte %d"
+                        % first_mismatch(expected, record[0 : len(expected)]),
+                        self.filenum,
+                        self.rq + records,
+                        bytesread,
+                    )
+            records += 1
+            remaining_kb -= next_kb
+        return records
+
+    # return (record count, record size in bytes, size of last record in bytes)
+    # for a transfer of remaining_kb, last record is shorter if record size
+    # does not divide evenly into remaining_kb
+
+    def get_record_layout(self, remaining_kb):
+        rszkb = self.get_record_size_to_use()
+        if remaining_kb == 0:
+            return (0, rszkb * self.BYTES_PER_KB, 0)
+        records = (remaining_kb + rszkb - 1) // rszkb
+        last_kb = remaining_kb - ((records - 1) * rszkb)
+        return (records, rszkb * self.BYTES_PER_KB, last_kb * self.BYTES_PER_KB)
+
+    # same as write_records() but submit up to iov_count records
+    # per os.pwritev() call, the file offset is tracked here
+    # so the write starts wherever the caller positioned fd (e.g. append)
+    # rq is still counted per record so IOPS are comparable with sync engine
+
+    def write_records_vectored(self, fd, remaining_kb):
+        (records, rszbytes, last_bytes) = self.get_record_layout(remaining_kb)
+        source = self.get_write_source(rszbytes)
+        iov = [source] * self.iov_count
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        done = 0
+        while done < records:
+            batch = min(self.iov_count, records - done)
+            next_iov = iov[0:batch]
+            tail = None
+            if done + batch == records:
+                next_iov[-1] = source[0:last_bytes]
+                if self.direct_io and last_bytes % self.direct_io_align:
+                    tail = next_iov.pop()
+            if next_iov:
+                expected = sum([len(record) for record in next_iov])
+                written = os.pwritev(fd, next_iov, offset)
+                if written != expected:
+                    raise MFRdWrExc(self.opname, self.filenum, self.rq + done, written)
+                offset += written
+            if tail is not None:
+                clear_direct_io(fd)
+                written = os.pwrite(fd, tail, offset)
+                if written != len(tail):
+                    raise MFRdWrExc(
+                        self.opname, self.filenum, self.rq + records - 1, written
+                    )
+                offset += written
+            done += batch
+        return records
+
+    # same as read_records() but read up to iov_count records
+    # per os.preadv() call into consecutive records of a preallocated buffer,
+    # then verify each record in place.
+    # with O_DIRECT, records start on block boundaries in the buffer,
+    # which only makes a difference for a file smaller than one block
+
+    def read_records_vectored(self, fd, remaining_kb):
+        (records, rszbytes, last_bytes) = self.get_record_layout(remaining_kb)
+        stride = self.get_read_transfer_size(rszbytes)
+        read_view = self.get_read_buf(stride * self.iov_count)
+        iov = [
+            read_view[k * stride : k * stride + rszbytes]
+            for k in range(0, self.iov_count)
+        ]
+        expected = self.buf[0:rszbytes]
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        done = 0
+        while done < records:
+            batch = min(self.iov_count, records - done)
+            next_iov = iov[0:batch]
+            expected_bytes = batch * rszbytes
+            if done + batch == records:
+                last_offset = (batch - 1) * stride
+                next_iov[-1] = read_view[
+                    last_offset : last_offset + self.get_read_transfer_size(last_bytes)
+                ]
+                expected_bytes -= rszbytes - last_bytes
+            bytesread = os.preadv(fd, next_iov, offset)
+            if bytesread < expected_bytes:
+                raise MFRdWrExc(self.opname, self.filenum, self.rq + done, bytesread)
+            if self.verify_read:
+                for k in range(0, batch):
+                    expected_record = expected
+                    if done + k == records - 1:
+                        expected_record = expected[0:last_bytes]
+                    if not buf_matches(self.read_buf, k * stride, expected_record):
+                        raise MFRdWrExc(
+                            "read: buffer contents matched up through byte %d"
+                            % first_mismatch(
+                                expected_record, next_iov[k][0 : len(expected_record)]
+                            ),
+                            self.filenum,
+                            self.rq + done + k,
+                            len(expected_record),
+                        )
+            offset += bytesread
+            done += batch
+        return records
+
+    # copy remaining_kb of data from self.buf into a writable mmap
+    # in records of get_record_size_to_use() KB, so pages are dirtied
+    # by page faults instead of write system calls
+    # returns the number of records written
+
+    def write_records_mmap(self, mm, remaining_kb):
+        (records, rszbytes, last_bytes) = self.get_record_layout(remaining_kb)
+        record = self.buf[0:rszbytes]
+        offset = 0
+        for k in range(0, records):
+            if k == records - 1:
+                record = record[0:last_bytes]
+            mm[offset : offset + len(record)] = record
+            offset += len(record)
+        return records
+
+    # access remaining_kb of data in a read-only mmap
+    # in records of get_record_size_to_use() KB,
+    # comparing each record in place against the expected pattern,
+    # or if not verifying, touching one byte in every page of the record
+    # returns the number of records accessed
+
+    def read_records_mmap(self, mm, remaining_kb):
+        (records, rszbytes, last_bytes) = self.get_record_layout(remaining_kb)
+        expected = self.buf[0:rszbytes]
+        offset = 0
+        for k in range(0, records):
+            if k == records - 1:
+                expected = expected[0:last_bytes]
+            next_offset = offset + len(expected)
+            if self.verify_read:
+                if not buf_matches(mm, offset, expected):
+                    raise MFRdWrExc(
+                        "read: buffer contents matched up through byte %d"
+                        % first_mismatch(expected, mm[offset:next_offset]),
+                        self.filenum,
+                        self.rq + k,
+                        len(expected),
+                    )
+            else:
+                for page_offset in range(offset, next_offset, mmap.PAGESIZE):
+                    mm[page_offset]
+            offset = next_offset
+        return records
+
     # determine record size to use in test
     # if record size is 0, that means to use largest possible value
     # we try to use the file size as the record size, but
     # if the biggest_buf_size is less than the file size, use it instead.
+    # with O_DIRECT, round it down to a multiple of the block size if possible
 
     def get_record_size_to_use(self):
         rszkb = self.record_sz_kb
@@ -1100,265 +2183,472 @@ class SmallfileWorkload:
             rszkb = self.total_sz_kb
         if rszkb > SmallfileWorkload.biggest_buf_size // self.BYTES_PER_KB:
             rszkb = SmallfileWorkload.biggest_buf_size // self.BYTES_PER_KB
+        if self.direct_io:
+            align_kb = self.direct_io_align // self.BYTES_PER_KB
+            if rszkb > align_kb:
+                rszkb -= rszkb % align_kb
         return rszkb
 
     # make all subdirectories needed for test in advance,
     # don't include in measurement
     # use set to avoid duplicating operations on directories
 
-    def make_all_subdirs(self):
-        self.log.debug("making all subdirs")
-        abort_filename = self.abort_fn()
-        if self.tid != "00" and self.is_shared_dir:
-            return
-        dirset = set()
+    # list every subdirectory of a per-thread top directory,
+    # grouped by depth so that each level can be created after its parent.
+    # this comes straight from the radix structure of directory names:
+    # directory index d holds files d * files_per_dir and up,
+    # and its parent directory is index d // dirs_per_dir,
+    # for both sequential and hashed names (see mk_seq_dir_name),
+    # so no file names need to be generated
 
-        # FIXME: we could check to see if
-        # self.dest_dirs is actually used before we include it
+    def subdir_levels(self):
+        if self.hash_to_dir:
+            last_dir_index = (self.iterations - 1) // self.files_per_dir
+        else:
+            last_dir_index = -(-self.iterations // self.files_per_dir)
+        names = []
+        levels = []
+        seen = set()
+        for d in range(0, last_dir_index + 1):
+            if self.hash_to_dir:
+                if d > 1:
+                    leaf = "h_" + str(d * self.some_prime % self.dirs_per_dir).zfill(3)
+                    parent = names[d // self.dirs_per_dir]
+                    name = parent + os.sep + leaf if parent else leaf
+                else:
+                    name = ""
+            elif d < self.dirs_per_dir:
+                name = "d_" + str(d).zfill(3)
+            else:
+                leaf = "d_" + str(d % self.dirs_per_dir).zfill(3)
+                name = names[d // self.dirs_per_dir] + os.sep + leaf
+            names.append(name)
+            if name and name not in seen:
+                seen.add(name)
+                depth = name.count(os.sep)
+                if depth == len(levels):
+                    levels.append([])
+                levels[depth].append(name)
+        return levels
+
+    # returns 1 if directory was created, 0 if it was already there
+
+    def make_one_dir(self, dpath):
+        try:
+            os.mkdir(dpath, 0o777)
+            if debug_timeout:
+                time.sleep(1)
+        except FileExistsError:
+            return 0
+        return 1
 
-        for tree in [self.src_dirs, self.dest_dirs]:
-            tree_range = range(0, len(tree))
+    # returns 1 if directory was removed, 0 if it was not there
+    # or could not be removed because it is in use (e.g. not empty)
 
-            # if we are hashing into directories,
-            # we can't make any assumptions about
-            # which directories will be used first
+    def remove_one_dir(self, dpath):
+        try:
+            os.rmdir(dpath)
+        except OSError as e:
+            err = e.errno
+            if err in [errno.ENOENT, errno.ENOTEMPTY, errno.EACCES, errno.EBUSY]:
+                return 0
+            self.log.error("deleting directory dpath: %s" % e)
+            if not self.is_shared_dir:
+                raise e
+            return 0
+        return 1
 
-            if self.hash_to_dir:
-                dir_range = range(0, self.iterations + 1)
-            else:
-                # optimization: if not hashing into directories,
-                # we put files_per_dir files into each directory, so
-                # we only need to check every files_per_dir filenames
-                # for a new directory name
-                dir_range = range(
-                    0, self.iterations + self.files_per_dir, self.files_per_dir
-                )
+    # run dir_op on every directory in the given (depth, level) list
+    # under every per-thread top directory, a level at a time,
+    # using dir_threads threads per level,
+    # and return how many directories it succeeded on
 
-            # we need this range because
-            # we need to create directories in each top dir
-            for k in tree_range:
-                for j in dir_range:
-                    fpath = self.mk_file_nm(tree, j + k)
-                    dpath = os.path.dirname(fpath)
-                    dirset.add(dpath)
+    def for_each_dir_level(self, levels, dir_op, verb):
+        abort_filename = self.abort_fn()
+        top_dirs = self.src_dirs + self.dest_dirs
+        done = 0
+        pool = None
+        if self.dir_threads > 1:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.dir_threads)
+        try:
+            for (depth, level) in levels:
+                if exists(abort_filename):
+                    break
+                dpaths = [t + os.sep + name for t in top_dirs for name in level]
+                if pool is None:
+                    level_done = sum(map(dir_op, dpaths))
+                else:
+                    level_done = sum(pool.map(dir_op, dpaths, chunksize=64))
+                done += level_done
+                self.log.info(
+                    "%s %d of %d directories at depth %d"
+                    % (verb, level_done, len(dpaths), depth + 1)
+                )
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return done
 
-        # since we put them into a set, duplicates are filtered out
+    # create every subdirectory before the test starts,
+    # parents first, and record how long it took
 
-        for unique_dpath in dirset:
-            if exists(abort_filename):
-                break
-            if not exists(unique_dpath):
-                try:
-                    os.makedirs(unique_dpath, 0o777)
-                    if debug_timeout:
-                        time.sleep(1)
-                except OSError as e:
-                    if not (e.errno == errno.EEXIST and self.is_shared_dir):
-                        raise e
+    def make_all_subdirs(self):
+        self.log.debug("making all subdirs")
+        if self.tid != "00" and self.is_shared_dir:
+            return
+        start_time = time.time()
+        for t in self.src_dirs + self.dest_dirs:
+            os.makedirs(t, 0o777, exist_ok=True)
+        levels = list(enumerate(self.subdir_levels()))
+        self.dirs_created = self.for_each_dir_level(
+            levels, self.make_one_dir, "created"
+        )
+        self.dir_create_time = time.time() - start_time
+        self.log.info(
+            "created %d directories in %f sec"
+            % (self.dirs_created, self.dir_create_time)
+        )
 
-    # clean up all subdirectories
-    # algorithm same as make_all_subdirs
+    # clean up all subdirectories, deepest first,
+    # so each directory is attempted exactly once,
+    # after all of its subdirectories, and record how long it took
 
     def clean_all_subdirs(self):
         self.log.debug("cleaning all subdirs")
         if self.tid != "00" and self.is_shared_dir:
             return
-        for tree in [self.src_dirs, self.dest_dirs]:
-            # for efficiency, when we are not using --hash-to-dirs option,
-            # we only make filename for every files_per_dir files
+        start_time = time.time()
+        levels = list(enumerate(self.subdir_levels()))
+        levels.reverse()
+        self.dirs_removed = self.for_each_dir_level(
+            levels, self.remove_one_dir, "removed"
+        )
+        self.dir_remove_time = time.time() - start_time
+        self.log.info(
+            "removed %d directories in %f sec"
+            % (self.dirs_removed, self.dir_remove_time)
+        )
 
-            if self.hash_to_dir:
-                dir_range = range(0, self.iterations + 1)
-            else:
-                dir_range = range(
-                    0, self.iterations + self.files_per_dir, self.files_per_dir
-                )
+    # remove the entries in one directory whose names are those of
+    # this thread's files, their renamed and symlinked versions and the
+    # directories made by the mkdir operation, and return how many
 
-            # construct set of directories
-
-            tree_range = range(0, len(tree))
-            dirset = set()
-            for k in tree_range:
-                for j in dir_range:
-                    fpath = self.mk_file_nm(tree, j + k)
-                    dpath = os.path.dirname(fpath)
-                    dirset.add(dpath)
-
-            # now clean them up if empty,
-            # and do this recursively on parent directories also
-            # until top directory or non-empty directory is reached
-
-            for unique_dpath in dirset:
-                # determine top directory (i.e. one of list passed in --top)
-                topdir = None
-                for t in tree:
-                    if unique_dpath.startswith(t):
-                        topdir = t
+    def unlink_thread_entries(self, dpath, file_prefix, file_suffix):
+        try:
+            with os.scandir(dpath) as it:
+                entries = [e for e in it if e.name.startswith(file_prefix)]
+        except FileNotFoundError:
+            return 0
+        removed = 0
+        for e in entries:
+            base = e.name
+            if not base.endswith(file_suffix):
+                for ext in [self.rename_suffix, ".s", ".d"]:
+                    if base.endswith(ext):
+                        base = base[: -len(ext)]
                         break
-                if not topdir:
-                    raise SMFRunException(
-                        "directory %s is not part of any top-level directory in %s"
-                        % (unique_dpath, str(tree))
-                    )
+            if not base.endswith(file_suffix):
+                continue
+            if not base[len(file_prefix) : -len(file_suffix)].isdigit():
+                continue
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    os.rmdir(e.path)
+                else:
+                    os.unlink(e.path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # another thread or host got there first
+        return removed
+
+    # cleanup without generating file names,
+    # list every directory in this thread's trees once, dir_threads at a time,
+    # and remove only what is there
+
+    def unlink_all_thread_entries(self):
+        start_time = time.time()
+        file_prefix = "_".join([self.prefix, self.onhost, self.tid]) + "_"
+        file_suffix = "_" + self.suffix
+        names = [""] + [name for level in self.subdir_levels() for name in level]
+        dpaths = [
+            t + os.sep + name if name else t
+            for t in self.src_dirs + self.dest_dirs
+            for name in names
+        ]
 
-                # delete this directory and
-                # parent directories if empty and below top
+        def unlink_dir_entries(dpath):
+            return self.unlink_thread_entries(dpath, file_prefix, file_suffix)
 
-                while len(unique_dpath) > len(topdir):
-                    if not exists(unique_dpath):
-                        unique_dpath = os.path.dirname(unique_dpath)
-                        continue
-                    else:
-                        try:
-                            os.rmdir(unique_dpath)
-                        except OSError as e:
-                            err = e.errno
-                            if err == errno.ENOTEMPTY:
-                                break
-                            if err == errno.EACCES:
-                                break
-                            if err == errno.EBUSY:  # might be mountpoint
-                                break
-                            self.log.error("deleting directory dpath: %s" % e)
-                            if err != errno.ENOENT and not self.is_shared_dir:
-                                raise e
-                        unique_dpath = os.path.dirname(unique_dpath)
-                        if len(unique_dpath) <= len(self.src_dirs[0]):
-                            break
+        if self.dir_threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.dir_threads
+            ) as pool:
+                removed = sum(pool.map(unlink_dir_entries, dpaths))
+        else:
+            removed = sum(map(unlink_dir_entries, dpaths))
+        self.log.info(
+            "removed %d entries from %d directories in %f sec"
+            % (removed, len(dpaths), time.time() - start_time)
+        )
 
     # operation-specific test code goes in do_<opname>()
     # whatever record size sequence we use in do_create
     # must also be attempted in do_read
 
+    # run file_op on every file in the test, file_op is called as
+    #   file_op(invoke, pathname, file size in KB)
+    # and returns the number of records transferred.
+    # with iodepth > 1, up to iodepth files are kept in flight by a
+    # per-worker thread pool, each pool thread runs file_op on its own copy
+    # of this object, so per-file state (filenum, buffers) is not shared.
+    # file names and file sizes are still generated here in file number order,
+    # so file contents do not depend on iodepth, and counters, response times
+    # and auto-pause are updated here as each file completes
+    # if run by the asyncio worker engine, this returns a coroutine instead
+
+    def do_file_ops(self, file_op, dirs):
+        if self.async_executor is not None:
+            return self.do_file_ops_async(file_op, dirs)
+        if self.iodepth == 1:
+            while self.do_another_file():
+                fn = self.mk_file_nm(dirs)
+                self.op_starttime()
+                self.rq += file_op(self, fn, self.get_next_file_size())
+                self.op_endtime(self.opname)
+            return
+
+        lanes = self.make_lanes()
+        in_flight = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.iodepth
+            ) as pool:
+                while True:
+                    if self.can_start_file(len(in_flight)):
+                        if self.do_another_file():
+                            lane = lanes.pop()
+                            lane.filenum = self.filenum
+                            fn = self.mk_file_nm(dirs)
+                            next_fsz = self.get_next_file_size()
+                            future = pool.submit(
+                                timed_file_op, file_op, lane, fn, next_fsz
+                            )
+                            in_flight[future] = lane
+                            continue
+                        if not in_flight:
+                            break
+                    (done, _) = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        lanes.append(in_flight.pop(future))
+                        self.file_op_done(future.result())
+        finally:
+            self.release_lanes(lanes + list(in_flight.values()))
+
+    # same as do_file_ops but this worker is a coroutine,
+    # file ops are done by the executor shared by all workers in the process
+    # so the event loop is never blocked by the filesystem
+
+    async def do_file_ops_async(self, file_op, dirs):
+        loop = asyncio.get_running_loop()
+        lanes = [self] if self.iodepth == 1 else self.make_lanes()
+        in_flight = {}
+        try:
+            while True:
+                if self.can_start_file(len(in_flight)):
+                    if self.do_another_file():
+                        if self.async_pause_sec > 0.0:
+                            await asyncio.sleep(self.async_pause_sec)
+                            self.async_pause_sec = 0.0
+                        lane = lanes.pop()
+                        lane.filenum = self.filenum
+                        fn = self.mk_file_nm(dirs)
+                        next_fsz = self.get_next_file_size()
+                        future = loop.run_in_executor(
+                            self.async_executor,
+                            timed_file_op,
+                            file_op,
+                            lane,
+                            fn,
+                            next_fsz,
+                        )
+                        in_flight[future] = lane
+                        continue
+                    if not in_flight:
+                        break
+                (done, _) = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    lanes.append(in_flight.pop(future))
+                    self.file_op_done(future.result())
+        finally:
+            # if a file op failed, let the others finish before returning
+            if in_flight:
+                await asyncio.wait(in_flight)
+            self.release_lanes(lanes + list(in_flight.values()))
+
+    # make one copy of this object for each file in flight
+
+    def make_lanes(self):
+        lanes = []
+        for k in range(0, self.iodepth):
+            lane = copy.copy(self)
+            lane.buf = None
+            lane.read_buf = None
+            lane.write_buf = None
+            if self.dir_fds is not None:
+                lane.dir_fds = dir_fd_cache(self.dir_fd_cache_size)
+            lanes.append(lane)
+        return lanes
+
+    # close directory fds opened by lanes, keeping their cache counters
+
+    def release_lanes(self, lanes):
+        for lane in lanes:
+            if lane is not self and lane.dir_fds is not None:
+                lane.dir_fds.close(self.dir_fds)
+
+    # can another file be started when in_flight files are in flight?
+    # do_another_file() ends the test when the last file is started,
+    # so files in flight must complete before asking it that
+
+    def can_start_file(self, in_flight):
+        if in_flight >= self.iodepth:
+            return False
+        return self.filenum < self.iterations or in_flight == 0
+
+    # account for a file op done by timed_file_op() in another thread
+
+    def file_op_done(self, result):
+        (records, start_time, end_time) = result
+        self.rq += records
+        self.op_starttime(start_time)
+        self.op_endtime(self.opname, end_time)
+
+    def create_file(self, fn, remaining_kb):
+        fd = -1
+        try:
+            fd = self.open_data_file(
+                fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY | O_BINARY
+            )
+            if fd < 0:
+                self.log.error("failed to open file %s" % fn)
+                raise MFRdWrExc(self.opname, self.filenum, 0, 0)
+            self.prepare_buf()
+            records = self.write_records(fd, remaining_kb)
+            if self.record_ctime_size:
+                remember_ctime_size_xattr(fd)
+        except OSError as e:
+            if e.errno == errno.ENOENT and self.dirs_on_demand:
+                # retry this file now that dir. exists
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                return self.create_file(fn, remaining_kb)
+            raise e
+        finally:
+            if fd >= 0:
+                if self.fsync:
+                    os.fsync(fd)
+                os.close(fd)
+        return records
+
     def do_create(self):
         if self.record_ctime_size and not xattr_installed:
             raise SMFRunException(
                 "no python xattr module, cannot record create time + size"
             )
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            fd = -1
-            try:
-                fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY | O_BINARY)
-                if fd < 0:
-                    self.log.error("failed to open file %s" % fn)
-                    raise MFRdWrExc(self.opname, self.filenum, 0, 0)
-                remaining_kb = self.get_next_file_size()
-                self.prepare_buf()
-                rszkb = self.get_record_size_to_use()
-                while remaining_kb > 0:
-                    next_kb = min(rszkb, remaining_kb)
-                    rszbytes = next_kb * self.BYTES_PER_KB
-                    written = os.write(fd, self.buf[0:rszbytes])
-                    if written != rszbytes:
-                        raise MFRdWrExc(self.opname, self.filenum, self.rq, written)
-                    self.rq += 1
-                    remaining_kb -= next_kb
-                if self.record_ctime_size:
-                    remember_ctime_size_xattr(fd)
-            except OSError as e:
-                if e.errno == errno.ENOENT and self.dirs_on_demand:
-                    os.makedirs(os.path.dirname(fn))
-                    self.filenum -= 1  # retry this file now that dir. exists
-                    continue
-                self.status = e.errno
-                raise e
-            finally:
-                if fd >= 0:
-                    if self.fsync:
-                        os.fsync(fd)
-                    os.close(fd)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.create_file, self.src_dirs)
+
+    def make_dir(self, fn, file_size_kb):
+        try:
+            (dfd, name) = self.at_dir(fn)
+            os.mkdir(name + ".d", dir_fd=dfd)
+        except OSError as e:
+            if e.errno == errno.ENOENT and self.dirs_on_demand:
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                return self.make_dir(fn, file_size_kb)
+            raise e
+        return 0
 
     def do_mkdir(self):
-        while self.do_another_file():
-            dir = self.mk_file_nm(self.src_dirs) + ".d"
-            self.op_starttime()
-            try:
-                os.mkdir(dir)
-            except OSError as e:
-                if e.errno == errno.ENOENT and self.dirs_on_demand:
-                    os.makedirs(os.path.dirname(dir))
-                    self.filenum -= 1
-                    continue
-                raise e
-            finally:
-                self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.make_dir, self.src_dirs)
+
+    def remove_dir(self, fn, file_size_kb):
+        (dfd, name) = self.at_dir(fn)
+        os.rmdir(name + ".d", dir_fd=dfd)
+        return 0
 
     def do_rmdir(self):
-        while self.do_another_file():
-            dir = self.mk_file_nm(self.src_dirs) + ".d"
-            self.op_starttime()
-            os.rmdir(dir)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.remove_dir, self.src_dirs)
+
+    def symlink_file(self, fn, file_size_kb):
+        (dfd, name) = self.at_dir(self.mk_file_nm(self.dest_dirs))
+        os.symlink(fn, name + ".s", dir_fd=dfd)
+        return 0
 
     def do_symlink(self):
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            fn2 = self.mk_file_nm(self.dest_dirs) + ".s"
-            self.op_starttime()
-            os.symlink(fn, fn2)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.symlink_file, self.src_dirs)
+
+    def stat_file(self, fn, file_size_kb):
+        (dfd, name) = self.at_dir(fn)
+        os.stat(name, dir_fd=dfd)
+        return 0
 
     def do_stat(self):
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            os.stat(fn)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.stat_file, self.src_dirs)
+
+    def chmod_file(self, fn, file_size_kb):
+        (dfd, name) = self.at_dir(fn)
+        os.chmod(name, 0o646, dir_fd=dfd)
+        return 0
 
     def do_chmod(self):
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            os.chmod(fn, 0o646)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.chmod_file, self.src_dirs)
 
     # we use "prefix" parameter to provide a list of characters
     # to use as extended attribute name suffixes
     # so that we can do multiple xattr operations per node
 
+    def getxattr_file(self, fn, file_size_kb):
+        self.prepare_buf()
+        for j in range(0, self.xattr_count):
+            v = xattr.getxattr(fn, "user.smallfile-%d" % j)
+            if self.buf[j : self.xattr_size + j] != v:
+                raise MFRdWrExc(
+                    "getxattr: value contents wrong", self.filenum, j, len(v)
+                )
+        return 0
+
     def do_getxattr(self):
         if not xattr_installed:
             raise SMFRunException(
                 "xattr module not present, getxattr and setxattr operations will not work"
             )
-
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            self.prepare_buf()
-            for j in range(0, self.xattr_count):
-                v = xattr.getxattr(fn, "user.smallfile-%d" % j)
-                if self.buf[j : self.xattr_size + j] != v:
-                    raise MFRdWrExc(
-                        "getxattr: value contents wrong", self.filenum, j, len(v)
-                    )
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.getxattr_file, self.src_dirs)
+
+    def setxattr_file(self, fn, file_size_kb):
+        self.prepare_buf()
+        (dfd, name) = self.at_dir(fn)
+        fd = os.open(name, os.O_WRONLY | O_BINARY, dir_fd=dfd)
+        for j in range(0, self.xattr_count):
+            # make sure each xattr has a unique value
+            xattr.setxattr(
+                fd,
+                "user.smallfile-%d" % j,
+                binary_buf_str(self.buf[j : self.xattr_size + j]),
+            )
+        if self.fsync:  # fsync also flushes xattr values and metadata
+            os.fsync(fd)
+        os.close(fd)
+        return 0
 
     def do_setxattr(self):
         if not xattr_installed:
             raise SMFRunException(
                 "xattr module not present, getxattr and setxattr operations will not work"
             )
-
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.prepare_buf()
-            self.op_starttime()
-            fd = os.open(fn, os.O_WRONLY | O_BINARY)
-            for j in range(0, self.xattr_count):
-                # make sure each xattr has a unique value
-                xattr.setxattr(
-                    fd,
-                    "user.smallfile-%d" % j,
-                    binary_buf_str(self.buf[j : self.xattr_size + j]),
-                )
-            if self.fsync:  # fsync also flushes xattr values and metadata
-                os.fsync(fd)
-            os.close(fd)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.setxattr_file, self.src_dirs)
 
     def do_append(self):
         return self.do_write(append=True)
@@ -1369,6 +2659,29 @@ class SmallfileWorkload:
     def do_truncate_overwrite(self):
         return self.do_write(truncate=True)
 
+    def write_file(self, fn, remaining_kb, append=False, truncate=False):
+        fd = -1
+        try:
+            # don't use O_APPEND, it has different semantics!
+            open_mode = os.O_WRONLY | O_BINARY
+            if truncate:
+                open_mode |= os.O_TRUNC
+            fd = self.open_data_file(fn, open_mode)
+            if append:
+                offset = os.lseek(fd, 0, os.SEEK_END)
+                if self.direct_io and offset % self.direct_io_align:
+                    clear_direct_io(fd)
+            self.prepare_buf()
+            records = self.write_records(fd, remaining_kb)
+            if self.record_ctime_size:
+                remember_ctime_size_xattr(fd)
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            if fd >= 0:
+                os.close(fd)
+        return records
+
     def do_write(self, append=False, truncate=False):
         if self.record_ctime_size and not xattr_installed:
             raise SMFRunException(
@@ -1376,86 +2689,101 @@ class SmallfileWorkload:
             )
         if append and truncate:
             raise SMFRunException("can not append and truncate at the same time")
+        return self.do_file_ops(
+            lambda invk, fn, remaining_kb: invk.write_file(
+                fn, remaining_kb, append, truncate
+            ),
+            self.src_dirs,
+        )
 
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            fd = -1
-            try:
-                # don't use O_APPEND, it has different semantics!
-                open_mode = os.O_WRONLY | O_BINARY
-                if truncate:
-                    open_mode |= os.O_TRUNC
-                fd = os.open(fn, open_mode)
-                if append:
-                    os.lseek(fd, 0, os.SEEK_END)
-                remaining_kb = self.get_next_file_size()
-                self.prepare_buf()
-                rszkb = self.get_record_size_to_use()
-                while remaining_kb > 0:
-                    next_kb = min(remaining_kb, rszkb)
-                    rszbytes = next_kb * self.BYTES_PER_KB
-                    written = os.write(fd, self.buf[0:rszbytes])
-                    self.rq += 1
-                    if written != rszbytes:
-                        raise MFRdWrExc(self.opname, self.filenum, self.rq, written)
-                    remaining_kb -= next_kb
-                if self.record_ctime_size:
-                    remember_ctime_size_xattr(fd)
+    # same as create_file but file data is written through a shared mapping
+    # of the file, after setting the file size with ftruncate()
+
+    def create_file_mmap(self, fn, remaining_kb):
+        fd = -1
+        records = 0
+        try:
+            (dfd, name) = self.at_dir(fn)
+            fd = os.open(
+                name, os.O_CREAT | os.O_EXCL | os.O_RDWR | O_BINARY, dir_fd=dfd
+            )
+            self.prepare_buf()
+            if remaining_kb > 0:
+                os.ftruncate(fd, remaining_kb * self.BYTES_PER_KB)
+                mm = mmap.mmap(
+                    fd, remaining_kb * self.BYTES_PER_KB, access=mmap.ACCESS_WRITE
+                )
+                try:
+                    records = self.write_records_mmap(mm, remaining_kb)
+                    if self.fsync:
+                        mm.flush()
+                finally:
+                    mm.close()
+            if self.record_ctime_size:
+                remember_ctime_size_xattr(fd)
+        except OSError as e:
+            if e.errno == errno.ENOENT and self.dirs_on_demand:
+                # retry this file now that dir. exists
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                return self.create_file_mmap(fn, remaining_kb)
+            raise e
+        finally:
+            if fd >= 0:
                 if self.fsync:
                     os.fsync(fd)
-            finally:
-                if fd >= 0:
-                    os.close(fd)
-            self.op_endtime(self.opname)
+                os.close(fd)
+        return records
+
+    def do_create_mmap(self):
+        if self.record_ctime_size and not xattr_installed:
+            raise SMFRunException(
+                "no python xattr module, cannot record create time + size"
+            )
+        return self.do_file_ops(SmallfileWorkload.create_file_mmap, self.src_dirs)
+
+    def read_file(self, fn, next_fsz):
+        fd = -1
+        try:
+            fd = self.open_data_file(fn, os.O_RDONLY | O_BINARY)
+            self.prepare_buf()
+            if self.verbose:
+                self.log.debug("read fn %s next_fsz %u" % (fn, next_fsz))
+            return self.read_records(fd, next_fsz)
+        finally:
+            if fd > -1:
+                os.close(fd)
 
     def do_read(self):
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            fd = -1
+        return self.do_file_ops(SmallfileWorkload.read_file, self.src_dirs)
+
+    # same as read_file but file data is accessed through a read-only mapping
+
+    def read_file_mmap(self, fn, next_fsz):
+        fd = -1
+        try:
+            (dfd, name) = self.at_dir(fn)
+            fd = os.open(name, os.O_RDONLY | O_BINARY, dir_fd=dfd)
+            self.prepare_buf()
+            if next_fsz == 0:
+                return 0
             try:
-                next_fsz = self.get_next_file_size()
-                fd = os.open(fn, os.O_RDONLY | O_BINARY)
-                self.prepare_buf()
-                rszkb = self.get_record_size_to_use()
-                remaining_kb = next_fsz
-                while remaining_kb > 0:
-                    next_kb = min(rszkb, remaining_kb)
-                    rszbytes = next_kb * self.BYTES_PER_KB
-                    bytesread = os.read(fd, rszbytes)
-                    self.rq += 1
-                    if len(bytesread) != rszbytes:
-                        raise MFRdWrExc(
-                            self.opname, self.filenum, self.rq, len(bytesread)
-                        )
-                    if self.verify_read:
-                        # this is in fast path so avoid evaluating self.log.debug
-                        # unless people really want to see it
-                        if self.verbose:
-                            self.log.debug(
-                                "read fn %s next_fsz %u remain %u rszbytes %u bytesread %u"
-                                % (fn, next_fsz, remaining_kb, rszbytes, len(bytesread))
-                            )
-                        if self.buf[0:rszbytes] != bytesread:
-                            bytes_matched = len(bytesread)
-                            for k in range(0, rszbytes):
-                                if self.buf[k] != bytesread[k]:
-                                    bytes_matched = k
-                                    break
-                            # self.log.debug('front of read buffer: %s' % bytesread.hex()[0:40])
-                            raise MFRdWrExc(
-                                "read: buffer contents matched up through byte %d"
-                                % bytes_matched,
-                                self.filenum,
-                                self.rq,
-                                len(bytesread),
-                            )
-                    remaining_kb -= next_kb
+                mm = mmap.mmap(
+                    fd, next_fsz * self.BYTES_PER_KB, access=mmap.ACCESS_READ
+                )
+            except ValueError:  # file is shorter than expected
+                raise MFRdWrExc(
+                    self.opname, self.filenum, self.rq, os.fstat(fd).st_size
+                )
+            try:
+                return self.read_records_mmap(mm, next_fsz)
             finally:
-                if fd > -1:
-                    os.close(fd)
-            self.op_endtime(self.opname)
+                mm.close()
+        finally:
+            if fd > -1:
+                os.close(fd)
+
+    def do_read_mmap(self):
+        return self.do_file_ops(SmallfileWorkload.read_file_mmap, self.src_dirs)
 
     def do_readdir(self):
         if self.hash_to_dir:
@@ -1557,6 +2885,51 @@ class SmallfileWorkload:
                     0,
                 )
 
+    # same as ls-l, but directories are listed with os.scandir(),
+    # whose entries carry the file type so it needs no stat to skip
+    # subdirectories, and whose stat() result is cached in the entry
+
+    def do_ls_l_scandir(self):
+        if self.hash_to_dir:
+            raise SMFRunException("cannot do readdir test with --hash-into-dirs option")
+        prev_dir = ""
+        dir_map = {}
+        while self.do_another_file():
+            fn = self.mk_file_nm(self.src_dirs)
+            dir = os.path.dirname(fn)
+            common_dir = None
+            for d in self.top_dirs:
+                if dir.startswith(d):
+                    common_dir = dir[len(self.top_dirs[0]) :]
+                    break
+            if not common_dir:
+                raise SMFRunException(
+                    "ls-l-scandir: filename %s is not in any top dir in %s"
+                    % (fn, str(self.top_dirs))
+                )
+            if common_dir != prev_dir:
+                self.op_starttime()
+                dir_map = {}
+                for t in self.top_dirs:
+                    with os.scandir(t + common_dir) as entries:
+                        for e in entries:
+                            if e.is_file(follow_symlinks=False):
+                                dir_map[e.name] = e  # only include files
+                self.op_endtime(self.opname + "-readdir")
+                prev_dir = common_dir
+            entry = dir_map.get(os.path.basename(fn))
+            if entry is None:
+                raise MFRdWrExc(
+                    "ls-l-scandir: file missing from directory %s" % prev_dir,
+                    self.filenum,
+                    self.rq,
+                    0,
+                )
+            # per-file stat timing separate readdir timing
+            self.op_starttime()
+            entry.stat(follow_symlinks=False)
+            self.op_endtime(self.opname + "-stat")
+
     # await-create is used for Gluster (async) geo-replication testing
     # instead of creating the files, we wait for them to appear
     # (e.g. on the slave geo-rep volume)
@@ -1592,35 +2965,37 @@ class SmallfileWorkload:
             self.op_starttime(starttime=original_ctime)
             self.op_endtime(self.opname)
 
+    def rename_file(self, fn, file_size_kb):
+        fn2 = self.mk_file_nm(self.dest_dirs)
+        if self.dest_dirs == self.src_dirs:
+            fn2 = fn2 + self.rename_suffix
+        (dfd, name) = self.at_dir(fn)
+        (dfd2, name2) = self.at_dir(fn2)
+        os.rename(name, name2, src_dir_fd=dfd, dst_dir_fd=dfd2)
+        return 0
+
     def do_rename(self):
-        in_same_dir = self.dest_dirs == self.src_dirs
-        while self.do_another_file():
-            fn1 = self.mk_file_nm(self.src_dirs)
-            fn2 = self.mk_file_nm(self.dest_dirs)
-            if in_same_dir:
-                fn2 = fn2 + self.rename_suffix
-            self.op_starttime()
-            os.rename(fn1, fn2)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.rename_file, self.src_dirs)
+
+    def delete_file(self, fn, file_size_kb):
+        (dfd, name) = self.at_dir(fn)
+        os.unlink(name, dir_fd=dfd)
+        return 0
 
     def do_delete(self):
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.src_dirs)
-            self.op_starttime()
-            os.unlink(fn)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.delete_file, self.src_dirs)
 
     # we only need this method because filenames after rename are different,
 
+    def delete_renamed_file(self, fn, file_size_kb):
+        if self.dest_dirs == self.src_dirs:
+            fn = fn + self.rename_suffix
+        (dfd, name) = self.at_dir(fn)
+        os.unlink(name, dir_fd=dfd)
+        return 0
+
     def do_delete_renamed(self):
-        in_same_dir = self.dest_dirs == self.src_dirs
-        while self.do_another_file():
-            fn = self.mk_file_nm(self.dest_dirs)
-            if in_same_dir:
-                fn = fn + self.rename_suffix
-            self.op_starttime()
-            os.unlink(fn)
-            self.op_endtime(self.opname)
+        return self.do_file_ops(SmallfileWorkload.delete_renamed_file, self.dest_dirs)
 
     # this operation tries to emulate a OpenStack Swift GET request behavior
 
@@ -1635,37 +3010,11 @@ class SmallfileWorkload:
             next_fsz = self.get_next_file_size()
             self.op_starttime()
             fd = os.open(fn, os.O_RDONLY | O_BINARY)
-            rszkb = self.get_record_size_to_use()
-            remaining_kb = next_fsz
             self.prepare_buf()
             try:
-                while remaining_kb > 0:
-                    next_kb = min(rszkb, remaining_kb)
-                    rszbytes = next_kb * self.BYTES_PER_KB
-                    self.log.debug(
-                        "swift_get fd %d next_fsz %u remain %u rszbytes %u "
-                        % (fd, next_fsz, remaining_kb, rszbytes)
-                    )
-                    bytesread = os.read(fd, rszbytes)
-                    if len(bytesread) != rszbytes:
-                        raise MFRdWrExc(
-                            self.opname, self.filenum, self.rq, len(bytesread)
-                        )
-                    if self.verify_read:
-                        if self.verbose:
-                            self.log.debug("swift_get bytesread %u" % len(bytesread))
-                        if self.buf[0:rszbytes] != bytesread:
-                            xpct_buf = self.buf[0:rszbytes]
-                            self.log.debug("expect buf: " + binary_buf_str(xpct_buf))
-                            self.log.debug("saw buf: " + binary_buf_str(bytesread))
-                            raise MFRdWrExc(
-                                "read: buffer contents wrong",
-                                self.filenum,
-                                self.rq,
-                                len(bytesread),
-                            )
-                    remaining_kb -= next_kb
-                    self.rq += 1
+                if self.verbose:
+                    self.log.debug("swift_get fd %d next_fsz %u" % (fd, next_fsz))
+                self.rq += self.read_records(fd, next_fsz)
                 for j in range(0, self.xattr_count):
                     try:
                         v = xattr.getxattr(fd, "user.smallfile-all-%d" % j)
@@ -1698,31 +3047,9 @@ class SmallfileWorkload:
                 ret = fallocate.fallocate(fd, 0, 0, fszbytes)
                 if ret != OK:
                     raise SMFRunException("fallocate call returned %d" % ret)
-                rszkb = self.get_record_size_to_use()
-                remaining_kb = next_fsz
-                while remaining_kb > 0:
-                    next_kb = min(rszkb, remaining_kb)
-                    rszbytes = next_kb * self.BYTES_PER_KB
-                    self.log.debug("reading %d bytes" % rszbytes)
-                    if rszbytes != len(self.buf):
-                        self.log.debug(
-                            "swift put self.buf: "
-                            + binary_buf_str(self.buf[0:rszbytes])
-                        )
-                        written = os.write(fd, self.buf[0:rszbytes])
-                    else:
-                        self.log.debug(
-                            "swift put entire self.buf: "
-                            + binary_buf_str(self.buf[0:rszbytes])
-                        )
-                        written = os.write(fd, self.buf[:])
-                    if written != rszbytes:
-                        self.log.error(
-                            "written byte count %u not correct byte count %u"
-                            % (written, rszbytes)
-                        )
-                        raise MFRdWrExc(self.opname, self.filenum, self.rq, written)
-                    remaining_kb -= next_kb
+                if self.verbose:
+                    self.log.debug("swift put %d KB" % next_fsz)
+                self.write_records(fd, next_fsz)
                 for j in range(0, self.xattr_count):
                     xattr_nm = "user.smallfile-all-%d" % j
                     try:
@@ -1774,18 +3101,16 @@ class SmallfileWorkload:
         self.stonewall = False
         save_finish = self.finish_all_rq
         self.finish_all_rq = True
+        if self.cleanup_scan:
+            self.unlink_all_thread_entries()
+            self.filenum = self.iterations
+            self.end_test()
         while self.do_another_file():
-            sym = self.mk_file_nm(self.dest_dirs) + ".s"
-            ensure_deleted(sym)
-            basenm = self.mk_file_nm(self.src_dirs)
-            fn = basenm
-            ensure_deleted(fn)
-            fn += self.rename_suffix
-            ensure_deleted(fn)
-            fn = self.mk_file_nm(self.dest_dirs)
-            ensure_deleted(fn)
-            fn = basenm + self.rename_suffix
-            ensure_deleted(fn)
+            (basenm, dest_fn) = self.file_names.mk_src_dest_nms(self.filenum)
+            ensure_deleted(dest_fn + ".s")
+            ensure_deleted(basenm)
+            ensure_deleted(basenm + self.rename_suffix)
+            ensure_deleted(dest_fn)
             dir = basenm + ".d"
             if os.path.exists(dir):
                 os.rmdir(dir)
@@ -1806,44 +3131,57 @@ class SmallfileWorkload:
             )
             time.sleep(total_sleep_time)
 
-    def do_workload(self):
+    # everything done by a thread before it reaches the starting gate
+
+    def prepare_workload(self):
         self.reset()
-        for j in range(0, self.iterations + self.files_per_dir):
-            self.file_dirs.append(self.mk_dir_name(j))
         self.start_log()
         self.log.info("do_workload: " + str(self))
         ensure_dir_exists(self.network_dir)
-        if ["create", "mkdir", "swift-put"].__contains__(self.opname):
+        if ["create", "create-mmap", "mkdir", "swift-put"].__contains__(self.opname):
             self.make_all_subdirs()
         # create_biggest_buf() depends on init_random_seed()
         self.init_random_seed()
-        self.biggest_buf = self.create_biggest_buf(False)
-        if self.total_sz_kb > 0:
-            self.files_between_checks = max(
-                10, int(self.max_files_between_checks - self.total_sz_kb / 100)
-            )
-        try:
-            self.wait_for_gate()
-            self.start_time = time.time()
-            o = self.opname
-            func = SmallfileWorkload.workloads[o]
-            func(self)  # call the do_ function for that workload type
-        except KeyError as e:
-            self.log.error("invalid workload type " + o)
-            self.status = e.ENOKEY
-        except KeyboardInterrupt as e:
+        if self.shared_buf is None:
+            self.biggest_buf = memoryview(self.create_biggest_buf(False)).toreadonly()
+        if self.dir_fd_cache_size > 0:
+            self.dir_fds = dir_fd_cache(self.dir_fd_cache_size)
+
+    # exceptions that end a thread's workload early are recorded in its status
+
+    workload_exceptions = (KeyError, KeyboardInterrupt, OSError, MFRdWrExc)
+
+    def workload_exception(self, e):
+        if isinstance(e, KeyError):
+            self.log.error("invalid workload type " + self.opname)
+            self.status = errno.ENOKEY
+        elif isinstance(e, KeyboardInterrupt):
             self.log.error("control-C (SIGINT) signal received, ending test")
-            self.status = e.EINTR
-        except OSError as e:
+            self.status = errno.EINTR
+        elif isinstance(e, OSError):
             self.status = e.errno
             self.log.error("OSError status %d seen" % e.errno)
             self.log.exception(e)
-        except MFRdWrExc as e:
+        else:
             self.status = errno.EIO
             self.log.error("MFRdWrExc seen")
             self.log.exception(e)
+
+    # everything done by a thread after its workload is done
+
+    def finish_workload(self):
         if self.measure_rsptimes:
             self.save_rsptimes()
+        if self.dir_fds is not None:
+            self.dir_fds.close()
+            self.dir_fd_hits = self.dir_fds.hits
+            self.dir_fd_misses = self.dir_fds.misses
+            self.dir_fd_evictions = self.dir_fds.evictions
+            self.dir_fds = None
+            self.log.info(
+                "directory fd cache: %d hits, %d misses, %d evictions"
+                % (self.dir_fd_hits, self.dir_fd_misses, self.dir_fd_evictions)
+            )
         if self.status != ok:
             self.log.error("invocation did not complete cleanly")
         if self.filenum != self.iterations:
@@ -1855,6 +3193,17 @@ class SmallfileWorkload:
 
         return self.status
 
+    def do_workload(self):
+        self.prepare_workload()
+        try:
+            self.wait_for_gate()
+            self.start_time = time.time()
+            func = SmallfileWorkload.workloads[self.opname]
+            func(self)  # call the do_ function for that workload type
+        except self.workload_exceptions as e:
+            self.workload_exception(e)
+        return self.finish_workload()
+
     # we look up the function for the workload type
     # by workload name in this dictionary (hash table)
 
@@ -1866,6 +3215,7 @@ class SmallfileWorkload:
         "rmdir": do_rmdir,
         "readdir": do_readdir,
         "ls-l": do_ls_l,
+        "ls-l-scandir": do_ls_l_scandir,
         "stat": do_stat,
         "getxattr": do_getxattr,
         "setxattr": do_setxattr,
@@ -1880,6 +3230,8 @@ class SmallfileWorkload:
         "swift-put": do_swift_put,
         "swift-get": do_swift_get,
         "await-create": do_await_create,
+        "create-mmap": do_create_mmap,
+        "read-mmap": do_read_mmap,
     }
 
 
@@ -2006,9 +3358,151 @@ if unittest_module:
             os.unlink(fn)
             self.assertTrue(not exists(fn))
 
+        # file_dirs must give the same names as mk_dir_name()
+        # but store each directory's name only once
+
+        def test_a1_lazy_file_dirs(self):
+            ivk = self.invok
+            ivk.iterations = 1000
+            ivk.files_per_dir = 7
+            ivk.dirs_per_dir = 3
+            for hash_to_dir in [False, True]:
+                ivk.hash_to_dir = hash_to_dir
+                ivk.reset()
+                for j in range(0, ivk.iterations + ivk.files_per_dir):
+                    self.assertTrue(ivk.file_dirs[j] == ivk.mk_dir_name(j))
+                # one entry per directory, not per file
+                dir_count = (
+                    ivk.iterations + ivk.files_per_dir - 1
+                ) // ivk.files_per_dir + 1
+                self.assertTrue(len(ivk.file_dirs.names) <= dir_count)
+
+        # cached file names must match names built from scratch,
+        # with more than one top directory, and after thread ID changes
+
+        def test_a2_file_name_generator(self):
+            ivk = self.invok
+            ivk.set_top(["/var/tmp/smf_a", "/var/tmp/smf_b", "/var/tmp/smf_c"])
+            ivk.iterations = 200
+            for (hash_to_dir, tid) in [(False, "regtest"), (True, "regtest2")]:
+                ivk.hash_to_dir = hash_to_dir
+                ivk.tid = tid
+                ivk.reset()
+                for j in range(0, ivk.iterations + 1):
+                    for tree in [ivk.src_dirs, ivk.dest_dirs]:
+                        expected = os.sep.join(
+                            [
+                                tree[j % len(tree)],
+                                ivk.mk_dir_name(j),
+                                "%s_%s_%s_%d_%s"
+                                % (ivk.prefix, ivk.onhost, tid, j, ivk.suffix),
+                            ]
+                        )
+                        self.assertTrue(ivk.mk_file_nm(tree, j) == expected)
+                    self.assertTrue(
+                        ivk.file_names.mk_src_dest_nms(j)
+                        == (
+                            ivk.mk_file_nm(ivk.src_dirs, j),
+                            ivk.mk_file_nm(ivk.dest_dirs, j),
+                        )
+                    )
+
+        # directories derived from directory indices must be exactly
+        # the directories that files go in, plus their parents,
+        # and each level must only contain children of the level above
+
+        def test_a3_subdir_levels(self):
+            ivk = self.invok
+            for (hash_to_dir, files, files_per_dir, dirs_per_dir) in [
+                (False, 1000, 7, 3),
+                (False, 50, 5, 2),
+                (False, 10, 100, 10),
+                (True, 1000, 7, 3),
+                (True, 500, 5, 4),
+            ]:
+                ivk.hash_to_dir = hash_to_dir
+                ivk.iterations = files
+                ivk.files_per_dir = files_per_dir
+                ivk.dirs_per_dir = dirs_per_dir
+                ivk.reset()
+                expected = set()
+                for j in range(0, ivk.iterations + 1):
+                    d = ivk.mk_dir_name(j)
+                    while d:
+                        expected.add(d)
+                        d = os.path.dirname(d)
+                levels = ivk.subdir_levels()
+                found = set()
+                for (depth, level) in enumerate(levels):
+                    for d in level:
+                        self.assertTrue(d.count(os.sep) == depth)
+                        if depth > 0:
+                            self.assertTrue(os.path.dirname(d) in levels[depth - 1])
+                    found.update(level)
+                if hash_to_dir:
+                    self.assertTrue(found == expected)
+                else:
+                    # the directory for the file after the last one is made too
+                    self.assertTrue(expected <= found)
+                    self.assertTrue(len(found - expected) <= 1)
+
         def test_b_Cleanup(self):
             self.cleanup_files()
 
+        def test_b1_parallel_dir_tree(self):
+            ivk = self.invok
+            ivk.iterations = 300
+            ivk.files_per_dir = 3
+            ivk.dirs_per_dir = 4
+            ivk.total_sz_kb = 0
+            ivk.dir_threads = 3
+            # other tests leave files in the default top directory
+            top = join(ivk.tmp_dir, "smf_dir_tree")
+            self.deltree(top)
+            ivk.set_top([top])
+            ensure_dir_exists(ivk.network_dir)
+            self.runTest("create")
+            self.assertTrue(ivk.dirs_created > 100)
+            created = ivk.dirs_created
+            self.runTest("cleanup")
+            self.assertTrue(ivk.dirs_removed == created)
+            for t in ivk.src_dirs + ivk.dest_dirs:
+                self.assertTrue(os.listdir(t) == [])
+            self.deltree(top)
+
+        def test_b2_cleanup_scan(self):
+            ivk = self.invok
+            ivk.iterations = 200
+            ivk.files_per_dir = 7
+            ivk.dirs_per_dir = 3
+            ivk.total_sz_kb = 0
+            ivk.dir_threads = 2
+            top = join(ivk.tmp_dir, "smf_cleanup_scan")
+            self.deltree(top)
+            ivk.set_top([top])
+            ensure_dir_exists(ivk.network_dir)
+            self.runTest("create")
+            self.runTest("symlink")
+            self.runTest("mkdir")
+            # names that are not this thread's must survive cleanup,
+            # and so must the directories holding them
+            last_fn = self.lastFileNameInTest(ivk.src_dirs)
+            keep = [
+                last_fn.replace("_" + ivk.tid + "_", "_" + ivk.tid + "1_"),
+                last_fn + ".keep",
+            ]
+            for fn in keep:
+                touch(fn)
+            ivk.cleanup_scan = True
+            self.runTest("cleanup")
+            left = []
+            for d in ivk.src_dirs + ivk.dest_dirs:
+                for (dirpath, subdirs, files) in os.walk(d):
+                    left.extend([join(dirpath, f) for f in files])
+                    left.extend([join(dirpath, d) for d in subdirs if d.endswith(".d")])
+            self.assertTrue(sorted(left) == sorted(keep))
+            self.deltree(top)
+
         def test_c_Create(self):
             self.mk_files()  # depends on cleanup_files
             fn = self.lastFileNameInTest(self.invok.src_dirs)
@@ -2067,6 +3561,13 @@ if unittest_module:
             self.runTest("ls-l")
             self.cleanup_files()
 
+        def test_c46_Ls_l_scandir(self):
+            self.mk_files()
+            self.runTest("ls-l-scandir")
+            stat_times = self.invok.histograms["ls-l-scandir-stat"]
+            self.assertTrue(stat_times.count == self.invok.iterations)
+            self.cleanup_files()
+
         def test_c5_Chmod(self):
             self.mk_files()
             self.runTest("chmod")
@@ -2188,6 +3689,333 @@ if unittest_module:
             self.assertTrue(self.invok.status != ok)
             self.cleanup_files()
 
+        def test_h3_first_mismatch(self):
+            b = bytes(range(0, 200))
+            self.assertEqual(first_mismatch(b, bytearray(b)), len(b))
+            for k in [0, 1, 5, 99, 199]:
+                bad = bytearray(b)
+                bad[k] = 255
+                self.assertEqual(first_mismatch(memoryview(b), bad), k)
+
+        def test_h4_vectored_io(self):
+            if not vectored_io_supported:
+                return
+            ivk = self.invok
+            ivk.io_engine = ivk.io_engine_vectored
+            ivk.iov_count = 4
+            ivk.record_sz_kb = 4
+            ivk.total_sz_kb = 37
+            ivk.iterations = 10
+            self.cleanup_files()
+            self.runTest("create")
+            # rq still counted per record, last record in each file is partial
+            self.assertTrue(ivk.rq == ivk.iterations * 10)
+            fn = self.lastFileNameInTest(ivk.src_dirs)
+            self.assertTrue(self.file_size(fn) == ivk.total_sz_kb * ivk.BYTES_PER_KB)
+            self.runTest("append")
+            self.assertTrue(
+                self.file_size(fn) == 2 * ivk.total_sz_kb * ivk.BYTES_PER_KB
+            )
+            ivk.verify_read = True
+            self.runTest("read")
+            self.assertTrue(ivk.rq == ivk.iterations * 10)
+            self.cleanup_files()
+
+        def test_h5_vectored_read_bad_data(self):
+            if not vectored_io_supported:
+                return
+            ivk = self.invok
+            ivk.io_engine = ivk.io_engine_vectored
+            ivk.iov_count = 4
+            ivk.record_sz_kb = 1
+            ivk.total_sz_kb = 8
+            self.mk_files()
+            ivk.verify_read = True
+            fn = self.lastFileNameInTest(ivk.src_dirs)
+            fd = os.open(fn, os.O_WRONLY | O_BINARY)
+            # corrupt a record that is not first in its vectored read
+            os.lseek(fd, 6 * ivk.BYTES_PER_KB + 5, os.SEEK_SET)
+            os.write(fd, b"!")
+            os.close(fd)
+            try:
+                self.runTest("read")
+            except MFRdWrExc:
+                pass
+            except SMFRunException:
+                pass
+            self.assertTrue(ivk.status != ok)
+            self.cleanup_files()
+
+        def test_h6_direct_io(self):
+            if not direct_io_supported:
+                return
+            ivk = self.invok
+            ivk.direct_io = True
+            ivk.record_sz_kb = 8
+            ivk.total_sz_kb = 37
+            ivk.iterations = 10
+            self.cleanup_files()
+            try:
+                self.runTest("create")
+            except SMFRunException:
+                return  # filesystem does not support O_DIRECT
+            fn = self.lastFileNameInTest(ivk.src_dirs)
+            self.assertTrue(self.file_size(fn) == ivk.total_sz_kb * ivk.BYTES_PER_KB)
+            self.runTest("append")
+            self.assertTrue(
+                self.file_size(fn) == 2 * ivk.total_sz_kb * ivk.BYTES_PER_KB
+            )
+            ivk.verify_read = True
+            self.runTest("read")
+            self.assertTrue(ivk.rq == ivk.iterations * 5)
+            if vectored_io_supported:
+                ivk.io_engine = ivk.io_engine_vectored
+                ivk.iov_count = 2
+                self.runTest("overwrite")
+                self.runTest("read")
+                self.assertTrue(ivk.rq == ivk.iterations * 5)
+            self.cleanup_files()
+
+        # a file smaller than one block is still read with O_DIRECT
+        # in multiples of the block size, or 4K-sector devices fail the read
+
+        def test_h6b_direct_io_small_file(self):
+            if not direct_io_supported:
+                return
+            ivk = self.invok
+            ivk.direct_io = True
+            ivk.record_sz_kb = 0
+            ivk.total_sz_kb = 2
+            ivk.iterations = 10
+            ivk.verify_read = True
+            self.cleanup_files()
+            try:
+                self.runTest("create")
+            except SMFRunException:
+                return  # filesystem does not support O_DIRECT
+            read_sizes = []
+            original_read_into = read_into
+            original_preadv = os.preadv
+
+            def recording_read_into(fd, view):
+                read_sizes.append(len(view))
+                return original_read_into(fd, view)
+
+            def recording_preadv(fd, iov, offset):
+                read_sizes.extend([len(v) for v in iov])
+                return original_preadv(fd, iov, offset)
+
+            globals()["read_into"] = recording_read_into
+            try:
+                self.runTest("read")
+                if vectored_io_supported:
+                    os.preadv = recording_preadv
+                    ivk.io_engine = ivk.io_engine_vectored
+                    self.runTest("read")
+            finally:
+                globals()["read_into"] = original_read_into
+                os.preadv = original_preadv
+            self.assertTrue(ivk.status == ok)
+            self.assertTrue(len(read_sizes) >= ivk.iterations)
+            for size in read_sizes:
+                self.assertTrue(size > 0 and size % ivk.direct_io_align == 0)
+            self.cleanup_files()
+
+        def test_h7_mmap(self):
+            ivk = self.invok
+            ivk.record_sz_kb = 4
+            ivk.total_sz_kb = 37
+            ivk.iterations = 10
+            self.cleanup_files()
+            self.runTest("create-mmap")
+            self.assertTrue(ivk.rq == ivk.iterations * 10)
+            fn = self.lastFileNameInTest(ivk.src_dirs)
+            self.assertTrue(self.file_size(fn) == ivk.total_sz_kb * ivk.BYTES_PER_KB)
+            # files written through mmap must read back correctly either way
+            ivk.verify_read = True
+            self.runTest("read")
+            self.runTest("read-mmap")
+            self.assertTrue(ivk.rq == ivk.iterations * 10)
+            ivk.verify_read = False
+            self.runTest("read-mmap")
+            self.assertTrue(ivk.rq == ivk.iterations * 10)
+            ivk.verify_read = True
+            fd = os.open(fn, os.O_WRONLY | O_BINARY)
+            os.lseek(fd, 33 * ivk.BYTES_PER_KB + 5, os.SEEK_SET)
+            os.write(fd, b"!")
+            os.close(fd)
+            try:
+                self.runTest("read-mmap")
+            except MFRdWrExc:
+                pass
+            except SMFRunException:
+                pass
+            self.assertTrue(ivk.status != ok)
+            self.cleanup_files()
+
+        def test_h8_iodepth(self):
+            ivk = self.invok
+            ivk.iodepth = 4
+            ivk.record_sz_kb = 4
+            ivk.total_sz_kb = 16
+            ivk.iterations = 50
+            ivk.filesize_distr = ivk.fsdistr_random_exponential
+            ivk.measure_rsptimes = True
+            self.cleanup_files()
+            self.runTest("create")
+            self.assertTrue(ivk.filenum_final == ivk.iterations)
+            self.assertTrue(len(ivk.rsptimes) == ivk.iterations)
+            # file contents and sizes must not depend on iodepth
+            ivk.iodepth = 1
+            ivk.verify_read = True
+            self.runTest("read")
+            rq_iodepth_1 = ivk.rq_final
+            ivk.iodepth = 3
+            self.runTest("read")
+            self.assertTrue(ivk.rq_final == rq_iodepth_1)
+            self.assertTrue(len(ivk.rsptimes) == ivk.iterations)
+            self.cleanup_files()
+
+        def test_h9_dir_fd_cache(self):
+            if not dir_fd_supported:
+                return
+            ivk = self.invok
+            ivk.total_sz_kb = 4
+            ivk.verify_read = True
+            self.cleanup_files()
+            ivk.dir_fd_cache_size = 2
+            fds_before = len(os.listdir("/proc/self/fd"))
+            for op in ["create", "stat", "chmod", "mkdir", "rmdir", "symlink"]:
+                self.runTest(op)
+                self.assertTrue(ivk.dir_fds is None)
+                # files are visited one directory at a time
+                dir_count = len(
+                    {
+                        os.path.dirname(ivk.mk_file_nm(ivk.src_dirs, j))
+                        for j in range(1, ivk.iterations + 1)
+                    }
+                )
+                self.assertTrue(ivk.dir_fd_misses == dir_count)
+                self.assertTrue(ivk.dir_fd_evictions == dir_count - 2)
+                self.assertTrue(ivk.dir_fd_hits + ivk.dir_fd_misses == ivk.iterations)
+            # files in flight each have their own cache
+            ivk.iodepth = 3
+            self.runTest("read")
+            self.assertTrue(ivk.dir_fd_hits + ivk.dir_fd_misses == ivk.iterations)
+            ivk.iodepth = 1
+            # rename looks up both source and destination directory
+            self.runTest("rename")
+            self.assertTrue(ivk.dir_fd_hits + ivk.dir_fd_misses == 2 * ivk.iterations)
+            self.runTest("delete-renamed")
+            self.assertTrue(len(os.listdir("/proc/self/fd")) == fds_before)
+            ivk.dir_fd_cache_size = 0
+            self.cleanup_files()
+            for d in ivk.src_dirs + ivk.dest_dirs:
+                for (dirpath, subdirs, files) in os.walk(d):
+                    mine = [f for f in files if f.startswith(ivk.prefix + "_")]
+                    self.assertTrue(mine == [])
+
+        # what a worker process sends back is small
+        # and has everything output_results needs
+
+        def test_h10_thread_result(self):
+            import pickle
+
+            ivk = self.invok
+            ivk.measure_rsptimes = True
+            self.cleanup_files()
+            self.runTest("create")
+            rslt = pickle.loads(pickle.dumps(thread_result(ivk)))
+            self.assertTrue(rslt.result_version == thread_result.version)
+            for f in thread_result.__slots__:
+                if f not in ["result_version", "record_sz_kb", "histograms"]:
+                    self.assertTrue(getattr(rslt, f) == getattr(ivk, f))
+            self.assertTrue(rslt.record_sz_kb == ivk.get_record_size_to_use())
+            self.assertTrue(list(rslt.histograms.keys()) == ["create"])
+            self.assertTrue(rslt.histograms["create"].count == ivk.filenum_final)
+            self.assertTrue(len(pickle.dumps(rslt)) < 2000)
+            ivk.measure_rsptimes = False
+            self.cleanup_files()
+
+        # samples written during the test come back in the same order,
+        # and can be converted to CSV
+
+        def test_h11_rsptime_recorder(self):
+            ivk = self.invok
+            ivk.measure_rsptimes = True
+            ivk.iterations = 250
+            self.cleanup_files()
+            rsptime_recorder.chunk_size = 64
+            try:
+                self.runTest("create")
+                self.runTest("ls-l-scandir")
+                count = len(ivk.rsptimes)
+                self.assertTrue(count > 250)
+                self.assertTrue(ivk.rsptimes.written == count)
+                header = read_rsptime_header(ivk.rsptime_fn("rsp"))
+                self.assertTrue(header["samples"] == count)
+                self.assertTrue(header["tid"] == ivk.tid)
+                self.assertTrue(header["start_time"] == ivk.start_time)
+                self.assertTrue(
+                    sorted(header["op_names"])
+                    == ["ls-l-scandir-readdir", "ls-l-scandir-stat"]
+                )
+                samples = list(ivk.rsptimes.samples())
+                self.assertTrue(len(samples) == count)
+                starts = [start for (_, start, _) in samples]
+                self.assertTrue(starts == sorted(starts))
+                self.assertTrue(starts[0] >= ivk.start_time)
+                ivk.rsptime_format = ivk.rsptime_format_csv
+                self.runTest("ls-l-scandir")
+                self.assertTrue(not exists(ivk.rsptime_fn("rsp")))
+                with open(ivk.rsptime_fn("csv")) as f:
+                    lines = f.readlines()
+                self.assertTrue(len(lines) == len(ivk.rsptimes))
+                self.assertTrue(lines[-1].split(",")[0].strip() == samples[-1][0])
+            finally:
+                rsptime_recorder.chunk_size = 1 << 16
+                ivk.rsptime_format = ivk.rsptime_format_binary
+                ivk.measure_rsptimes = False
+                self.cleanup_files()
+
+        # percentiles from histograms are close to exact ones,
+        # and histograms merge and pickle without losing anything
+
+        def test_h12_latency_histogram(self):
+            import pickle
+
+            rng = random.Random(1)
+            samples = [rng.expovariate(1000.0) for _ in range(20000)]
+            parts = [latency_histogram(), latency_histogram()]
+            for (j, t) in enumerate(samples):
+                parts[j % 2].add(t)
+            h = latency_histogram()
+            for part in parts:
+                h.merge(pickle.loads(pickle.dumps(part)))
+            self.assertTrue(h.count == len(samples))
+            self.assertTrue(h.min == min(samples) and h.max == max(samples))
+            self.assertTrue(abs(h.total - sum(samples)) < 1.0e-9)
+            samples.sort()
+            for pct in [1.0, 50.0, 90.0, 99.0, 99.9]:
+                exact = samples[math.ceil(len(samples) * pct / 100.0) - 1]
+                error = abs(h.percentile(pct) - exact)
+                self.assertTrue(error <= exact / 32 + 0.5e-6)
+            self.assertTrue(h.percentile(100.0) == h.max)
+            self.assertTrue(len(pickle.dumps(h)) < 2000)
+            # a histogram for each kind of operation a thread does
+            ivk = self.invok
+            self.cleanup_files()
+            self.runTest("create")
+            self.runTest("ls-l-scandir")
+            self.assertTrue(
+                sorted(ivk.histograms.keys())
+                == ["ls-l-scandir-readdir", "ls-l-scandir-stat"]
+            )
+            self.assertTrue(
+                ivk.histograms["ls-l-scandir-stat"].count == ivk.filenum_final
+            )
+            self.cleanup_files()
+
         def common_z_params(self):
             self.invok.filesize_distr = self.invok.fsdistr_random_exponential
             self.invok.incompressible = True
@@ -2272,6 +4100,21 @@ if unittest_module:
             expected = join(join("d_006", "d_003"), "d_005")
             self.assertTrue(d == expected)
 
+        def test_j0a_biggest_buf_deterministic(self):
+            for incompressible in [False, True]:
+                self.invok.incompressible = incompressible
+                bufs = []
+                for seed in ["seed-a", "seed-a", "seed-b"]:
+                    self.invok.randstate.seed(seed)
+                    bufs.append(self.invok.create_biggest_buf(False))
+                expected_len = self.invok.biggest_buf_size + self.invok.buf_offset_range
+                self.assertTrue(len(bufs[0]) == expected_len)
+                self.assertTrue(bufs[0] == bufs[1])
+                if incompressible:
+                    self.assertTrue(bufs[0] != bufs[2])
+                else:
+                    self.assertTrue(b"\\" not in bufs[0])
+
         def test_j1_deep_tree(self):
             self.invok.total_sz_kb = 0
             self.invok.record_sz_kb = 0
@@ -28,6 +28,7 @@ import pickle
 import sys
 import time
 
+import control_plane
 import launcher_thread
 import multi_thread_workload
 import output_results
@@ -43,16 +44,15 @@ min_files_per_sec = 15
 pct_files_min = 70  # minimum percentage of files for valid test
 
 
-# run a multi-host test
+# start smallfile_remote.py on every host in the test,
+# remote_args tells it how to reach the test driver,
+# returns list of threads that did it
 
 
-def run_multi_host_workload(prm):
+def launch_remote_hosts(prm, remote_args):
     prm_host_set = prm.host_set
     prm_permute_host_dirs = prm.permute_host_dirs
-    master_invoke = prm.master_invoke
-
-    starting_gate = master_invoke.starting_gate
-    verbose = master_invoke.verbose
+    verbose = prm.master_invoke.verbose
 
     if os.getenv("PYPY"):
         python_prog = os.getenv("PYPY")
@@ -65,25 +65,12 @@ def run_multi_host_workload(prm):
 
     # construct list of ssh threads to invoke in parallel
 
-    master_invoke.create_top_dirs(True)
-    pickle_fn = os.path.join(prm.master_invoke.network_dir, "param.pickle")
-
-    # if verbose: print('writing ' + pickle_fn))
-
-    sync_files.write_pickle(pickle_fn, prm)
-
-    # print('python_prog = %s'%python_prog)
-
     remote_thread_list = []
     host_ct = len(prm_host_set)
     for j in range(0, len(prm_host_set)):
         remote_host = prm_host_set[j]
         smf_remote_pgm = os.path.join(prm.remote_pgm_dir, "smallfile_remote.py")
-        this_remote_cmd = "%s %s --network-sync-dir %s " % (
-            python_prog,
-            smf_remote_pgm,
-            prm.master_invoke.network_dir,
-        )
+        this_remote_cmd = "%s %s %s " % (python_prog, smf_remote_pgm, remote_args)
 
         # this_remote_cmd = remote_cmd
 
@@ -109,6 +96,55 @@ def run_multi_host_workload(prm):
             # pace starts so that we don't get ssh errors
             time.sleep(0.1)
         t.start()
+    return remote_thread_list
+
+
+# run a multi-host test coordinated through TCP connections to each host,
+# no files in the network directory and no waiting for NFS to see them
+
+
+def run_multi_host_control(prm):
+    master_invoke = prm.master_invoke
+    master_invoke.create_top_dirs(False)
+    coord = control_plane.coordinator(prm)
+    remote_thread_list = launch_remote_hosts(prm, coord.remote_args())
+    host_timeout = prm.host_startup_timeout
+    if smallfile.is_windows_os:
+        host_timeout += 20
+    all_ok = NOTOK
+    try:
+        invoke_list = coord.run(remote_thread_list, host_timeout)
+        for t in remote_thread_list:
+            t.join()
+        output_results.output_results(invoke_list, prm)
+        all_ok = OK
+    except SMFRunException as e:
+        print("ERROR: %s, aborting test" % str(e))
+    except KeyboardInterrupt:
+        print("control-C signal seen (SIGINT), aborting test")
+    sys.exit(all_ok)
+
+
+# run a multi-host test
+
+
+def run_multi_host_workload(prm):
+    prm_host_set = prm.host_set
+    master_invoke = prm.master_invoke
+
+    starting_gate = master_invoke.starting_gate
+    verbose = master_invoke.verbose
+
+    master_invoke.create_top_dirs(True)
+    pickle_fn = os.path.join(prm.master_invoke.network_dir, "param.pickle")
+
+    # if verbose: print('writing ' + pickle_fn))
+
+    sync_files.write_pickle(pickle_fn, prm)
+
+    remote_thread_list = launch_remote_hosts(
+        prm, "--network-sync-dir %s" % master_invoke.network_dir
+    )
 
     # wait for hosts to arrive at starting gate
     # if only one host, then no wait will occur
@@ -216,7 +252,7 @@ def run_multi_host_workload(prm):
             )
 
     # attempt to aggregate results by reading pickle files
-    # containing SmallfileWorkload instances
+    # containing a smallfile.thread_result for each thread
     # with counters and times that we need
 
     try:
@@ -225,7 +261,7 @@ def run_multi_host_workload(prm):
         one_shot_delay = True
         for h in prm_host_set:  # for each host in test
             # read results for each thread run in that host
-            # from python pickle of the list of SmallfileWorkload objects
+            # from python pickle of the list of smallfile.thread_result objects
 
             pickle_fn = master_invoke.host_result_filename(h)
             if verbose:
@@ -279,6 +315,8 @@ def run_workload():
     # for multi-host test
 
     if params.host_set and not params.is_slave:
+        if params.control_port:
+            return run_multi_host_control(params)
         return run_multi_host_workload(params)
     return multi_thread_workload.run_multi_thread_workload(params)
 
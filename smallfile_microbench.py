@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+smallfile_microbench.py -- microbenchmarks for smallfile per-worker overheads
+
+these measure the python-side cost of pieces of the workload generator
+in isolation, so that changes to them can be compared before and after
+without running a full multi-host test.
+
+how to run:
+
+    # python smallfile_microbench.py --benchmark buffer-build
+    # python smallfile_microbench.py --help
+
+Copyright 2012 -- Ben England
+Licensed under the Apache License at http://www.apache.org/licenses/LICENSE-2.0
+See Appendix on this page for instructions pertaining to license.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import smallfile
+from parser_data_types import non_negative_integer, positive_integer
+
+# run a callable repeatedly and return the best elapsed time per call
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(0, repeat):
+        t_start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t_start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+# the way biggest_buf used to be built, one randrange() call per byte,
+# kept here only so that the old and new costs can be compared
+
+
+def legacy_create_biggest_buf(invk):
+    if not invk.incompressible:
+        random_segment_size = 1 << invk.random_seg_size_bits
+        biggest_buf = bytearray([k % 128 for k in range(0, random_segment_size)])
+        biggest_buf = biggest_buf.replace(b"\\", b"!")
+        for j in range(0, invk.biggest_buf_size_bits - invk.random_seg_size_bits):
+            biggest_buf.extend(biggest_buf[:])
+    else:
+        biggest_buf = bytearray([invk.randstate.randrange(0, 255)])
+        powerof2 = 1
+        for j in range(0, invk.biggest_buf_size_bits - 1):
+            powerof2 *= 2
+            biggest_buf.extend(
+                bytearray(
+                    [invk.randstate.randrange(0, 255) for k in range(0, powerof2)]
+                )
+            )
+        biggest_buf.extend(bytearray([invk.randstate.randrange(0, 255)]))
+    biggest_buf.extend(biggest_buf[0 : invk.buf_offset_range])
+    return biggest_buf
+
+
+def bench_buffer_build(args):
+    print("per-worker biggest_buf build time (best of %d):" % args.repeat)
+    for incompressible in [False, True]:
+        invk = smallfile.SmallfileWorkload()
+        invk.incompressible = incompressible
+        invk.randstate = random.Random("microbench")
+        legacy = best_time(lambda: legacy_create_biggest_buf(invk), args.repeat)
+        current = best_time(lambda: invk.create_biggest_buf(False), args.repeat)
+
+        # same seed must always give the same buffer,
+        # or read verification of previously written files breaks
+
+        invk.randstate = random.Random("microbench")
+        buf1 = invk.create_biggest_buf(False)
+        invk.randstate = random.Random("microbench")
+        buf2 = invk.create_biggest_buf(False)
+        if buf1 != buf2:
+            raise smallfile.SMFRunException("biggest_buf not deterministic per seed")
+        print(
+            "%20s : before %9.6f sec, after %9.6f sec, speedup %7.1fx"
+            % (
+                "incompressible=%s" % incompressible,
+                legacy,
+                current,
+                legacy / max(current, 1.0e-9),
+            )
+        )
+        print(
+            "%20s   %d workers/host would spend %7.3f sec before, %7.3f sec after"
+            % ("", args.workers, legacy * args.workers, current * args.workers)
+        )
+
+
+# the way do_create used to write a file, with biggest_buf as a bytearray,
+# so the pattern buffer was copied once per file in prepare_buf()
+# and again for every os.write()
+
+
+def legacy_write_file(invk, fd, remaining_kb):
+    invk.prepare_buf()
+    rszkb = invk.get_record_size_to_use()
+    while remaining_kb > 0:
+        next_kb = min(rszkb, remaining_kb)
+        os.write(fd, invk.buf[0 : next_kb * invk.BYTES_PER_KB])
+        remaining_kb -= next_kb
+
+
+def current_write_file(invk, fd, remaining_kb):
+    invk.prepare_buf()
+    invk.write_records(fd, remaining_kb)
+
+
+# measure time per file for an I/O path,
+# using the null device or a cached file so that only python-side cost is seen,
+# then measure peak python heap allocation in a separate pass
+# since tracing allocations slows everything down
+# peak traced memory shows whether file data was copied
+
+
+def measure_io_path(invk, do_one_file, files):
+    t_start = time.perf_counter()
+    for j in range(1, files + 1):
+        invk.filenum = j
+        do_one_file()
+    elapsed = time.perf_counter() - t_start
+    tracemalloc.start()
+    for j in range(1, min(files, 1000) + 1):
+        invk.filenum = j
+        do_one_file()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (elapsed / files, peak)
+
+
+def bench_write_path(args):
+    invk = smallfile.SmallfileWorkload()
+    invk.tid = "00"
+    invk.total_sz_kb = args.file_size
+    invk.record_sz_kb = args.record_size
+    biggest_buf = invk.create_biggest_buf(False)
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        invk.biggest_buf = biggest_buf
+        (legacy_t, legacy_peak) = measure_io_path(
+            invk, lambda: legacy_write_file(invk, fd, invk.total_sz_kb), args.files
+        )
+        invk.biggest_buf = memoryview(biggest_buf).toreadonly()
+        (current_t, current_peak) = measure_io_path(
+            invk, lambda: current_write_file(invk, fd, invk.total_sz_kb), args.files
+        )
+    finally:
+        os.close(fd)
+    print(
+        "write path, %d files of %d KB, record size %d KB (0 = file size):"
+        % (args.files, args.file_size, args.record_size)
+    )
+    print(
+        "%20s : %9.3f usec/file, peak python allocation %8d bytes"
+        % ("before (copying)", legacy_t * 1.0e6, legacy_peak)
+    )
+    print(
+        "%20s : %9.3f usec/file, peak python allocation %8d bytes"
+        % ("after (memoryview)", current_t * 1.0e6, current_peak)
+    )
+
+
+# the way do_read used to verify a file, allocating a bytes object per record
+# and comparing it against a copy of the expected pattern
+
+
+def legacy_read_file(invk, fd, remaining_kb):
+    invk.filenum = 1
+    os.lseek(fd, 0, os.SEEK_SET)
+    invk.prepare_buf()
+    rszkb = invk.get_record_size_to_use()
+    while remaining_kb > 0:
+        next_kb = min(rszkb, remaining_kb)
+        rszbytes = next_kb * invk.BYTES_PER_KB
+        bytesread = os.read(fd, rszbytes)
+        if bytes(invk.buf[0:rszbytes]) != bytesread:
+            raise smallfile.SMFRunException("legacy read verification failed")
+        remaining_kb -= next_kb
+
+
+def current_read_file(invk, fd, remaining_kb):
+    invk.filenum = 1
+    os.lseek(fd, 0, os.SEEK_SET)
+    invk.prepare_buf()
+    invk.read_records(fd, remaining_kb)
+
+
+# read back and verify one file written with the same pattern,
+# reading the same file every time so that it stays in page cache
+
+
+def bench_read_path(args):
+    invk = smallfile.SmallfileWorkload()
+    invk.tid = "00"
+    invk.filenum = 1
+    invk.total_sz_kb = args.file_size
+    invk.record_sz_kb = args.record_size
+    invk.verify_read = True
+    invk.biggest_buf = memoryview(invk.create_biggest_buf(False)).toreadonly()
+    fn = os.path.join(invk.tmp_dir, "smallfile_microbench.%d.tmp" % os.getpid())
+    invk.prepare_buf()
+    fd = os.open(fn, os.O_CREAT | os.O_RDWR | smallfile.O_BINARY, 0o644)
+    try:
+        invk.write_records(fd, invk.total_sz_kb)
+        (legacy_t, legacy_peak) = measure_io_path(
+            invk, lambda: legacy_read_file(invk, fd, invk.total_sz_kb), args.files
+        )
+        (current_t, current_peak) = measure_io_path(
+            invk, lambda: current_read_file(invk, fd, invk.total_sz_kb), args.files
+        )
+    finally:
+        os.close(fd)
+        os.unlink(fn)
+    print(
+        "verified read path, %d files of %d KB, record size %d KB (0 = file size):"
+        % (args.files, args.file_size, args.record_size)
+    )
+    print(
+        "%20s : %9.3f usec/file, peak python allocation %8d bytes"
+        % ("before (os.read)", legacy_t * 1.0e6, legacy_peak)
+    )
+    print(
+        "%20s : %9.3f usec/file, peak python allocation %8d bytes"
+        % ("after (readv)", current_t * 1.0e6, current_peak)
+    )
+
+
+# the way mk_file_nm() used to make a file name, joining every component
+# for every call
+
+
+def legacy_mk_file_nm(invk, base_dirs, filenum):
+    tree = base_dirs[filenum % len(base_dirs)]
+    components = [
+        tree,
+        os.sep,
+        invk.file_dirs[filenum],
+        os.sep,
+        invk.prefix,
+        "_",
+        invk.onhost,
+        "_",
+        invk.tid,
+        "_",
+        str(filenum),
+        "_",
+        invk.suffix,
+    ]
+    return "".join(components)
+
+
+# names made per file by each operation, before and after,
+# cleanup used to make 5 names per file, rename and symlink make 2
+
+
+def legacy_names(invk, op, j):
+    src = invk.src_dirs
+    dest = invk.dest_dirs
+    if op == "cleanup":
+        return (
+            legacy_mk_file_nm(invk, dest, j) + ".s",
+            legacy_mk_file_nm(invk, src, j),
+            legacy_mk_file_nm(invk, src, j) + invk.rename_suffix,
+            legacy_mk_file_nm(invk, dest, j),
+            legacy_mk_file_nm(invk, src, j) + invk.rename_suffix,
+        )
+    if op == "rename":
+        return (legacy_mk_file_nm(invk, src, j), legacy_mk_file_nm(invk, dest, j))
+    return legacy_mk_file_nm(invk, src, j)
+
+
+def current_names(invk, op, j):
+    if op == "cleanup":
+        (src_fn, dest_fn) = invk.file_names.mk_src_dest_nms(j)
+        return (dest_fn + ".s", src_fn, src_fn + invk.rename_suffix, dest_fn)
+    if op == "rename":
+        return (invk.mk_file_nm(invk.src_dirs, j), invk.mk_file_nm(invk.dest_dirs, j))
+    return invk.mk_file_nm(invk.src_dirs, j)
+
+
+# time to create and delete a 1-byte file in --dir,
+# with names made in advance, so that name generation cost
+# can be compared to the cost of the operations themselves
+
+
+def time_tiny_files(top, files):
+    d = tempfile.mkdtemp(prefix="smallfile_microbench.", dir=top)
+    try:
+        names = [os.path.join(d, "f%d" % j) for j in range(0, files)]
+        t_start = time.perf_counter()
+        for fn in names:
+            fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            os.write(fd, b"x")
+            os.close(fd)
+        create_t = (time.perf_counter() - t_start) / files
+        t_start = time.perf_counter()
+        for fn in names:
+            os.unlink(fn)
+        delete_t = (time.perf_counter() - t_start) / files
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+    return (create_t, delete_t)
+
+
+def bench_file_names(args):
+    invk = smallfile.SmallfileWorkload()
+    invk.tid = "00"
+    invk.iterations = args.files
+    invk.set_top([os.path.join(args.dir, "smf")])
+    (create_t, delete_t) = time_tiny_files(args.dir, min(args.files, 100000))
+    print(
+        "1-byte file in %s: create %9.3f usec, delete %9.3f usec"
+        % (args.dir, create_t * 1.0e6, delete_t * 1.0e6)
+    )
+    print("file name generation per file (best of %d):" % args.repeat)
+    op_times = {"create": create_t, "rename": create_t, "cleanup": delete_t}
+    for op in ["create", "rename", "cleanup"]:
+        results = []
+        for make_names in [legacy_names, current_names]:
+            invk.reset()
+            results.append(
+                best_time(
+                    lambda: [make_names(invk, op, j) for j in range(1, args.files + 1)],
+                    args.repeat,
+                )
+                / args.files
+            )
+        (legacy, current) = results
+        print(
+            "%20s : before %7.3f usec (%5.1f%% of op), after %7.3f usec (%5.1f%% of op)"
+            % (
+                op,
+                legacy * 1.0e6,
+                100.0 * legacy / op_times[op],
+                current * 1.0e6,
+                100.0 * current / op_times[op],
+            )
+        )
+
+
+# response time files like the ones gen-fake-rsptimes.sh makes,
+# 4 threads on each of 2 hosts, but with --files samples per thread
+# at random times over 10 minutes, in the CSV format that smallfile writes
+
+
+def make_fake_rsptimes(rspdir, samples_per_thread):
+    rng = numpy.random.default_rng(1)
+    for h in ["host-21.foo.com", "host-22.foo.com"]:
+        for t in ["01", "02", "03", "04"]:
+            at_times = numpy.sort(rng.uniform(0.0, 600.0, samples_per_thread))
+            rsp_times = rng.exponential(0.002, samples_per_thread)
+            numpy.savetxt(
+                os.path.join(
+                    rspdir, "rsptimes_%s_%s_op-name_1700000000.00.csv" % (t, h)
+                ),
+                numpy.column_stack([at_times, rsp_times]),
+                fmt="op-name, %9.6f, %9.6f",
+            )
+
+
+# run a copy of smallfile_rsptimes_stats.py on the fake response times,
+# returning its best elapsed time and its output
+
+
+def time_rsptimes_stats(program, rspdir, repeat):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, program, "--common-hostname-suffix", "foo.com", rspdir]
+
+    def run_stats():
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    elapsed = best_time(run_stats, repeat)
+    with open(os.path.join(rspdir, "stats-rsptimes.csv")) as f:
+        return (elapsed, f.read())
+
+
+# --baseline-stats is an older copy of smallfile_rsptimes_stats.py,
+# for example from "git show <commit>:smallfile_rsptimes_stats.py",
+# its output must be the same as the current one's
+
+
+def bench_rsptimes_stats(args):
+    rspdir = tempfile.mkdtemp(prefix="smallfile_microbench.", dir=args.dir)
+    try:
+        make_fake_rsptimes(rspdir, args.files)
+        current_pgm = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "smallfile_rsptimes_stats.py"
+        )
+        (current, current_output) = time_rsptimes_stats(
+            current_pgm, rspdir, args.repeat
+        )
+        print(
+            "response time stats for %d samples (best of %d):"
+            % (8 * args.files, args.repeat)
+        )
+        print("%20s : %9.3f sec" % ("current", current))
+        if args.baseline_stats:
+            (baseline, baseline_output) = time_rsptimes_stats(
+                args.baseline_stats, rspdir, args.repeat
+            )
+            if baseline_output != current_output:
+                raise smallfile.SMFRunException(
+                    "%s output differs from current output" % args.baseline_stats
+                )
+            print(
+                "%20s : %9.3f sec, speedup %7.1fx, same output"
+                % ("baseline", baseline, baseline / max(current, 1.0e-9))
+            )
+    finally:
+        shutil.rmtree(rspdir, ignore_errors=True)
+
+
+benchmarks = {
+    "buffer-build": bench_buffer_build,
+    "file-names": bench_file_names,
+    "read-path": bench_read_path,
+    "rsptimes-stats": bench_rsptimes_stats,
+    "write-path": bench_write_path,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="smallfile microbenchmarks")
+    add = parser.add_argument
+    add(
+        "--benchmark",
+        choices=sorted(benchmarks.keys()) + ["all"],
+        default="all",
+        help="which microbenchmark to run",
+    )
+    add(
+        "--repeat",
+        type=positive_integer,
+        default=3,
+        help="repetitions of each measurement, best time is reported",
+    )
+    add(
+        "--files",
+        type=positive_integer,
+        default=100000,
+        help="files per measurement for per-file benchmarks",
+    )
+    add(
+        "--file-size",
+        type=positive_integer,
+        default=4,
+        help="file size (KB) for per-file benchmarks",
+    )
+    add(
+        "--record-size",
+        type=non_negative_integer,
+        default=0,
+        help="record size (KB, 0 = file size) for per-file benchmarks",
+    )
+    add(
+        "--dir",
+        default="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        help="directory for benchmarks that create files (tmpfs is best)",
+    )
+    add(
+        "--workers",
+        type=positive_integer,
+        default=512,
+        help="worker processes per host to extrapolate per-host cost to",
+    )
+    add(
+        "--baseline-stats",
+        default=None,
+        help="another smallfile_rsptimes_stats.py to compare with (rsptimes-stats)",
+    )
+    return parser.parse_args()
+
+
+def run_benchmarks():
+    args = parse_args()
+    for name in sorted(benchmarks.keys()):
+        if args.benchmark in [name, "all"]:
+            print("*** %s" % name)
+            benchmarks[name](args)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
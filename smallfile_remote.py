@@ -31,10 +31,10 @@ def run_workload():
     # if a --host-set parameter was passed, it's a multi-host workload
     # each remote instance will wait until all instances reach starting gate
 
-    params = parse_slave.parse()
+    (params, control) = parse_slave.parse()
     if params.master_invoke.verbose:
         print("slave params: %s" % str(params))
-    return multi_thread_workload.run_multi_thread_workload(params)
+    return multi_thread_workload.run_multi_thread_workload(params, control)
 
 
 # for windows compatibility,
@@ -25,7 +25,6 @@
 # output in the 'start-time' field.
 
 
-import bisect
 import os
 import re
 import sys
@@ -35,7 +34,7 @@ import numpy
 import scipy
 import scipy.stats
 
-time_infinity = 1 << 62
+from smallfile import read_rsptime_header, rsptime_fields, rsptime_header_size
 
 # edit this list if you want additional percentiles
 
@@ -55,98 +54,90 @@ def usage(msg):
 
 
 # parse files once, we assume here that we can hold them in RAM
-# so we don't have to keep reading them
-# by keeping them in RAM we allow binary search for starting
-# time since we want to isolate set of samples in a time interval
-
-
-def parse_rsptime_file(result_dir, csv_pathname):
-    samples = []
-    with open(os.path.join(result_dir, csv_pathname), "r") as f:
-        records = [line.strip() for line in f.readlines()]
-        for sample in records:
-            components = sample.split(",")
-            op = components[0]
-            at_time = float(components[1])
-            if start_time > 0:
-                at_time += start_time
-            rsp_time = float(components[2])
-            samples.append((op, at_time, rsp_time))
-    return samples
-
-
-# to be used for sorting based on tuple components
-
-
-def get_at_time(rsptime_tuple):
-    (_, at_time, _) = rsptime_tuple
-    return at_time
-
-
-def get_rsp_time(rsptime_tuple):
-    (_, _, rsp_time) = rsptime_tuple
-    return rsp_time
-
-
-def do_sorting(sample_set, already_sorted=False):
-    """
-    this function avoids duplication of sorting
-    """
-    if not already_sorted:
-        sorted_samples = sorted(sample_set, key=get_at_time)
-    else:
-        sorted_samples = sample_set
-    sorted_keys = list(map(get_at_time, sorted_samples))
-    sorted_rsptimes = sorted(list(map(get_rsp_time, sample_set)))
-    return (sorted_samples, sorted_keys, sorted_rsptimes)
-
-
-# leverage python binary search module "bisect"
-# obtained from https://docs.python.org/2/library/bisect.html#searching-sorted-lists
+# so we don't have to keep reading them.
+# samples are kept as 2 numpy columns, time of each request
+# and its response time, operation names are not needed for stats
+
+
+def parse_rsptime_file(result_dir, pathname):
+    if pathname.endswith(".rsp"):
+        return parse_rsptime_binary(os.path.join(result_dir, pathname))
+    full_pathname = os.path.join(result_dir, pathname)
+    if os.path.getsize(full_pathname) == 0:
+        return (numpy.empty(0), numpy.empty(0))
+    records = numpy.loadtxt(full_pathname, delimiter=",", usecols=(1, 2), ndmin=2)
+    at_times = records[:, 0].copy()
+    if start_time > 0:
+        at_times += start_time
+    return (at_times, records[:, 1].copy())
+
+
+# binary response time files are mapped into memory instead of read,
+# and times are converted to time since the thread started,
+# as they are in CSV files
+
+
+def parse_rsptime_binary(pathname):
+    header = read_rsptime_header(pathname)
+    sample_count = header["samples"]
+    if sample_count == 0:
+        return (numpy.empty(0), numpy.empty(0))
+    byteorder = "<" if header["byteorder"] == "little" else ">"
+    records = numpy.memmap(
+        pathname,
+        dtype=numpy.dtype(byteorder + "f8"),
+        mode="r",
+        offset=rsptime_header_size,
+        shape=(sample_count, rsptime_fields),
+    )
+    at_times = records[:, 1] - header["start_time"]
+    if start_time > 0:
+        at_times += start_time
+    return (at_times, numpy.array(records[:, 2], dtype=numpy.float64))
 
 
-def find_le(a, x):
-    # find highest index with value < x
-    i = bisect.bisect_right(a, x)
-    return i
+# response times of a set of threads, in one column
 
 
-def find_gt(a, x):
-    # find lowest index with value >= x
-    i = bisect.bisect_left(a, x)
-    if i < len(a):
-        return i
-    # since the only thing we are doing with this result
-    # is to extract a slice of an array,
-    # returning len(a) is a valid thing
-    # raise ValueError
+def rsptimes_of(sample_sets):
+    return numpy.concatenate([rsp_times for (_, rsp_times) in sample_sets])
 
 
-# if you want this to calculate stats for a time_interval
-# t specify from_time and to_time
+# if you want stats for a time interval,
+# pass the response times of samples in that interval
 
 
-def reduce_thread_set(sorted_samples_tuple, from_time=0, to_time=time_infinity):
-    # FIXME: need binary search to
-    # efficiently find beginning of time interval
-    (sorted_samples, sorted_keys, sorted_times) = sorted_samples_tuple
-    if to_time < time_infinity:
-        start_index = find_le(sorted_keys, from_time)
-        end_index = find_gt(sorted_keys, to_time)
-        # replace sorted_times with just the response times in time interval
-        sorted_times = sorted(map(get_rsp_time, sorted_samples[start_index:end_index]))
-    sample_count = len(sorted_times)
+def reduce_rsptimes(rsp_times):
+    sample_count = len(rsp_times)
     if sample_count < min_rsptime_samples:
         return None
+    sorted_times = numpy.sort(rsp_times)
     mintime = sorted_times[0]
     maxtime = sorted_times[-1]
     mean = scipy.stats.tmean(sorted_times)
     stdev = scipy.stats.tstd(sorted_times)
     pctdev = 100.0 * stdev / mean
-    pctiles = []
-    for p in percentiles:
-        pctiles.append(numpy.percentile(sorted_times, float(p), overwrite_input=True))
-    return (sample_count, mintime, maxtime, mean, pctdev, pctiles)
+    pctiles = numpy.percentile(sorted_times, percentiles, overwrite_input=True)
+    return (sample_count, mintime, maxtime, mean, pctdev, pctiles.tolist())
+
+
+# stats for each time interval starting at a time in from_times,
+# samples are sorted by time once, and then the samples in each interval
+# are found by binary search.
+# a sample at exactly the start or end of an interval is in neither
+
+
+def reduce_intervals(sample_sets, from_times, interval):
+    at_times = numpy.concatenate([at_times for (at_times, _) in sample_sets])
+    order = numpy.argsort(at_times, kind="stable")
+    sorted_keys = at_times[order]
+    rsp_times = rsptimes_of(sample_sets)[order]
+    start_indexes = numpy.searchsorted(sorted_keys, from_times, side="right")
+    end_indexes = numpy.searchsorted(sorted_keys, from_times + interval, side="left")
+    return [
+        reduce_rsptimes(rsp_times[start_index:end_index])
+        for (start_index, end_index) in zip(start_indexes, end_indexes)
+    ]
 
 
 # format the stats for output to a csv file
@@ -208,7 +199,7 @@ print("time interval is %d seconds" % time_interval)
 # thread number
 # hostname
 
-regex = r"rsptimes_([0-9]{2})_([0-9,a-z,\-,\.]*)%s_[-,a-z]*_[.,0-9]*.csv"
+regex = r"rsptimes_([0-9]{2})_([0-9,a-z,\-,\.]*)%s_[-,a-z]*_[.,0-9]*\.(csv|rsp)"
 
 # filter out redundant suffix, if any, in hostname
 
@@ -221,7 +212,7 @@ if argindex != argcount - 1:
 
 directory = argv[argindex]
 if not os.path.isdir(directory):
-    usage("%s: directory containing result csv files was not provided" % directory)
+    usage("%s: directory containing response time files was not provided" % directory)
 
 # process the results
 # we show individual threads, per-host groupings and all threads together
@@ -230,7 +221,7 @@ samples_by_thread = {}
 hosts = {}
 
 pathnames = filter(
-    lambda path: path.startswith("rsptimes") and path.endswith(".csv"),
+    lambda path: path.startswith("rsptimes") and path.endswith((".csv", ".rsp")),
     os.listdir(directory),
 )
 max_thread = 0
@@ -255,7 +246,7 @@ for p in pathnames:
 
 hostcount = len(hosts.keys())
 if hostcount == 0:
-    usage("%s: no .csv response time log files were found" % directory)
+    usage("%s: no .csv or .rsp response time log files were found" % directory)
 
 summary_pathname = os.path.join(directory, "stats-rsptimes.csv")
 header = "host:thread, samples, min, max, mean, %dev, "
@@ -268,15 +259,13 @@ with open(summary_pathname, "w") as outf:
     # aggregate response times across all threads and whole test duration
     # if there is only 1 host, no need for cluster-wide stats
 
-    cluster_sample_set = None
+    cluster_sample_set = []
+    for per_host_dict in hosts.values():
+        for _, samples in per_host_dict.values():
+            cluster_sample_set.append(samples)
     if len(hosts.keys()) > 1:
         outf.write("cluster-wide stats:\n")
-        cluster_sample_set = []
-        for per_host_dict in hosts.values():
-            for _, samples in per_host_dict.values():
-                cluster_sample_set.extend(samples)
-        sorted_cluster_tuple = do_sorting(cluster_sample_set)
-        cluster_results = reduce_thread_set(sorted_cluster_tuple)
+        cluster_results = reduce_rsptimes(rsptimes_of(cluster_sample_set))
         outf.write("all-hosts:all-thrd," + format_stats(cluster_results) + "\n")
         outf.write("\n")
 
@@ -289,11 +278,8 @@ with open(summary_pathname, "w") as outf:
     if len(first_host) > 1:
         outf.write("per-host stats:\n")
         for h in sorted(hosts.keys()):
-            sample_set = []
-            for _, samples in hosts[h].values():
-                sample_set.extend(samples)
-            sorted_host_tuple = do_sorting(sample_set)
-            host_results = reduce_thread_set(sorted_host_tuple)
+            sample_set = [samples for (_, samples) in hosts[h].values()]
+            host_results = reduce_rsptimes(rsptimes_of(sample_set))
             outf.write(h + ":" + "all-thrd" + "," + format_stats(host_results) + "\n")
         outf.write("\n")
 
@@ -303,9 +289,8 @@ with open(summary_pathname, "w") as outf:
     for h in sorted(hosts.keys()):
         threadset = hosts[h]
         for t in sorted(threadset.keys()):
-            (_, samples) = threadset[t]
-            sorted_thrd_tuple = do_sorting(samples, already_sorted=True)
-            thrd_results = reduce_thread_set(sorted_thrd_tuple)
+            (_, (_, rsp_times)) = threadset[t]
+            thrd_results = reduce_rsptimes(rsp_times)
             outf.write(h + ":" + t + "," + format_stats(thrd_results) + "\n")
     outf.write("\n")
 
@@ -318,9 +303,10 @@ with open(summary_pathname, "w") as outf:
     for h in hosts.keys():
         threadset = hosts[h]
         for t in threadset.keys():
-            (_, samples) = threadset[t]
-            if len(samples) > 0:
-                (_, max_at_time, max_rsp_time) = samples[-1]
+            (_, (at_times, rsp_times)) = threadset[t]
+            if len(at_times) > 0:
+                max_at_time = at_times[-1]
+                max_rsp_time = rsp_times[-1]
             else:
                 max_at_time = 0.0
                 max_rsp_time = 0.0
@@ -334,21 +320,11 @@ with open(summary_pathname, "w") as outf:
     if quantized_end_time > 0:
         outf.write("cluster-wide response time stats over time:\n")
         outf.write("time-since-start(sec), " + header + "\n")
-
-        # avoid re-sorting all response time samples
-        # if possible (and it often is)
-
-        if cluster_sample_set is None:
-            cluster_sample_set = []
-            for per_host_dict in hosts.values():
-                for _, samples in per_host_dict.values():
-                    cluster_sample_set.extend(samples)
-            sorted_cluster_tuple = do_sorting(cluster_sample_set)
-        for from_t in range(int(start_time), quantized_end_time, time_interval):
-            to_t = from_t + time_interval
-            results_in_interval = reduce_thread_set(
-                sorted_cluster_tuple, from_time=from_t, to_time=to_t
-            )
+        from_times = numpy.arange(int(start_time), quantized_end_time, time_interval)
+        interval_results = reduce_intervals(
+            cluster_sample_set, from_times, time_interval
+        )
+        for (from_t, results_in_interval) in zip(from_times, interval_results):
             outf.write("%-8d, all-hosts:all-thrd, " % from_t)
             outf.write(format_stats(results_in_interval) + "\n")
         outf.write("\n")
@@ -19,6 +19,13 @@ def bool2YN(boolval):
 
 
 class smf_test_params:
+    # how threads are run in each worker process on a host,
+    # as python threads, or as coroutines sharing a pool of executor threads
+
+    worker_engine_process = "process"
+    worker_engine_asyncio = "asyncio"
+    all_worker_engines = [worker_engine_process, worker_engine_asyncio]
+
     def __init__(
         self,
         host_set=None,
@@ -38,6 +45,13 @@ class smf_test_params:
         self.as_host = None
         self.host_set = host_set
         self.thread_count = thread_count
+        self.worker_engine = self.worker_engine_process
+        # with asyncio worker engine, blocking calls in flight per process
+        self.executor_threads = 32
+        # worker processes per host and threads per worker process,
+        # 0 means derive it from thread_count, see get_threads_per_proc()
+        self.procs = 0
+        self.threads_per_proc = 0
         self.master_invoke = smallfile.SmallfileWorkload()
         self.remote_pgm_dir = remote_pgm_dir
         self.top_dirs = top_dirs
@@ -47,6 +61,9 @@ class smf_test_params:
         if network_sync_dir:
             self.master_invoke.network_dir = network_sync_dir
         self.launch_by_daemon = False
+        # TCP port test driver coordinates hosts on, 0 = files in network_dir
+        self.control_port = 0
+        self.control_host = smallfile.get_hostname(None)
         self.is_slave = slave
         self.permute_host_dirs = permute_host_dirs
         self.startup_timeout = 0
@@ -68,17 +85,42 @@ class smf_test_params:
             (dirs * 2) // self.min_directories_per_sec
         )
 
-        # allow for creating list of pathnames if millions of files per dir
-        file_creation_overhead = max(1, self.master_invoke.files_per_dir // 300000)
-
-        # allow no less than 2 seconds to account for NTP inaccuracy
-        self.startup_timeout = 2 + file_creation_overhead + dir_creation_overhead
+        # allow no less than 3 seconds to account for NTP inaccuracy
+        # and process startup
+        self.startup_timeout = 3 + dir_creation_overhead
 
         self.host_startup_timeout = self.startup_timeout
         if self.host_set is not None:
             # allow extra time for inter-host synchronization
             self.host_startup_timeout += 5 + (len(self.host_set) // 2)
 
+    # most threads run by any worker process on a host,
+    # if neither procs nor threads_per_proc was given,
+    # process engine runs one thread per process,
+    # asyncio engine runs all threads in one process
+
+    def get_threads_per_proc(self):
+        if self.threads_per_proc:
+            return self.threads_per_proc
+        if self.procs:
+            return -(-self.thread_count // self.procs)
+        if self.worker_engine == self.worker_engine_asyncio:
+            return self.thread_count
+        return 1
+
+    # number of threads in each worker process on a host,
+    # with just procs given, there are exactly that many processes,
+    # and the threads are spread over them as evenly as possible
+
+    def get_proc_thread_counts(self):
+        if self.procs and not self.threads_per_proc:
+            (per_proc, extra) = divmod(self.thread_count, self.procs)
+            counts = [per_proc + 1] * extra + [per_proc] * (self.procs - extra)
+            return [c for c in counts if c > 0]
+        per_proc = self.get_threads_per_proc()
+        (full_procs, extra) = divmod(self.thread_count, per_proc)
+        return [per_proc] * full_procs + ([extra] if extra else [])
+
     def __str__(self):
         fmt = "smf_test_params: version=%s json=%s as_host=%s host_set=%s "
         fmt += "launch_by_daemon=%s "
@@ -120,6 +162,8 @@ class smf_test_params:
             ("operation", inv.opname),
             ("files/thread", "%d" % inv.iterations),
             ("threads", "%d" % self.thread_count),
+            ("worker engine", self.worker_engine),
+            ("threads per process", "%d" % self.get_threads_per_proc()),
             ("record size (KB, 0 = maximum)", "%d" % inv.record_sz_kb),
             ("file size (KB)", "%d" % inv.total_sz_kb),
             ("file size distribution", fsdistr_str),
@@ -131,6 +175,12 @@ class smf_test_params:
             ("hash file number into dir.?", bool2YN(inv.hash_to_dir)),
             ("fsync after modify?", bool2YN(inv.fsync)),
             ("incompressible?", bool2YN(inv.incompressible)),
+            ("I/O engine", inv.io_engine),
+            ("direct I/O?", bool2YN(inv.direct_io)),
+            ("files in flight per thread", "%d" % inv.iodepth),
+            ("directory fds cached per thread", "%d" % inv.dir_fd_cache_size),
+            ("directory tree threads", "%d" % inv.dir_threads),
+            ("cleanup by directory scan?", bool2YN(inv.cleanup_scan)),
             ("pause between files (microsec)", "%d" % inv.pause_between_files),
             ("auto-pause?", bool2YN(inv.auto_pause)),
             (
@@ -142,6 +192,7 @@ class smf_test_params:
             ("finish all requests?", "%s" % bool2YN(inv.finish_all_rq)),
             ("stonewall?", "%s" % bool2YN(inv.stonewall)),
             ("measure response times?", "%s" % bool2YN(inv.measure_rsptimes)),
+            ("response time file format", inv.rsptime_format),
             ("verify read?", "%s" % bool2YN(inv.verify_read)),
             ("verbose?", bool2YN(inv.verbose)),
             ("log to stderr?", bool2YN(inv.log_to_stderr)),
@@ -153,6 +204,10 @@ class smf_test_params:
                     ("ext.attr.count", "%d" % inv.xattr_count),
                 ]
             )
+        if self.worker_engine == self.worker_engine_asyncio:
+            prm_list.append(("executor threads", "%d" % self.executor_threads))
+        if inv.io_engine == inv.io_engine_vectored:
+            prm_list.append(("records per system call", "%d" % inv.iov_count))
         if self.host_set:
             prm_list.extend(
                 [("permute host directories?", "%s" % bool2YN(self.permute_host_dirs))]
@@ -161,6 +216,13 @@ class smf_test_params:
                 prm_list.append(("remote program directory", self.remote_pgm_dir))
             if self.network_sync_dir:
                 prm_list.append(("network thread sync. dir.", self.network_sync_dir))
+            if self.control_port:
+                prm_list.append(
+                    (
+                        "control address",
+                        "%s:%d" % (self.control_host, self.control_port),
+                    )
+                )
         return prm_list
 
     # add any parameters that might be relevant to
@@ -189,6 +251,9 @@ class smf_test_params:
         p["operation"] = inv.opname
         p["files_per_thread"] = inv.iterations
         p["threads"] = self.thread_count
+        p["worker_engine"] = self.worker_engine
+        p["executor_threads"] = self.executor_threads
+        p["threads_per_proc"] = self.get_threads_per_proc()
         p["file_size"] = inv.total_sz_kb
         p["file_size_distr"] = self.size_distribution
         p["files_per_dir"] = inv.files_per_dir
@@ -203,10 +268,19 @@ class smf_test_params:
         p["finish_all_requests"] = bool2YN(inv.finish_all_rq)
         p["stonewall"] = bool2YN(inv.stonewall)
         p["verify_read"] = bool2YN(inv.verify_read)
+        p["response_times_format"] = inv.rsptime_format
+        p["io_engine"] = inv.io_engine
+        p["iov_count"] = inv.iov_count
+        p["direct_io"] = bool2YN(inv.direct_io)
+        p["iodepth"] = inv.iodepth
+        p["dir_fd_cache"] = inv.dir_fd_cache_size
+        p["dir_threads"] = inv.dir_threads
+        p["cleanup_scan"] = bool2YN(inv.cleanup_scan)
         p["xattr_size"] = str(inv.xattr_size)
         p["xattr_count"] = str(inv.xattr_count)
         p["permute_host_dirs"] = bool2YN(self.permute_host_dirs)
         p["network_sync_dir"] = self.network_sync_dir
+        p["control_port"] = self.control_port
         p["min_directories_per_sec"] = self.min_directories_per_sec
         p["total_hosts"] = inv.total_hosts
 
@@ -50,6 +50,12 @@ def parse_yaml(test_params, input_yaml_file):
                 test_params.output_json = v
             elif k == "response-times":
                 inv.measure_rsptimes = boolean(v)
+            elif k == "response-times-format":
+                if v not in smallfile.SmallfileWorkload.all_rsptime_formats:
+                    raise SmfParseException(
+                        'response-times-format "%s" not recognized' % v
+                    )
+                inv.rsptime_format = v
             elif k == "network-sync-dir":
                 inv.network_dir = boolean(v)
             elif k == "operation":
@@ -66,6 +72,16 @@ def parse_yaml(test_params, input_yaml_file):
                 inv.iterations = positive_integer(v)
             elif k == "threads":
                 test_params.thread_count = positive_integer(v)
+            elif k == "worker-engine":
+                if v not in test_params.all_worker_engines:
+                    raise SmfParseException('worker-engine "%s" not recognized' % v)
+                test_params.worker_engine = v
+            elif k == "executor-threads":
+                test_params.executor_threads = positive_integer(v)
+            elif k == "procs":
+                test_params.procs = non_negative_integer(v)
+            elif k == "threads-per-proc":
+                test_params.threads_per_proc = non_negative_integer(v)
             elif k == "files-per-dir":
                 inv.files_per_dir = positive_integer(v)
             elif k == "dirs-per-dir":
@@ -106,6 +122,10 @@ def parse_yaml(test_params, input_yaml_file):
                 inv.is_shared_dir = boolean(v)
             elif k == "verbose":
                 inv.verbose = boolean(v)
+            elif k == "control-port":
+                test_params.control_port = non_negative_integer(v)
+            elif k == "control-host":
+                test_params.control_host = v
             elif k == "permute-host-dirs":
                 test_params.permute_host_dirs = boolean(v)
             elif k == "record-time-size":
@@ -114,6 +134,22 @@ def parse_yaml(test_params, input_yaml_file):
                 inv.verify_read = boolean(v)
             elif k == "incompressible":
                 inv.incompressible = boolean(v)
+            elif k == "io-engine":
+                if v not in smallfile.SmallfileWorkload.all_io_engines:
+                    raise SmfParseException('io-engine "%s" not recognized' % v)
+                inv.io_engine = v
+            elif k == "iov-count":
+                inv.iov_count = positive_integer(v)
+            elif k == "direct-io":
+                inv.direct_io = boolean(v)
+            elif k == "iodepth":
+                inv.iodepth = positive_integer(v)
+            elif k == "dir-threads":
+                inv.dir_threads = positive_integer(v)
+            elif k == "cleanup-scan":
+                inv.cleanup_scan = boolean(v)
+            elif k == "dir-fd-cache":
+                inv.dir_fd_cache_size = non_negative_integer(v)
             elif k == "min-dirs-per-sec":
                 test_params.min_directories_per_sec = positive_integer(v)
             elif k == "log-to-stderr":
@@ -178,6 +214,44 @@ class TestYamlParse(unittest_module.TestCase):
             == smallfile.SmallfileWorkload.fsdistr_random_exponential
         )
 
+    def test_parse_rsptime_format(self):
+        fn = os.path.join(tempfile.gettempdir(), "sample_parse_rsptime_format.yaml")
+        with open(fn, "w") as f:
+            f.write("response-times: y\n")
+            f.write("response-times-format: csv\n")
+        parse_yaml(self.params, fn)
+        assert self.params.master_invoke.measure_rsptimes
+        assert self.params.master_invoke.rsptime_format == "csv"
+
+    def test_parse_io_engine(self):
+        fn = os.path.join(tempfile.gettempdir(), "sample_parse_io_engine.yaml")
+        with open(fn, "w") as f:
+            f.write("io-engine: vectored\n")
+            f.write("iov-count: 8\n")
+        parse_yaml(self.params, fn)
+        assert self.params.master_invoke.io_engine == "vectored"
+        assert self.params.master_invoke.iov_count == 8
+
+    def test_parse_procs(self):
+        fn = os.path.join(tempfile.gettempdir(), "sample_parse_procs.yaml")
+        with open(fn, "w") as f:
+            f.write("threads: 16\n")
+            f.write("procs: 4\n")
+        parse_yaml(self.params, fn)
+        assert self.params.procs == 4
+        assert self.params.get_threads_per_proc() == 4
+        self.params.threads_per_proc = 8
+        assert self.params.get_threads_per_proc() == 8
+
+    def test_parse_control(self):
+        fn = os.path.join(tempfile.gettempdir(), "sample_parse_control.yaml")
+        with open(fn, "w") as f:
+            f.write("control-port: 9123\n")
+            f.write("control-host: driver.example.com\n")
+        parse_yaml(self.params, fn)
+        assert self.params.control_port == 9123
+        assert self.params.control_host == "driver.example.com"
+
     def test_parse_dir_list(self):
         fn = os.path.join(tempfile.gettempdir(), "sample_parse_dirlist.yaml")
         with open(fn, "w") as f: